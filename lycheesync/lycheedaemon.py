@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import click
+
+from lycheesync.lycheewatcher import PhotoTitles
+from lycheesync.lycheewatcher import closeAggregator
+from lycheesync.lycheewatcher import makeAggregator
+from lycheesync.lycheewatcher import reconcile
+from lycheesync.utils.boilerplatecode import reload_conf
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = ('sync-now', 'status')
+
+# read once when the daemon starts (db connections, watch pipeline, throttle, metrics, photo ids,
+# image and deletion workers): SIGHUP does not change them, by key prefix
+STARTUP_KEYS = ('db', 'srcdir', 'lycheepath', 'watch', 'daemonSocket', 'throttle', 'metrics', 'photoId',
+                'image', 'delete')
+
+
+def serve(conf):
+    """
+    Daemon mode main loop, until SIGTERM or SIGINT
+    Returns nothing
+    """
+    SyncDaemon(conf).run()
+
+
+class SyncDaemon:
+
+    """
+    A long running sync keeping its state warm between syncs:
+    - db connections, album cache and photo titles of the albums (MyEventHandler)
+    - fingerprints of the source tree (FingerprintStore): the scan manifest
+    An incremental sync is a reconcile of the source tree, the changes are handled as watch mode events.
+    The first one, without fingerprints yet, goes through every photo: already imported ones are skipped
+    without being read, from the photo titles (PhotoTitles, loaded again at each sync)
+    Syncs run every daemonInterval seconds, on SIGUSR1 and on the sync-now command
+    SIGHUP reloads the configuration file
+    Commands are read on a local unix socket (daemonSocket), one per line: sync-now, status.
+    Each one is answered with a json line
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.aggregator = makeAggregator(conf)
+        if self.aggregator.store is None:
+            raise Exception("daemon mode needs the watchState fingerprints")
+        self.aggregator.handler.titles = PhotoTitles()
+        self.socket_path = conf.get('daemonSocket', os.path.join('logs', 'lycheesync.sock'))
+        self.server = None
+        self.requested = threading.Event()
+        self.reloading = False
+        self.stopped = False
+        self.syncing = False
+        self.syncs = 0
+        self.started = time.time()
+        self.next_sync = self.started
+        # {'start', 'end', 'changes'}
+        self.last_sync = None
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._onSighup)
+        signal.signal(signal.SIGUSR1, self._onSigusr1)
+        signal.signal(signal.SIGTERM, self._onSigterm)
+        self.server = startServer(self.socket_path, self)
+        logger.info("daemon started, commands on %s", self.socket_path)
+        try:
+            while not self.stopped:
+                time.sleep(0.2)
+                if self.reloading:
+                    self.reload()
+                if not self.syncing and (self.requested.is_set() or time.time() >= self.next_sync):
+                    self.startSync()
+                self.aggregator.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            closeAggregator(self.aggregator)
+            logger.info("daemon stopped after %s syncs", self.syncs)
+
+    def _onSighup(self, signum, frame):
+        self.reloading = True
+
+    def _onSigusr1(self, signum, frame):
+        self.requested.set()
+
+    def _onSigterm(self, signum, frame):
+        self.stopped = True
+
+    def reload(self):
+        self.reloading = False
+        try:
+            changed, ignored = reload_conf(STARTUP_KEYS)
+            logger.info("configuration reloaded, changed: %s", ", ".join(changed) or "nothing")
+            if ignored:
+                logger.warn("not reloaded, restart the daemon to apply: %s", ", ".join(ignored))
+        except Exception as e:
+            logger.exception(e)
+            logger.error("configuration not reloaded")
+
+    def startSync(self):
+        self.requested.clear()
+        self.syncing = True
+        t = threading.Thread(target=self._sync, name='sync')
+        t.daemon = True
+        t.start()
+
+    def _sync(self):
+        start = time.time()
+        changes = None
+        # photos may have been deleted from Lychee since the last sync
+        self.aggregator.handler.titles.clear()
+        try:
+            # without fingerprints, everything is checked
+            changes = reconcile(self.aggregator.store, self.conf['srcdir'], self.aggregator.dispatch, baseline=False)
+        except Exception as e:
+            logger.exception(e)
+            logger.error("incremental sync failed")
+        finally:
+            self.last_sync = {'start': start, 'end': time.time(), 'changes': changes}
+            self.syncs += 1
+            self.next_sync = time.time() + self.conf.get('daemonInterval', 3600)
+            self.syncing = False
+
+    def status(self):
+        """
+        Returns a dict of the daemon state, json serializable
+        """
+        aggregator = self.aggregator
+        pool = aggregator.pool
+        albums = aggregator.handler.albums
+        titles = aggregator.handler.titles
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'syncs': self.syncs,
+            'syncing': self.syncing,
+            'last_sync': self.last_sync,
+            'next_sync': self.next_sync,
+            'events': {'received': aggregator.received, 'coalesced': aggregator.coalesced,
+                       'dispatched': aggregator.dispatched, 'failed': aggregator.failed,
+                       'pending': len(aggregator.pending), 'writing': aggregator.writing,
+                       'journaled': aggregator.journal.depth if aggregator.journal else 0},
+            'workers': {'queued': pool.queued, 'running': pool.running, 'done': pool.done, 'failed': pool.failed},
+            'album_cache': {'hits': albums.hits, 'misses': albums.misses},
+            'title_cache': {'hits': titles.hits, 'misses': titles.misses}}
+
+    def command(self, name):
+        """
+        Run a socket command
+        Returns the answer, a json serializable dict
+        """
+        if name == 'sync-now':
+            self.requested.set()
+            return {'ok': True, 'syncing': self.syncing}
+        elif name == 'status':
+            return {'ok': True, 'status': self.status()}
+        return {'ok': False, 'error': "unknown command: {}, expected one of: {}".format(name, ", ".join(COMMANDS))}
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            name = line.decode('utf-8').strip()
+            if not name:
+                continue
+            try:
+                answer = self.server.syncdaemon.command(name)
+            except Exception as e:
+                logger.exception(e)
+                answer = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(answer) + "\n").encode('utf-8'))
+
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def startServer(path, syncdaemon):
+    """
+    Listen for commands on the unix socket path, in a background thread
+    A socket left by a dead daemon is replaced
+    Returns the CommandServer
+    """
+    if os.path.exists(path):
+        try:
+            sendCommand(path, 'status')
+        except socket.error:
+            # nobody listening
+            os.remove(path)
+        else:
+            raise Exception("a daemon already listens on " + path)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    server = CommandServer(path, CommandHandler)
+    # local user only
+    os.chmod(path, 0o600)
+    server.syncdaemon = syncdaemon
+    t = threading.Thread(target=server.serve_forever, name='commands')
+    t.daemon = True
+    t.start()
+    return server
+
+
+def sendCommand(path, name, timeout=10):
+    """
+    Send a command to the daemon listening on the unix socket path
+    Returns its answer, a dict
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall((name + "\n").encode('utf-8'))
+        answer = b""
+        while not answer.endswith(b"\n"):
+            data = client.recv(4096)
+            if not data:
+                break
+            answer += data
+    finally:
+        client.close()
+    return json.loads(answer.decode('utf-8'))
+
+
+@click.command()
+@click.option('--socket', 'socket_path', default=os.path.join('logs', 'lycheesync.sock'),
+              type=click.Path(), help='daemon unix socket (daemonSocket)')
+@click.argument('command', type=click.Choice(COMMANDS))
+def main(socket_path, command):
+    """Send a command to a running lycheesync daemon"""
+    try:
+        answer = sendCommand(socket_path, command)
+    except socket.error as e:
+        click.echo("no daemon listening on {}: {}".format(socket_path, e), err=True)
+        sys.exit(1)
+    click.echo(json.dumps(answer, indent=2, sort_keys=True))
+    if not answer.get('ok'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,58 @@ from __future__ import unicode_literals
 import datetime
 import logging
 import re
+import time
 
 import pymysql
-from dateutil.parser import parse
+
+from lycheesync.utils.metrics import instrument
 
 logger = logging.getLogger(__name__)
 
+# called with (query, elapsed seconds, rows) after each query, rows is None if it failed. ex: Throttle.observeQuery
+QUERY_LISTENERS = []
+# called after each commit
+COMMIT_LISTENERS = []
+# called when a connection is reopened (ping(True) after an idle timeout, a lost server)
+RECONNECT_LISTENERS = []
+
+
+class TimedCursor(pymysql.cursors.DictCursor):
+    """
+    DictCursor reporting its queries to QUERY_LISTENERS: every statement of LycheeDAO goes through execute
+    """
+
+    def execute(self, query, args=None):
+        start = time.time()
+        rows = None
+        try:
+            rows = super(TimedCursor, self).execute(query, args)
+            return rows
+        finally:
+            elapsed = time.time() - start
+            for listener in QUERY_LISTENERS:
+                listener(query, elapsed, rows)
+
+
+class CountingConnection(pymysql.connections.Connection):
+    """
+    Connection reporting its commits to COMMIT_LISTENERS and its reconnections to RECONNECT_LISTENERS
+    """
+
+    connected = False
+
+    def connect(self, sock=None):
+        super(CountingConnection, self).connect(sock)
+        if self.connected:
+            for listener in RECONNECT_LISTENERS:
+                listener()
+        self.connected = True
+
+    def commit(self):
+        super(CountingConnection, self).commit()
+        for listener in COMMIT_LISTENERS:
+            listener()
+
 
 class LycheeDAO:
     """
@@ -36,21 +82,21 @@ class LycheeDAO:
                 logger.debug("password: %s", self.conf['dbPassword'])
                 logger.debug("db: %s", self.conf['db'])
                 logger.debug("unix_socket: %s", self.conf['dbSocket'])
-                self.db = pymysql.connect(host=self.conf['dbHost'],
-                                          user=self.conf['dbUser'],
-                                          passwd=self.conf['dbPassword'],
-                                          db=self.conf['db'],
-                                          charset='utf8mb4',
-                                          unix_socket=self.conf['dbSocket'],
-                                          cursorclass=pymysql.cursors.DictCursor)
+                self.db = CountingConnection(host=self.conf['dbHost'],
+                                             user=self.conf['dbUser'],
+                                             passwd=self.conf['dbPassword'],
+                                             db=self.conf['db'],
+                                             charset='utf8mb4',
+                                             unix_socket=self.conf['dbSocket'],
+                                             cursorclass=TimedCursor)
             else:
                 logger.debug("Connection to db in NO SOCKET mode")
-                self.db = pymysql.connect(host=self.conf['dbHost'],
-                                          user=self.conf['dbUser'],
-                                          passwd=self.conf['dbPassword'],
-                                          db=self.conf['db'],
-                                          charset='utf8mb4',
-                                          cursorclass=pymysql.cursors.DictCursor)
+                self.db = CountingConnection(host=self.conf['dbHost'],
+                                             user=self.conf['dbUser'],
+                                             passwd=self.conf['dbPassword'],
+                                             db=self.conf['db'],
+                                             charset='utf8mb4',
+                                             cursorclass=TimedCursor)
 
             cur = self.db.cursor()
             cur.execute("set names utf8;")
@@ -121,42 +167,69 @@ class LycheeDAO:
         finally:
             return res
 
-    def updateAlbumDate(self, albumid, newdate):
+    def updateAlbumsDate(self, album_ids, maxstamp):
         """
-        Update album date to an arbitrary date
-        newdate is an epoch timestamp
+        Set many albums date to the most recent takestamp of their photos in one query
+        Parameters:
+        - album_ids: an iterable of album ids
+        - maxstamp: photos with a takestamp greater or equal to this epoch timestamp are ignored
+        Returns the number of updated albums
         """
+        res = 0
+        album_ids = [str(a) for a in album_ids]
+        if len(album_ids) == 0:
+            return res
 
-        res = True
+        placeholders = ','.join(['%s'] * len(album_ids))
+        qry = ("update lychee_albums a join " +
+               "(select album, max(takestamp) as maxstamp from lychee_photos " +
+               "where album in (" + placeholders + ") and takestamp < %s group by album) p " +
+               "on a.id = p.album set a.sysstamp = p.maxstamp")
         try:
-            qry = "update lychee_albums set sysstamp= '" + str(newdate) + "' where id=" + str(albumid)
             cur = self.db.cursor()
-            cur.execute(qry)
+            res = cur.execute(qry, album_ids + [int(maxstamp)])
             self.db.commit()
         except Exception as e:
             logger.exception(e)
-            res = False
-            logger.error("updateAlbumDate", Exception)
+            logger.error("updateAlbumsDate while executing: %s", qry)
+            self.db.rollback()
             raise
-        finally:
-            return res
+        return res
 
-    def changeAlbumId(self, oldid, newid):
+    def changeAlbumIds(self, id_map):
         """
-        Change albums id based on album titles (to affect display order)
+        Change many albums ids at once (to affect display order)
+        Parameter:
+        - id_map: a dictionnary key=old album id value=new album id
+        New ids must not collide with existing ones
+        Photos, albums and sub albums parent are renumbered through a temporary
+        mapping table with one set-based update per table and a single commit
+        Returns a boolean
         """
         res = True
-        photo_query = "update lychee_photos set album = " + str(newid) + " where album = " + str(oldid)
-        album_query = "update lychee_albums set id = " + str(newid) + " where id = " + str(oldid)
+        if not id_map:
+            return res
         try:
             cur = self.db.cursor()
-            cur.execute(photo_query)
-            cur.execute(album_query)
+            cur.execute("drop temporary table if exists lychee_albums_renum")
+            cur.execute("create temporary table lychee_albums_renum "
+                        "(oldid int(11) not null primary key, newid int(11) not null)")
+            cur.executemany(
+                "insert into lychee_albums_renum (oldid, newid) values (%s, %s)",
+                [(int(oldid), int(newid)) for oldid, newid in id_map.items()])
+            cur.execute(
+                "update lychee_photos p join lychee_albums_renum m on p.album = m.oldid set p.album = m.newid")
+            cur.execute(
+                "update lychee_albums a join lychee_albums_renum m on a.parent = m.oldid set a.parent = m.newid")
+            cur.execute(
+                "update lychee_albums a join lychee_albums_renum m on a.id = m.oldid set a.id = m.newid")
             self.db.commit()
-            logger.debug("album id changed: " + str(oldid) + " to " + str(newid))
+            cur.execute("drop temporary table if exists lychee_albums_renum")
+            logger.debug("%s album ids changed", len(id_map))
         except Exception as e:
             logger.exception(e)
-            logger.error("album id changed: " + str(oldid) + " to " + str(newid))
+            logger.error("changeAlbumIds failed for: %s", id_map)
+            self.db.rollback()
             res = False
         finally:
             return res
@@ -247,6 +320,21 @@ class LycheeDAO:
         finally:
             return res
 
+    def getPhotoTitles(self, album_id):
+        """
+        Lists the photo titles of an album
+        Returns a list of titles, None if the query failed
+        """
+        res = None
+        try:
+            cur = self.db.cursor()
+            cur.execute("select title from lychee_photos where album=%s", (album_id,))
+            res = [row['title'] for row in cur.fetchall()]
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            return res
+
     def photoExists(self, photo):
         """
         Check if a photo already exists in its album based on its original name or checksum
@@ -289,11 +377,12 @@ class LycheeDAO:
         finally:
             return res
 
-    def createAlbum(self, album):
+    def createAlbum(self, album, album_id=None):
         """
         Creates an album
         Parameter:
         - album: the album properties list, at least the name should be specified
+        - album_id: optional, an explicit id for the new album (used to create albums already sorted)
         Returns the created albumid or None
         """
         album['id'] = None
@@ -310,18 +399,30 @@ class LycheeDAO:
         try:
 
             cur = self.db.cursor()
-            logger.debug("try to createAlbum: %s", query)
-            cur.execute(
-                "insert into lychee_albums (title, sysstamp, public, password, parent) values (%s,%s,%s,NULL,%s)",
-                (
-                    album['name'],
-                    datetime.datetime.now().strftime('%s'),
-                    str(self.conf["publicAlbum"]),
-                    str(album['parent']))
-            )
+            logger.debug("try to createAlbum: %s (id: %s)", query, album_id)
+            if album_id:
+                cur.execute(
+                    "insert into lychee_albums (id, title, sysstamp, public, password, parent) "
+                    "values (%s,%s,%s,%s,NULL,%s)",
+                    (
+                        int(album_id),
+                        album['name'],
+                        datetime.datetime.now().strftime('%s'),
+                        str(self.conf["publicAlbum"]),
+                        str(album['parent']))
+                )
+            else:
+                cur.execute(
+                    "insert into lychee_albums (title, sysstamp, public, password, parent) values (%s,%s,%s,NULL,%s)",
+                    (
+                        album['name'],
+                        datetime.datetime.now().strftime('%s'),
+                        str(self.conf["publicAlbum"]),
+                        str(album['parent']))
+                )
             self.db.commit()
             rowId = None
-            rowId = cur.lastrowid
+            rowId = int(album_id) if album_id else cur.lastrowid
             self.albumslist[album['name']] = rowId
             album['id'] = rowId
 
@@ -362,11 +463,9 @@ class LycheeDAO:
 
     def setAlbumParentAndTitle(self, title, parents, id):
         res = True
-        album_query = "update lychee_albums set title = '" + str(title) + "', parent='" + str(
-            parents) + "' where id = " + str(id)
         try:
             cur = self.db.cursor()
-            cur.execute(album_query)
+            cur.execute("update lychee_albums set title = %s, parent = %s where id = %s", (title, parents, id))
             self.db.commit()
         except Exception as e:
             logger.exception(e)
@@ -376,14 +475,34 @@ class LycheeDAO:
 
     def setPhotoAlbumAndTitle(self, title, Album, id):
         res = True
-        album_query = "update lychee_photos set title = '" + str(title) + "', album='" + str(
-            Album) + "' where id='" + str(id) + "'"
         try:
             cur = self.db.cursor()
-            cur.execute(album_query)
+            cur.execute("update lychee_photos set title = %s, album = %s where id = %s", (title, Album, id))
+            self.db.commit()
+        except Exception as e:
+            logger.exception(e)
+            res = False
+        finally:
+            return res
+
+    def mergeAlbum(self, src_id, dest_id):
+        """
+        Move the photos and sub albums of an album into another one, then drop it
+        Parameters:
+        - src_id: the album to merge and drop
+        - dest_id: the album receiving its content
+        Returns True on success
+        """
+        res = True
+        try:
+            cur = self.db.cursor()
+            cur.execute("update lychee_photos set album = %s where album = %s", (dest_id, src_id))
+            cur.execute("update lychee_albums set parent = %s where parent = %s", (dest_id, src_id))
+            cur.execute("delete from lychee_albums where id = %s", (src_id, ))
             self.db.commit()
         except Exception as e:
             logger.exception(e)
+            self.db.rollback()
             res = False
         finally:
             return res
@@ -567,18 +686,11 @@ class LycheeDAO:
         """
         Add a photo to an album
         Parameter:
-        - photo: a valid LycheePhoto object
+        - photo: a PhotoRecord (see LycheePhoto.record)
         Returns a boolean
         """
         res = True
 
-
-        try:
-            stamp = parse(photo.exif.takedate + ' ' + photo.exif.taketime).strftime('%s')
-        except Exception as e:
-
-            stamp = datetime.datetime.now().strftime('%s')
-
         query = ("insert into lychee_photos " +
                  "(id, url, public, type, width, height, " +
                  "size, star, " +
@@ -595,15 +707,15 @@ class LycheeDAO:
                  ).format(photo.id, photo.url, self.conf["publicAlbum"], photo.type, photo.width, photo.height,
                           photo.size, photo.star,
                           photo.thumbUrl, photo.albumid,
-                          stamp,
+                          photo.takestamp,
                           photo.checksum)
         try:
             logger.debug(query)
             cur = self.db.cursor()
-            res = cur.execute(query, (photo.exif.iso,
-                                      photo.exif.aperture,
-                                      photo.exif.make,
-                                      photo.exif.model, photo.exif.shutter, photo.exif.focal,
+            res = cur.execute(query, (photo.iso,
+                                      photo.aperture,
+                                      photo.make,
+                                      photo.model, photo.shutter, photo.focal,
                                       photo.description, photo.originalname, photo.tags))
             self.db.commit()
         except Exception as e:
@@ -647,3 +759,7 @@ class LycheeDAO:
             self.db.commit()
         except Exception as e:
             logger.exception(e)
+
+
+# each call is a timed stage: dao.photoExists...
+instrument(LycheeDAO, 'dao')
@@ -10,13 +10,14 @@ import logging
 import math
 import mimetypes
 import os
-import random
 import time
+from collections import namedtuple
 from fractions import Fraction
 
-import pyexiv2
-from PIL import Image
-from dateutil.parser import parse
+from lycheesync.utils import exifdate
+from lycheesync.utils.metrics import timed
+from lycheesync.utils import photoid
+from lycheesync.utils import transfer
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,19 @@ class ExifData:
         return res
 
 
+class PhotoRecord(namedtuple('PhotoRecord', [
+        'id', 'url', 'type', 'width', 'height', 'size', 'star', 'thumbUrl', 'albumid', 'takestamp',
+        'iso', 'aperture', 'make', 'model', 'shutter', 'focal',
+        'description', 'originalname', 'checksum', 'tags'])):
+
+    """
+    Compact and immutable photo data: only what LycheeDAO.addFileToAlbum needs
+    Built by LycheePhoto.record() once the photo files are in place
+    """
+
+    __slots__ = ()
+
+
 class LycheePhoto:
 
     """
@@ -89,53 +103,40 @@ class LycheePhoto:
     tags = ""
     exif = None
     _str_datetime = None
+    _epoch_sysdate = None
     checksum = ""
+    staged = None
 
     def convert_strdate_to_timestamp(self, value):
-        # check parameter type
-        # logger.debug("convert_strdate input: " + str(value))
-        # logger.debug("convert_strdate input_type: " + str(type(value)))
-
-        timestamp = None
-        # now in epoch time
-        epoch_now = int(time.time())
-        timestamp = epoch_now
-
-        if isinstance(value, int):
-            timestamp = value
-        elif isinstance(value, datetime.date):
-            timestamp = (value - datetime.datetime(1970, 1, 1)).total_seconds()
-        elif value:
-
-            value = str(value)
-
-            try:
-                the_date = parse(value)
-                # works for python 3
-                # timestamp = the_date.timestamp()
-                timestamp = time.mktime(the_date.timetuple())
-
-            except Exception as e:
-                logger.warn('model date impossible to parse: ' + str(value))
-                timestamp = epoch_now
-        else:
-            # Value is None
-            timestamp = epoch_now
-
-        return timestamp
+        return exifdate.convert_strdate_to_timestamp(value)
 
     @property
     def epoch_sysdate(self):
-        return self.convert_strdate_to_timestamp(self._str_datetime)
+        # computed once per photo, see end of __init__
+        if self._epoch_sysdate is None:
+            self._epoch_sysdate = self.convert_strdate_to_timestamp(self._str_datetime)
+        return self._epoch_sysdate
 
     # Compute checksum
-    def __generateHash(self):
-        sha1 = hashlib.sha1()
-        with open(self.srcfullpath, 'rb') as f:
-            sha1.update(f.read())
-            self.checksum = sha1.hexdigest()
+    def __generateHash(self, stage=None):
+        """ streams the source once, writing it to stage at the same time if given """
+        self.checksum = transfer.sha1(self.srcfullpath, stage)
 
-    def __init__(self, conf, photoname, album):
+    def discardStaged(self):
+        """ remove the staged copy, if any (duplicate or failed import) """
+        if self.staged:
+            try:
+                os.remove(self.staged)
+            except OSError:
+                pass
+            self.staged = None
+
+    def __init__(self, conf, photoname, album, stage=False):
+        """
+        Parameters:
+        - stage: when photos are copied, copy the source to lychee while computing its checksum
+          (see copyFileToLychee), to read it once. discardStaged must be called if it's not imported
+        """
         # Parameters storage
         self.conf = conf
         self.originalname = photoname
@@ -148,18 +149,8 @@ class LycheePhoto:
             self.star = 1
 
         # Compute Photo ID
-        self.id = str(int(time.time()))
-        # not precise enough
-        length = len(self.id)
-        if length < 14:
-            missing_char = 14 - length
-            r = random.random()
-            r = str(r)
-            # last missing_char char
-            filler = r[-missing_char:]
-            self.id = self.id + filler
-
-        assert len(self.id) == 14, "id {} is not 14 character long: {}".format(self.id, str(len(self.id)))
+        # epoch seconds, worker id and sequence: unique across threads, and across processes with distinct workers
+        self.id = photoid.next_photo_id(self.conf)
 
         # Compute file storage url
         m = hashlib.md5()
@@ -175,8 +166,20 @@ class LycheePhoto:
         self.destfullpath = os.path.join(self.conf["lycheepath"], "uploads", "big", self.url)
 
         # Generate file checksum
-        self.__generateHash()
-
+        self.staged = None
+        if stage and transfer.get_transfer(conf).strategy == 'copy':
+            self.staged = os.path.join(os.path.dirname(self.destfullpath), '.staged-' + self.url)
+        try:
+            # with the staged copy when there is one
+            with timed('hash', os.path.getsize(self.srcfullpath)):
+                self.__generateHash(self.staged)
+            with timed('exif'):
+                self.__readProperties()
+        except Exception:
+            self.discardStaged()
+            raise
+
+    def __readProperties(self):
         # thumbnails already in place (see makeThumbnail)
 
         # Auto file some properties
@@ -191,6 +194,8 @@ class LycheePhoto:
 
         # Exif Data Parsing
         self.exif = ExifData()
+        # imported here: pyexiv2 is slow to import and only needed to import photos
+        import pyexiv2
         try:
 
             metadata = pyexiv2.ImageMetadata(self.srcfullpath)
@@ -200,6 +205,7 @@ class LycheePhoto:
                 w = metadata['Exif.Photo.PixelXDimension'].value
                 h = metadata['Exif.Photo.PixelYDimension'].value
             else:
+                from PIL import Image
                 img = Image.open(self.srcfullpath)
                 w, h = img.size
                 metadata['Exif.Photo.PixelXDimension'] = pyexiv2.ExifTag('Exif.Photo.PixelXDimension', w)
@@ -329,11 +335,40 @@ class LycheePhoto:
 
             self._str_datetime = takedate + " " + taketime
 
+            # parse date once
+            self._epoch_sysdate = self.convert_strdate_to_timestamp(self._str_datetime)
 
         except IOError as e:
             logger.debug('ioerror (corrupted ?): ' + self.srcfullpath)
             raise e
 
+    def record(self):
+        """
+        Returns a PhotoRecord with the current photo properties
+        Call it after adjustRotation which can swap width and height
+        """
+        return PhotoRecord(
+            id=self.id,
+            url=self.url,
+            type=self.type,
+            width=int(self.width),
+            height=int(self.height),
+            size=self.size,
+            star=self.star,
+            thumbUrl=self.thumbUrl,
+            albumid=self.albumid,
+            takestamp=int(self.epoch_sysdate),
+            iso=self.exif.iso,
+            aperture=self.exif.aperture,
+            make=self.exif.make,
+            model=self.exif.model,
+            shutter=self.exif.shutter,
+            focal=self.exif.focal,
+            description=self.description,
+            originalname=self.originalname,
+            checksum=self.checksum,
+            tags=self.tags)
+
     def __str__(self):
         res = ""
         res += "originalname:" + str(self.originalname) + "\n"
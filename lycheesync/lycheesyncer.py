@@ -4,20 +4,26 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
-import shutil
-
-import pyexiv2
-from PIL import Image
-from PIL import ImageFile
-from pathtools.patterns import match_path
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
 
 from lycheesync.lycheedao import LycheeDAO
 from lycheesync.lycheemodel import LycheePhoto
+from lycheesync.utils import exporter
+from lycheesync.utils import transfer
+from lycheesync.utils import querystats
+from lycheesync.utils.metrics import get_metrics
+from lycheesync.utils.metrics import report
+from lycheesync.utils.metrics import timed
+from lycheesync.utils.pagecache import get_page_cache
+from lycheesync.utils.throttle import get_throttle
 from lycheesync.utils.configuration import ConfBorg
+from lycheesync.utils.deletion import close_deletion_services
+from lycheesync.utils.deletion import get_deletion_service
+from lycheesync.utils import imagework
+from lycheesync.utils.sandbox import ImageTaskError
+from lycheesync.utils.sandbox import close_sandboxes
+from lycheesync.utils.sandbox import get_quarantine
+from lycheesync.utils.sandbox import get_sandbox
 
-ImageFile.LOAD_TRUNCATED_IMAGES = True
 import datetime
 import time
 import sys
@@ -44,35 +50,6 @@ class LycheeSyncer:
         borg = ConfBorg()
         self.conf = borg.conf
 
-    def deleteFiles(self, filelist):
-        """
-        Delete files in the Lychee file tree (uploads/big and uploads/thumbnails)
-        Give it the file name and it will delete relatives files and thumbnails
-        Parameters:
-        - filelist: a list of filenames
-        Returns nothing
-        """
-
-        for url in filelist:
-            if isAPhoto(self, url):
-                thumbpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb", url)
-                filesplit = os.path.splitext(url)
-                thumb2path = ''.join([filesplit[0], "@2x", filesplit[1]]).lower()
-                thumb2path = os.path.join(self.conf["lycheepath"], "uploads", "thumb", thumb2path)
-                bigpath = os.path.join(self.conf["lycheepath"], "uploads", "big", url)
-                remove_file(thumbpath)
-                remove_file(thumb2path)
-                remove_file(bigpath)
-
-    def deleteAllFiles(self):
-        """
-        Deletes every photo file in Lychee
-        Returns nothing
-        """
-        photopath = os.path.join(self.conf["lycheepath"], "uploads", "big")
-        filelist = [f for f in os.listdir(photopath)]
-        self.deleteFiles(filelist)
-
     def sync(self):
         """
         Program main loop
@@ -81,11 +58,18 @@ class LycheeSyncer:
         Returns nothing
         """
 
+        throttle = get_throttle(self.conf)
+        if throttle:
+            throttle.applyPriority()
+        # before connecting: every statement is counted
+        querystats.get_query_stats(self.conf)
+
         # Connect db
         # and drop it if dropdb activated
         self.dao = LycheeDAO(self.conf)
+        albums = []
         if self.conf['dropdb']:
-            self.deleteAllFiles()
+            deleteAllFiles(self)
             # Load db
 
             createdalbums = 0
@@ -93,11 +77,24 @@ class LycheeSyncer:
             importedphotos = 0
             album = {}
             albums = []
+            # ids of albums where photos have been imported
+            touchedalbums = set()
 
             album_name_max_width = self.dao.getAlbumNameDBWidth()
+            pagecache = get_page_cache(self.conf)
+            quarantine = get_quarantine(self.conf)
+
+            walk = get_metrics().timedIter('walk', os.walk(self.conf['srcdir']))
+            # in sort mode, album ids are allocated in sorted order before creation
+            album_ids_plan = {}
+            if self.conf['sort']:
+                # kept for the import: srcdir is scanned once
+                walk = list(sortedWalk(walk))
+                album_ids_plan = planAlbumIds(self, walk)
 
             # walkthroug each file / dir of the srcdir
-            for root, dirs, files in os.walk(self.conf['srcdir']):
+            for root, dirs, files in walk:
+                querystats.enter(self.conf, 'album', root)
 
                 if sys.version_info.major == 2:
                     try:
@@ -110,7 +107,6 @@ class LycheeSyncer:
                 album['path'] = None
                 album['relpath'] = None  # path relative to srcdir
                 album['parent'] = "0"
-                album['photos'] = []# path relative to srcdir
                 album = getAlbum(self, root)
                 # if a there is at least one photo in the files
 
@@ -128,14 +124,14 @@ class LycheeSyncer:
                 if self.conf['replace'] and album['id']:
                     # drop album photos
                     filelist = self.dao.eraseAlbum(album['id'])
-                    self.deleteFiles(filelist)
+                    deleteFiles(self, filelist)
                     assert self.dao.dropAlbum(album['id'])
                     # Album should be recreated
                     album['id'] = False
 
                 if not (album['id']):
                     # create album
-                    album['id'] = createAlbum(self, album)
+                    album['id'] = createAlbum(self, album, album_ids_plan.get(root))
 
                     if not (album['id']):
                         logger.error("didn't manage to create album for: " + album['name'])
@@ -146,56 +142,70 @@ class LycheeSyncer:
                     createdalbums += 1
 
                 # Albums are created or emptied, now take care of photos
-                for f in sorted(files):
-
-                    if isAPhoto(self, f):
-                        try:
-                            discoveredphotos += 1
-                            error = False
-                            logger.debug(
-                                "**** Trying to add to lychee album %s: %s",
-                                album['name'],
-                                os.path.join(
-                                    root,
-                                    f))
-                            # corruption detected here by launching exception
-                            photo = LycheePhoto(self.conf, f, album)
-                            if not (self.dao.photoExists(photo)):
-                                res = copyFileToLychee(self, photo)
-                                adjustRotation(self, photo)
-                                makeThumbnail(self, photo)
-                                res = self.dao.addFileToAlbum(photo)
-                                # increment counter
-                                if res:
-                                    importedphotos += 1
-                                    album['photos'].append(photo)
-                                else:
-                                    error = True
-                                    logger.error(
-                                        "while adding to album: %s photo: %s",
-                                        album['name'],
-                                        photo.srcfullpath)
+                # the next photos are read ahead by the kernel while this one is imported
+                photos = [f for f in sorted(files) if isAPhoto(self, f)]
+                for f in pagecache.ahead(photos, root):
+                    photo = None
+                    try:
+                        discoveredphotos += 1
+                        error = False
+                        logger.debug(
+                            "**** Trying to add to lychee album %s: %s",
+                            album['name'],
+                            os.path.join(
+                                root,
+                                f))
+                        querystats.enter(self.conf, 'photo', os.path.join(root, f))
+                        if quarantine.contains(os.path.join(root, f)):
+                            logger.warn("quarantined, skipped until modified: %s", os.path.join(root, f))
+                            error = True
+                            continue
+                        if throttle:
+                            throttle.before(os.path.join(root, f))
+                        # corruption detected here by launching exception
+                        photo = LycheePhoto(self.conf, f, album, stage=True)
+                        if not (self.dao.photoExists(photo)):
+                            res = copyFileToLychee(self, photo)
+                            processImage(self, photo)
+                            res = self.dao.addFileToAlbum(photo.record())
+                            exporter.imported(self.conf, res)
+                            # increment counter
+                            if res:
+                                importedphotos += 1
+                                touchedalbums.add(album['id'])
                             else:
-                                logger.warn(
-                                    "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
-                                    photo.srcfullpath)
                                 error = True
-                        except Exception as e:
-
-                            logger.exception(e)
-                            logger.error("could not add %s to album %s", f, album['name'])
+                                logger.error(
+                                    "while adding to album: %s photo: %s",
+                                    album['name'],
+                                    photo.srcfullpath)
+                        else:
+                            logger.warn(
+                                "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
+                                photo.srcfullpath)
+                            photo.discardStaged()
                             error = True
-                        finally:
-                            if not (error):
-                                logger.info(
-                                    "**** Successfully added %s to lychee album %s",
-                                    os.path.join(
-                                        root,
-                                        f),
-                                    album['name'])
-
-                a = album.copy()
-                albums.append(a)
+                    except Exception as e:
+                        if photo is not None:
+                            photo.discardStaged()
+                        logger.exception(e)
+                        logger.error("could not add %s to album %s", f, album['name'])
+                        exporter.imported(self.conf, False)
+                        error = True
+                    finally:
+                        querystats.leave(self.conf, 'photo')
+                        if photo is not None:
+                            pagecache.done(photo.srcfullpath, None if error else photo.destfullpath)
+                        if not (error):
+                            logger.info(
+                                "**** Successfully added %s to lychee album %s",
+                                os.path.join(
+                                    root,
+                                    f),
+                                album['name'])
+
+                # only keep what reorderalbumids needs
+                albums.append({'id': album['id'], 'name': album['name']})
                 logger.info("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
                 logger.info("Directory scanned:" + self.conf['srcdir'])
                 logger.info("Created albums: " + str(createdalbums))
@@ -206,10 +216,13 @@ class LycheeSyncer:
                     logger.error(
                         str(importedphotos) + " photos imported on " + str(discoveredphotos) + " discovered")
                 logger.info("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-            updateAlbumsDate(self, albums)
+            querystats.leave(self.conf, 'album')
+            pagecache.close()
+            quarantine.report()
+            updateAlbumsDate(self, touchedalbums)
         if self.conf['sort']:
-            reorderalbumids(self, albums)
-            self.dao.reinitAlbumAutoIncrement()
+            if reorderalbumids(self, albums):
+                self.dao.reinitAlbumAutoIncrement()
 
         if self.conf['sanity']:
 
@@ -226,7 +239,7 @@ class LycheeSyncer:
                     to_delete = self.dao.get_all_photos(a_id)
                     self.dao.eraseAlbum(a_id)
                     file_list = [p['url'] for p in to_delete]
-                    self.deleteFiles(file_list)
+                    deleteFiles(self, file_list)
 
             # get All Photos
             photos = self.dao.get_all_photos()
@@ -266,7 +279,7 @@ class LycheeSyncer:
                     # check if DB photo exists
                     if not self.dao.photoExistsByName(file_name):
                         # if not delete photo (or link)
-                        self.deleteFiles([file_name])
+                        deleteFiles(self, [file_name])
                         logger.info("%s deleted. Wasn't existing in DB", f)
 
                     # if broken link
@@ -277,7 +290,7 @@ class LycheeSyncer:
                             ps = {'id': id, 'url': file_name}
                             deletePhotos(self, [ps])
                         else:
-                            self.deleteFiles([file_name])
+                            deleteFiles(self, [file_name])
                         logger.info("%s deleted. Was a broken link", f)
 
             # drop empty albums
@@ -287,182 +300,23 @@ class LycheeSyncer:
                     self.dao.dropAlbum(e)
 
         self.dao.close()
+        close_deletion_services()
+        close_sandboxes()
+        report(self.conf)
+        querystats.report(self.conf)
+        exporter.report(self.conf)
         if self.conf['watch']:
-            event_handler = MyEventHandler()
-
-            observer = Observer()
-            observer.schedule(event_handler, self.conf['srcdir'], recursive=True)
-            observer.start()
-            try:
-                while True:
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                observer.stop()
-            observer.join()
-
-
-class MyEventHandler(FileSystemEventHandler):
-
-    def catch_all_handler(self, event):
-        return
-
-    def on_moved(self, event):
-        borg = ConfBorg()
-        self.conf = borg.conf
-        self.dao = LycheeDAO(self.conf)
-
-        if event.is_directory:
-
-            albSrc = getAlbum(self, event.src_path)
-            albDest = getAlbum(self, event.dest_path)
-            logger.info("%s Album moved to %s. ", event.src_path, event.dest_path)
-            self.dao.setAlbumParentAndTitle(albDest['name'], albDest['parent'], albSrc['id'])
-            return
-        else:
-            if match_path(event.src_path,
-                          included_patterns=['*.jpg', '*.jpeg', '*.gif', '*.png'],
-                          excluded_patterns=None,
-                          case_sensitive=False):
-                dirs = event.src_path.split(os.sep)
-                albDir = os.sep.join(dirs[:-1])
-                dirs2 = event.dest_path.split(os.sep)
-                albDir2 = os.sep.join(dirs2[:-1])
-                album = getAlbum(self, albDir)
-                if album['id'] == None:
-                    album = getAlbum(self, albDir2)
-
-                dbPhoto = self.dao.get_photo_light(album['id'], os.sep.join(dirs[-1:]), "")
-
-                album2 = getAlbum(self, albDir2)
-                logger.info("%s Photo moved to %s. ", event.src_path, event.dest_path)
-                self.dao.setPhotoAlbumAndTitle(os.sep.join(dirs2[-1:]), album2['id'], dbPhoto['id'])
-
-
-
-            return
-
-    def on_created(self, event):
-
-        borg = ConfBorg()
-        self.conf = borg.conf
-        self.dao = LycheeDAO(self.conf)
-
-        if event.is_directory:
-            album = getAlbum(self, event.src_path)
-            logger.info("Created album: %s.", album['name'])
-            self.dao.createAlbum(album)
-            return
-
-        else:
-            if match_path(event.src_path,
-                          included_patterns=['*.jpg', '*.jpeg', '*.gif', '*.png'],
-                          excluded_patterns=None,
-                          case_sensitive=False):
-                dirs = event.src_path.split(os.sep)
-                albDir = os.sep.join(dirs[:-1])
-                album = getAlbum(self, albDir)
-                album['path'] = albDir
-                photo = LycheePhoto(self.conf, os.sep.join(dirs[-1:]), album)
-                if not (self.dao.photoExists(photo)):
-                    res = copyFileToLychee(self, photo)
-
-                    adjustRotation(self, photo)
-                    makeThumbnail(self, photo)
-                    res = self.dao.addFileToAlbum(photo)
-                    logger.info("Created Photo: %s.", photo.srcfullpath)
-                    # increment counter
-                    if not res:
-                        logger.error(
-                            "while adding to album: %s photo: %s",
-                            album['name'],
-                            photo.srcfullpath)
-                else:
-                    logger.error(
-                        "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
-                        photo.srcfullpath)
-            return
-
-    def on_deleted(self, event):
-        borg = ConfBorg()
-        self.conf = borg.conf
-        self.dao = LycheeDAO(self.conf)
-        if event.is_directory:
-            album = getAlbum(self, event.src_path)
-            if album['id'] is not None:
-                filelist = self.dao.eraseAlbum(album['id'])
-                deleteFiles(self, filelist)
-                logger.info("Deleted album: %s.", album['name'])
-                assert self.dao.dropAlbum(album['id'])
-            else:
-                logger.error("Tried to delete album: %s, but it wasn't present in the DB", album['name'])
-
-            return
-        else:
-            if match_path(event.src_path,
-                          included_patterns=['*.jpg', '*.jpeg', '*.gif', '*.png'],
-                          excluded_patterns=None,
-                          case_sensitive=False):
-                dirs = event.src_path.split(os.sep)
-                albDir = os.sep.join(dirs[:-1])
-                album = getAlbum(self, albDir)
-                album['path'] = albDir
-                dbPhoto = self.dao.get_photo_light(album['id'], os.sep.join(dirs[-1:]), "")
-                if dbPhoto is not None:
-                    delete = [dbPhoto]
-                    deletePhotos(self, delete)
-                    logger.info("Deleted Photo: %s.", os.sep.join(dirs[-1:]))
-                else:
-                    logger.info("Tried to delete Photo: %s, but it wasn't in the database.", os.sep.join(dirs[-1:]))
-            return
-
-    def on_modified(self, event):
-        borg = ConfBorg()
-        self.conf = borg.conf
-        self.dao = LycheeDAO(self.conf)
-        if event.is_directory:
-            return
-        else:
-            if match_path(event.src_path,
-                          included_patterns=['*.jpg', '*.jpeg', '*.gif', '*.png'],
-                          excluded_patterns=None,
-                          case_sensitive=False):
-                dirs = event.src_path.split(os.sep)
-                albDir = os.sep.join(dirs[:-1])
-                album = getAlbum(self, albDir)
-                album['path'] = albDir
-                photo = LycheePhoto(self.conf, os.sep.join(dirs[-1:]), album)
-                dbPhoto = self.dao.get_photo(photo)
-                if dbPhoto is not None:
-                    delete = [dbPhoto]
-                    deletePhotos(self, delete)
-
-                dirs = event.src_path.split(os.sep)
-                albDir = os.sep.join(dirs[:-1])
-                album = getAlbum(self, albDir)
-                album['path'] = albDir
-                photo = LycheePhoto(self.conf, os.sep.join(dirs[-1:]), album)
-                if not (self.dao.photoExists(photo)):
-                    res = copyFileToLychee(self, photo)
-
-                    adjustRotation(self, photo)
-                    makeThumbnail(self, photo)
-                    res = self.dao.addFileToAlbum(photo)
-                    logger.info("Modified Photo: %s.", photo.srcfullpath)
-                    # increment counter
-                    if not res:
-                        logger.error(
-                            "while adding to album: %s photo: %s",
-                            album['name'],
-                            photo.srcfullpath)
-                else:
-                    logger.error(
-                        "photo already exists in this album with same name or same checksum: %s it won't be added to lychee",
-                        photo.srcfullpath)
-            return
+            # imported here: watchdog is only needed in watch mode
+            from lycheesync.lycheewatcher import watch
+            watch(self.conf)
+        elif self.conf.get('daemon'):
+            # imported here: watchdog is only needed in daemon and watch modes
+            from lycheesync.lycheedaemon import serve
+            serve(self.conf)
 
 
 def getAlbum(self, directory):
-    album = {'id': None, 'name': None, 'photos': [], 'parent': '0'}
+    album = {'id': None, 'name': None, 'parent': '0'}
 
     dirs = directory.split(os.sep)
     parent = '0'
@@ -516,19 +370,64 @@ def albumExists(self, album):
     """
 
 
-def createAlbum(self, album):
+def createAlbum(self, album, album_id=None):
     """
     Creates an album
     Inputs:
     - album: an album properties list. at least path should be specified (relative albumpath)
+    - album_id: optional, the album id allocated by planAlbumIds
     Returns an albumid or None if album does not exists
     """
     album['id'] = None
     if album['name'] != "":
-        album['id'] = self.dao.createAlbum(album)
+        album['id'] = self.dao.createAlbum(album, album_id)
     return album['id']
 
 
+def sortedWalk(walk):
+    """
+    os.walk results, sub directories visited in name order
+    """
+    for root, dirs, files in walk:
+        dirs.sort()
+        yield root, dirs, files
+
+
+def planAlbumIds(self, walk):
+    """
+    Allocate album ids in album name order before any album is created
+    so that sorted mode does not need to renumber albums afterwards
+    Takes the walk of srcdir the import will follow (see sortedWalk)
+    Returns a dictionnary key=album directory value=album id
+    """
+    plan = []
+    for root, dirs, files in walk:
+        if sys.version_info.major == 2:
+            try:
+                root = root.decode('UTF-8')
+            except Exception as e:
+                logger.error(e)
+        if root == self.conf['srcdir']:
+            continue
+        plan.append((os.path.basename(root), root))
+
+    # same order as reorderalbumids: by album name, then discovery order (stable sort)
+    plan.sort(key=lambda a: a[0])
+
+    min, max = self.dao.getAlbumMinMaxIds()
+    if max > 0:
+        newid = max + 1
+    else:
+        newid = 1
+
+    res = {}
+    for name, root in plan:
+        res[root] = newid
+        newid += 1
+    logger.debug("%s album ids planned from %s", len(res), newid - len(res))
+    return res
+
+
 def thumbIt(self, res, photo, destinationpath, destfile):
     """
     Create the thumbnail of a given photo
@@ -555,17 +454,14 @@ def thumbIt(self, res, photo, destinationpath, destfile):
 
     destimage = os.path.join(destinationpath, destfile)
     try:
-        img = Image.open(photo.destfullpath)
+        # decoded in the image sandbox
+        with timed("thumbnail {}x{}".format(*res)):
+            return get_sandbox(self.conf).run(imagework.thumbnail, photo.destfullpath, (left, upper, right, lower),
+                                              res, destimage)
     except Exception as e:
-        logger.exception(e)
-        logger.error("ioerror (corrupted file?): " + photo.srcfullpath)
+        logger.error("ioerror (corrupted file?): %s %s", photo.srcfullpath, e)
         raise
 
-    img = img.crop((left, upper, right, lower))
-    img.thumbnail(res, Image.ANTIALIAS)
-    img.save(destimage, quality=99)
-    return destimage
-
 
 def makeThumbnail(self, photo):
     """
@@ -596,11 +492,15 @@ def copyFileToLychee(self, photo):
     """
 
     try:
-        # copy photo
-        if self.conf['link']:
-            os.symlink(photo.srcfullpath, photo.destfullpath)
+        # copy, link or move photo, according to the transfer strategy
+        if photo.staged:
+            # already copied while computing its checksum
+            with timed('copy (staged)'):
+                transfer.get_transfer(self.conf).commit(photo.staged, photo.srcfullpath, photo.destfullpath)
+            photo.staged = None
         else:
-            shutil.copy(photo.srcfullpath, photo.destfullpath)
+            with timed('copy', os.path.getsize(photo.srcfullpath)):
+                transfer.get_transfer(self.conf).run(photo.srcfullpath, photo.destfullpath)
         # adjust right (chmod/chown)
         res = True
 
@@ -617,19 +517,10 @@ def deleteFiles(self, filelist):
     Give it the file name and it will delete relatives files and thumbnails
     Parameters:
     - filelist: a list of filenames
-    Returns nothing
+    Returns a dict of counts: removed, missing, failed
     """
-
-    for url in filelist:
-        if isAPhoto(self,url):
-            thumbpath = os.path.join(self.conf["lycheepath"], "uploads", "thumb", url)
-            filesplit = os.path.splitext(url)
-            thumb2path = ''.join([filesplit[0], "@2x", filesplit[1]]).lower()
-            thumb2path = os.path.join(self.conf["lycheepath"], "uploads", "thumb", thumb2path)
-            bigpath = os.path.join(self.conf["lycheepath"], "uploads", "big", url)
-            remove_file(thumbpath)
-            remove_file(thumb2path)
-            remove_file(bigpath)
+    urls = [url for url in filelist if isAPhoto(self, url)]
+    return get_deletion_service(self.conf).delete(urls)
 
 
 def adjustRotation(self, photo):
@@ -639,53 +530,53 @@ def adjustRotation(self, photo):
     """
 
     if photo.exif.orientation != 1:
-        metadata = pyexiv2.ImageMetadata(photo.srcfullpath)
-
-        metadata.read()
-        img = Image.open(photo.destfullpath)
-
-        if "Exif.Image.Orientation" in metadata.exif_keys:
-            orientation = metadata['Exif.Image.Orientation'].value
-
-            if orientation == 2:
-                img = img.transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                img = img.rotate(180)
-            elif orientation == 4:
-                img = img.rotate(180).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 5:
-                img = img.rotate(-90, expand=True).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 6:
-                img = img.rotate(-90, expand=True)
-            elif orientation == 7:
-                img = img.rotate(90, expand=True).transpose(Image.FLIP_LEFT_RIGHT)
-            elif orientation == 8:
-                img = img.rotate(90, expand=True)
-            else:
-                if orientation != 1:
-                    logger.warn("Orientation not defined {} for photo {}".format(orientation, photo.title))
-
-            if orientation in [5, 6, 7, 8]:
-                # invert width and height
-                h = photo.height
-                w = photo.width
-                photo.height = w
-                photo.width = h
-                metadata['Exif.Image.Orientation'].value = 1
-            img.save(photo.destfullpath, quality=99)
-        img.close()
-        metadata.write(preserve_timestamps=True)
+        # the lychee file: the source may be gone (move transfer)
+        with timed('rotation'):
+            orientation = get_sandbox(self.conf).run(imagework.rotate, photo.destfullpath, photo.url)
+        if orientation in imagework.SWAPPING_ORIENTATIONS:
+            # invert width and height
+            h = photo.height
+            w = photo.width
+            photo.height = w
+            photo.width = h
+
+
+def processImage(self, photo):
+    """
+    Rotation and thumbnails of a photo put in lychee, done in the image sandbox
+    A photo failing there (timeout, memory, pixels, corruption) is quarantined:
+    its lychee files are removed and ImageTaskError is raised
+    Returns nothing
+    """
+    try:
+        adjustRotation(self, photo)
+        makeThumbnail(self, photo)
+    except ImageTaskError as e:
+        get_quarantine(self.conf).add(photo.srcfullpath, e.reason)
+        deleteFiles(self, [photo.url])
+        raise
 
 
 def reorderalbumids(self, albums):
+    """
+    Renumber albums so that their ids follow their names
+    Albums created with planned ids are already sorted and left untouched
+    Returns True if albums have been renumbered
+    """
     # sort albums by title
     def getName(album):
         return album['name']
 
-    sortedalbums = sorted(albums, key=getName)
+    sortedalbums = [a for a in sorted(albums, key=getName) if a['id']]
+    ids = [a['id'] for a in sortedalbums]
+
+    # already sorted, nothing to do
+    if all(ids[i] < ids[i + 1] for i in range(len(ids) - 1)):
+        logger.debug("album ids already sorted")
+        return False
 
     # count albums
-    nbalbum = len(albums)
+    nbalbum = len(sortedalbums)
     # get higher album id + 1 as a first new album id
     min, max = self.dao.getAlbumMinMaxIds()
 
@@ -696,35 +587,32 @@ def reorderalbumids(self, albums):
         else:
             newid = max + 1
 
+        id_map = {}
         for a in sortedalbums:
-            self.dao.changeAlbumId(a['id'], newid)
+            id_map[a['id']] = newid
+            a['id'] = newid
             newid += 1
+        return self.dao.changeAlbumIds(id_map)
+    return False
 
 
-def updateAlbumsDate(self, albums):
-    now = datetime.datetime.now()
-    last2min = now - datetime.timedelta(minutes=2)
-    last2min_epoch = int((last2min - datetime.datetime(1970, 1, 1)).total_seconds())
-
-    for a in albums:
-        try:
-            # get photos with a real date (not just now)
-
-            if len(a['photos']) > 0:
-
-                datelist = [
-                    photo.epoch_sysdate for photo in a['photos'] if photo.epoch_sysdate < last2min_epoch]
+def updateAlbumsDate(self, album_ids):
+    """
+    Set the date of the given albums to the most recent takestamp of their photos
+    Photos without a real date (takestamp set to import time) are ignored
+    Parameters:
+    - album_ids: an iterable of album ids
+    Returns nothing
+    """
+    # get photos with a real date (not just now)
+    last2min_epoch = int(time.time()) - 120
 
-                if datelist is not None and len(datelist) > 0:
-                    newdate = max(datelist)
-                    self.dao.updateAlbumDate(a['id'], newdate)
-                    logger.debug(
-                        "album %s sysstamp changed to: %s ", a['name'], str(
-                            time.strftime(
-                                '%Y-%m-%d %H:%M:%S', time.localtime(newdate))))
-        except Exception as e:
-            logger.exception(e)
-            logger.error("updating album date for album:" + a['name'], e)
+    try:
+        updated = self.dao.updateAlbumsDate(album_ids, last2min_epoch)
+        logger.debug("%s albums sysstamp changed", updated)
+    except Exception as e:
+        logger.exception(e)
+        logger.error("updating album date for albums: %s", album_ids)
 
 
 def deleteAllFiles(self):
@@ -734,7 +622,7 @@ def deleteAllFiles(self):
     """
     photopath = os.path.join(self.conf["lycheepath"], "uploads", "big")
     filelist = [f for f in os.listdir(photopath)]
-    deleteFiles(filelist)
+    deleteFiles(self, filelist)
 
 
 def deletePhotos(self, photo_list):
@@ -744,13 +632,3 @@ def deletePhotos(self, photo_list):
         deleteFiles(self, url_list)
         for p in photo_list:
             self.dao.dropPhoto(p['id'])
-
-
-def remove_file(path):
-    try:
-        os.remove(path)
-    except Exception as e:
-        logger.warn("problem removing: " + path)
-        logger.debug(e)
-
-
@@ -0,0 +1,1024 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+from pathtools.patterns import match_path
+from watchdog.events import DirCreatedEvent
+from watchdog.events import DirDeletedEvent
+from watchdog.events import DirModifiedEvent
+from watchdog.events import DirMovedEvent
+from watchdog.events import FileCreatedEvent
+from watchdog.events import FileDeletedEvent
+from watchdog.events import FileModifiedEvent
+from watchdog.events import FileMovedEvent
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from lycheesync.lycheedao import LycheeDAO
+from lycheesync.lycheemodel import LycheePhoto
+from lycheesync.lycheesyncer import copyFileToLychee
+from lycheesync.lycheesyncer import deleteFiles
+from lycheesync.lycheesyncer import deletePhotos
+from lycheesync.lycheesyncer import processImage
+from lycheesync.utils.configuration import ConfBorg
+from lycheesync.utils.deletion import close_deletion_services
+from lycheesync.utils.eventjournal import EventJournal
+from lycheesync.utils import exporter
+from lycheesync.utils.fingerprints import FingerprintStore
+from lycheesync.utils import profiling
+from lycheesync.utils import querystats
+from lycheesync.utils.metrics import report
+from lycheesync.utils.pagecache import get_page_cache
+from lycheesync.utils.sandbox import close_sandboxes
+from lycheesync.utils.sandbox import get_quarantine
+from lycheesync.utils.throttle import get_throttle
+from lycheesync.utils.workerpool import PRIORITY_BULK
+from lycheesync.utils.workerpool import PRIORITY_INTERACTIVE
+from lycheesync.utils.workerpool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+PHOTO_PATTERNS = ['*.jpg', '*.jpeg', '*.gif', '*.png']
+
+
+def watch(conf):
+    """
+    Watch mode main loop
+    Forward filesystem events of the source directory to MyEventHandler until interrupted
+    Events are coalesced per path by an EventAggregator before being handled
+    Changes made while not watching are found by reconcile, from the fingerprints of the previous run
+    The observer is the native watchdog one (inotify...) or, with watchObserver: polling, a ScandirObserver
+    Returns nothing
+    """
+    aggregator = makeAggregator(conf)
+    store = aggregator.store
+
+    if conf.get('watchObserver', 'native') == 'polling':
+        snapshot = FingerprintStore(conf.get('watchPollSnapshot', os.path.join('logs', 'watchpoll.db')), conf['srcdir'])
+        # the snapshot of the previous run also finds the changes made while not watching
+        observer = ScandirObserver(snapshot, conf.get('watchPollInterval', 30), conf.get('watchPollCpu', 0.2))
+    else:
+        snapshot = None
+        observer = Observer()
+    observer.schedule(aggregator, conf['srcdir'], recursive=True)
+    observer.start()
+    if store and snapshot is None:
+        # started after the observer: nothing is missed in between
+        t = threading.Thread(target=reconcile, args=(store, conf['srcdir'], aggregator.dispatch), name='reconcile')
+        t.daemon = True
+        t.start()
+    try:
+        while True:
+            time.sleep(0.2)
+            aggregator.flush()
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+    closeAggregator(aggregator)
+    if snapshot:
+        snapshot.close()
+
+
+def makeAggregator(conf):
+    """
+    Build the event handling chain configured by conf: EventAggregator, its WorkerPool of MyEventHandler,
+    its EventJournal and FingerprintStore (each None when disabled)
+    Returns the EventAggregator
+    """
+    event_handler = MyEventHandler()
+    workers = conf.get('watchWorkers', 4)
+    throttle = get_throttle(conf)
+    if throttle:
+        workers = throttle.limitWorkers(workers)
+    pool = WorkerPool(workers, 'watch')
+    journal = None
+    if conf.get('watchJournal', os.path.join('logs', 'watchjournal.db')):
+        journal = EventJournal(conf.get('watchJournal', os.path.join('logs', 'watchjournal.db')))
+        if journal.depth:
+            logger.info("%s events left by the previous run will be handled", journal.depth)
+    aggregator = EventAggregator(event_handler, conf.get('watchQuietWindow', 2), conf.get('watchWriteTimeout', 600),
+                                 pool, conf['srcdir'], conf.get('watchInteractiveBatch', 10),
+                                 journal, conf.get('watchMaxPending', 100000))
+    if conf.get('watchState', os.path.join('logs', 'watchstate.db')):
+        store = FingerprintStore(conf.get('watchState', os.path.join('logs', 'watchstate.db')), conf['srcdir'])
+        aggregator.store = store
+        event_handler.store = store
+    exporter.serve(conf, aggregator)
+    return aggregator
+
+
+def closeAggregator(aggregator):
+    """ handle what has been received, then stop the workers and close the journal and the store """
+    aggregator.flush(force=True)
+    aggregator.pool.stop()
+    if aggregator.journal:
+        aggregator.journal.close()
+    if aggregator.store:
+        aggregator.store.close()
+    get_page_cache(aggregator.handler.conf).close()
+    close_deletion_services()
+    close_sandboxes()
+    get_quarantine(aggregator.handler.conf).report()
+    report(aggregator.handler.conf)
+    querystats.report(aggregator.handler.conf)
+    exporter.close(aggregator.handler.conf)
+
+
+def isWatched(path):
+    """ True if path is a photo handled by watch mode """
+    return match_path(path, included_patterns=PHOTO_PATTERNS, excluded_patterns=None, case_sensitive=False)
+
+
+def reconcile(store, root, emit, record=False, pace=None, baseline=None):
+    """
+    Find what changed in root since the fingerprints were recorded and emit the matching events
+    A directory with an unchanged mtime has the same entries: it is not listed, its files are only stat'ed
+    Without fingerprints (first run), records them and emits nothing
+    Parameters:
+    - store: a FingerprintStore
+    - emit: called with each watchdog event
+    - record: record the fingerprints when scanned instead of when handled (polling snapshot).
+      The files of a directory with an unchanged mtime are not stat'ed either: one stat per directory
+    - pace: called after each directory, the scan stops when it returns False
+    - baseline: only record the fingerprints, by default when there are none yet.
+      With False, everything is emitted as created on the first run
+    Returns the number of emitted events
+    """
+    start = time.time()
+    if baseline is None:
+        baseline = store.empty()
+    emitted = 0
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            continue
+        known_mtime, known_files, known_dirs = store.listing(directory)
+
+        if known_mtime is not None and known_mtime == mtime:
+            if record:
+                stack.extend(os.path.join(directory, name) for name in sorted(known_dirs, reverse=True))
+                if pace is not None and pace() is False:
+                    break
+                continue
+            entries = [(name, os.path.join(directory, name), None) for name in known_files]
+            dirs = known_dirs
+        else:
+            entries = []
+            dirs = []
+            try:
+                for entry in os.scandir(directory):
+                    # file type from the directory listing: no stat
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    elif isWatched(entry.path):
+                        entries.append((entry.name, entry.path, entry))
+            except OSError as e:
+                logger.warn("can't list %s: %s", directory, e)
+                continue
+
+        events = []
+        files = []
+        for name, path, entry in entries:
+            try:
+                st = entry.stat() if entry is not None else os.stat(path)
+            except OSError:
+                continue
+            files.append((path, st.st_size, st.st_mtime))
+            known = known_files.pop(name, None)
+            if known is None:
+                events.append(FileCreatedEvent(path))
+            elif known != (st.st_size, st.st_mtime):
+                events.append(FileModifiedEvent(path))
+        # not found anymore
+        gone = [os.path.join(directory, name) for name in known_files]
+        events.extend(FileDeletedEvent(path) for path in gone)
+        gone_dirs = [os.path.join(directory, name) for name in set(known_dirs) - set(dirs)]
+        events.extend(DirDeletedEvent(path) for path in gone_dirs)
+        for name in sorted(set(dirs) - set(known_dirs), reverse=True):
+            if not baseline:
+                # before its content, as the album is created first
+                emit(DirCreatedEvent(os.path.join(directory, name)))
+                emitted += 1
+        stack.extend(os.path.join(directory, name) for name in sorted(dirs, reverse=True))
+
+        if baseline or record:
+            for path in gone + gone_dirs:
+                store.remove(path)
+            store.update([(directory, mtime)], files)
+        elif events:
+            # fingerprints are recorded when the events are handled, the listing once they all are
+            store.invalidate(directory)
+        elif known_mtime != mtime:
+            store.update([(directory, mtime)])
+        if not baseline:
+            for event in events:
+                emit(event)
+            emitted += len(events)
+        if pace is not None and pace() is False:
+            break
+
+    if baseline:
+        logger.info("fingerprints of %s recorded in %.1fs", root, time.time() - start)
+    elif emitted or not record:
+        logger.info("%s changes found in %s in %.1fs", emitted, root, time.time() - start)
+    return emitted
+
+
+class ScandirObserver(threading.Thread):
+
+    """
+    A polling replacement for the watchdog Observer, for network file systems (NFS, SMB)
+    where inotify does not see the changes made by other clients
+    Scans with reconcile against a persistent snapshot (a FingerprintStore):
+    unchanged directories cost one stat, only changed ones are listed.
+    Files modified in place without changing their directory are not seen
+    A scan runs every interval seconds, using at most cpu_budget (0 to 1) of one cpu
+    """
+
+    def __init__(self, store, interval=30, cpu_budget=0.2):
+        threading.Thread.__init__(self, name='poller')
+        self.daemon = True
+        self.store = store
+        self.interval = interval
+        self.cpu_budget = min(max(cpu_budget, 0.01), 1)
+        self.stopped = threading.Event()
+        self.handler = None
+        self.path = None
+        self.resumed = 0
+        self.scans = 0
+
+    def schedule(self, event_handler, path, recursive=True):
+        self.handler = event_handler
+        self.path = path
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.resumed = time.time()
+            reconcile(self.store, self.path, self.handler.dispatch, record=True, pace=self._pace)
+            self.scans += 1
+            self.stopped.wait(self.interval)
+
+    def _pace(self):
+        """ sleep between directories to stay within the cpu budget """
+        busy = time.time() - self.resumed
+        if busy >= 0.05:
+            self.stopped.wait(busy * (1 - self.cpu_budget) / self.cpu_budget)
+            self.resumed = time.time()
+        return not self.stopped.is_set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class EventAggregator(FileSystemEventHandler):
+
+    """
+    Sits between watchdog and MyEventHandler
+    Collects events per path, collapses create/modify/delete/move sequences into one net action
+    and dispatches it once the path has been quiet for quiet_window seconds
+    Created or modified files are only dispatched once written: on close after write when the
+    observer reports it (inotify IN_CLOSE_WRITE), else when their size and mtime are stable.
+    Files still being written stay pending, at most write_timeout seconds
+    Events are received on the observer thread, flush is called from the watch loop
+    With a WorkerPool, events are handled by its workers, one lane per top level album of root
+    (an album is created before its photos, events of a path are serialized).
+    Small batches (at most interactive_batch events) overtake bulk ones
+    With an EventJournal, events are journaled as soon as they are received and removed once handled.
+    Events left in the journal by a previous run are handled first. Over max_pending pending paths,
+    events are only journaled and read back when the pending paths are handled (bounded memory)
+    """
+
+    def __init__(self, handler, quiet_window=2, write_timeout=600, pool=None, root=None, interactive_batch=10,
+                 journal=None, max_pending=100000):
+        self.handler = handler
+        self.quiet_window = quiet_window
+        self.write_timeout = write_timeout
+        self.pool = pool
+        self.root = root
+        self.interactive_batch = interactive_batch
+        self.journal = journal
+        self.max_pending = max_pending
+        # path -> {'action', 'src', 'is_directory', 'seq', 'first', 'last', 'writes', 'complete', 'stat', 'rows'}
+        self.pending = {}
+        # first journal row not loaded in pending yet, None if everything is loaded
+        self.backlog = None
+        if journal is not None and journal.depth:
+            self.backlog = 0
+        self.seq = 0
+        self.received = 0
+        # received events merged into a pending action or cancelled with it
+        self.coalesced = 0
+        self.dispatched = 0
+        # dispatched events whose handling raised
+        self.failed = 0
+        # number of pending files still being written
+        self.writing = 0
+        # set on the first close event: the observer reports write completion
+        self.close_events = False
+        # FingerprintStore updated with handled events
+        self.store = None
+        self.lock = threading.Lock()
+
+    def on_any_event(self, event):
+        if event.event_type not in ('created', 'modified', 'deleted', 'moved', 'closed'):
+            return
+        if event.is_directory and event.event_type == 'modified':
+            # directory content changes are reported by file events
+            return
+        with self.lock:
+            self.received += 1
+            if event.event_type == 'closed':
+                self._close(event.src_path)
+                return
+            dest_path = getattr(event, 'dest_path', None) or None
+            rows = []
+            if self.journal is not None:
+                row = self.journal.append(event.event_type, event.src_path, dest_path, event.is_directory)
+                rows.append(row)
+                if self.backlog is None and len(self.pending) >= self.max_pending:
+                    self.backlog = row
+                if self.backlog is not None:
+                    # read back later by _loadBacklog
+                    return
+            self._merge(event.event_type, event.src_path, dest_path, event.is_directory, rows)
+
+    def _merge(self, action, path, dest, is_directory, rows):
+        """ merge one event into the pending net actions """
+        self.seq += 1
+        before = len(self.pending)
+        if action == 'moved':
+            self._move(path, dest, is_directory, rows)
+        else:
+            self._add(path, action, is_directory, rows=rows)
+        # an event adding no pending action is coalesced, one removing an action cancels it as well
+        self.coalesced += 1 - (len(self.pending) - before)
+
+    def _loadBacklog(self):
+        """ move journaled events into pending while there is room. call with the lock held """
+        while self.backlog is not None and len(self.pending) < self.max_pending:
+            events = self.journal.read(self.backlog, self.max_pending - len(self.pending))
+            if not events:
+                self.backlog = None
+                break
+            for row, action, path, dest, is_directory in events:
+                if self.root and not path.startswith(self.root + os.sep):
+                    logger.warn("journaled event out of %s ignored: %s %s", self.root, action, path)
+                    self.journal.ack([row])
+                    continue
+                self._merge(action, path, dest, is_directory, [row])
+            self.backlog = events[-1][0] + 1
+
+    def _drop(self, entry):
+        """ a net action with nothing left to do """
+        if self.journal is not None:
+            self.journal.ack(entry['rows'])
+
+    def _close(self, path):
+        """ the writer closed the file: it can be handled without waiting """
+        self.close_events = True
+        entry = self.pending.get(path)
+        if entry is not None and entry['action'] in ('created', 'modified'):
+            entry['complete'] = True
+
+    def _add(self, path, action, is_directory, src=None, rows=()):
+        """ merge action into the pending net action of path """
+        now = time.time()
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = {'action': action, 'src': src, 'is_directory': is_directory,
+                                  'seq': self.seq, 'first': now, 'last': now,
+                                  'writes': 1 if action == 'modified' else 0,
+                                  'complete': False, 'stat': None, 'rows': list(rows)}
+            return
+
+        previous = entry['action']
+        entry['last'] = now
+        entry['is_directory'] = is_directory
+        entry['rows'].extend(rows)
+        if action == 'modified':
+            entry['writes'] += 1
+            entry['complete'] = False
+        if action == 'deleted':
+            if previous == 'created':
+                # never handled: nothing to do
+                del self.pending[path]
+                self._drop(entry)
+                if is_directory:
+                    self._dropContent(path)
+            elif previous == 'moved':
+                # net result: the source is gone
+                del self.pending[path]
+                self._add(entry['src'], 'deleted', is_directory, rows=entry['rows'])
+            else:
+                entry['action'] = 'deleted'
+        elif action == 'created':
+            if previous == 'deleted':
+                # replaced: re-import
+                entry['action'] = 'modified'
+        elif action == 'modified':
+            if previous == 'deleted':
+                entry['action'] = 'modified'
+            elif previous == 'moved' and not is_directory:
+                # moved then rewritten: drop the source and import the new content
+                entry['action'] = 'created'
+                self._add(entry['src'], 'deleted', is_directory)
+                entry['src'] = None
+
+    def _dropContent(self, directory):
+        """ drop the pending actions of the content of a directory cancelled before being handled """
+        prefix = directory + os.sep
+        for path in [p for p in self.pending if p.startswith(prefix)]:
+            entry = self.pending.pop(path)
+            self._drop(entry)
+            if entry['action'] == 'moved' and not entry['src'].startswith(prefix):
+                # moved in from outside: its source is gone
+                self._add(entry['src'], 'deleted', entry['is_directory'])
+
+    def _impliedByDirMove(self, src, dest):
+        """ True if moving src to dest is part of a pending directory move """
+        parent = os.path.dirname(dest)
+        while parent and parent != os.path.dirname(parent):
+            entry = self.pending.get(parent)
+            if entry and entry['action'] == 'moved' and entry['is_directory']:
+                return os.path.join(entry['src'], os.path.relpath(dest, parent)) == src
+            parent = os.path.dirname(parent)
+        return False
+
+    def _move(self, src, dest, is_directory, rows=()):
+        """ merge a move into the pending net actions of src and dest """
+        if self._impliedByDirMove(src, dest):
+            if self.journal is not None:
+                self.journal.ack(rows)
+            return
+        entry = self.pending.pop(src, None)
+        if is_directory:
+            # moves of the directory content are implied by the directory move
+            prefix = dest + os.sep
+            for path in [p for p, e in self.pending.items()
+                         if p.startswith(prefix) and e['action'] == 'moved' and e['src'] and
+                         e['src'].startswith(src + os.sep)]:
+                self._drop(self.pending.pop(path))
+
+        if entry is not None:
+            # the source events are handled with the move
+            rows = entry['rows'] + list(rows)
+        if entry is None:
+            self._add(dest, 'moved', is_directory, src, rows)
+        elif entry['action'] == 'created':
+            # never handled: handle it at its final place (temporary file renamed after upload)
+            self._add(dest, 'created', is_directory, rows=rows)
+            # renamed once written
+            self.pending[dest]['complete'] = True
+        elif entry['action'] == 'moved':
+            # moved twice: one move from the first source
+            self._add(dest, 'moved', is_directory, entry['src'], rows)
+        elif entry['action'] == 'deleted':
+            self._add(dest, 'moved', is_directory, src, rows)
+        else:
+            # modified then moved: the content has to be imported again
+            self._add(src, 'deleted', is_directory)
+            self._add(dest, 'created', is_directory, rows=rows)
+
+    def _blocked(self, path, ready):
+        """ a path waits for its not yet ready parent directory events (an album before its photos) """
+        parent = os.path.dirname(path)
+        while parent and parent != os.path.dirname(parent):
+            if parent in self.pending and parent not in ready:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    def _written(self, path, entry, now):
+        """ True if a created or modified file is completely written """
+        if entry['complete']:
+            return True
+        if now - entry['first'] >= self.write_timeout:
+            logger.warn("%s still being written after %s s, handled anyway", path, self.write_timeout)
+            return True
+        if self.close_events and entry['writes'] > 0:
+            # written but not closed yet
+            return False
+        # no close event for this file (moved in, or observer without close events): stable size and mtime
+        try:
+            st = os.stat(path)
+        except OSError:
+            # gone, the handler will cope with it
+            return True
+        stat = (st.st_size, st.st_mtime)
+        stable = entry['stat'] == stat
+        entry['stat'] = stat
+        return stable
+
+    def _ready(self, path, entry, now):
+        """ True if the net action of path can be dispatched """
+        if entry['is_directory'] or entry['action'] not in ('created', 'modified'):
+            return now - entry['last'] >= self.quiet_window
+        if entry['complete']:
+            return True
+        if now - entry['last'] < self.quiet_window:
+            return False
+        return self._written(path, entry, now)
+
+    def flush(self, force=False):
+        """
+        Dispatch the net action of every ready path to the handler, in order of arrival
+        Parameters:
+        - force: dispatch every pending action without waiting for the quiet window or write completion
+        Returns the number of dispatched events
+        """
+        now = time.time()
+        with self.lock:
+            self._loadBacklog()
+            ready = set(p for p, e in self.pending.items() if force or self._ready(p, e, now))
+            ready = [p for p in ready if not self._blocked(p, ready)]
+            entries = sorted([(self.pending.pop(p), p) for p in ready], key=lambda x: x[0]['seq'])
+            # quiet files not dispatched are still being written
+            self.writing = len([e for e in self.pending.values()
+                                if not e['is_directory'] and e['action'] in ('created', 'modified') and
+                                now - e['last'] >= self.quiet_window])
+
+        priority = PRIORITY_BULK
+        if len(entries) <= self.interactive_batch:
+            priority = PRIORITY_INTERACTIVE
+        for entry, path in entries:
+            event = makeEvent(entry['action'], path, entry['is_directory'], entry['src'])
+            if self.pool is None:
+                self._handle(event, entry['rows'])
+            else:
+                keys = set([self._lane(path)])
+                if entry['src']:
+                    keys.add(self._lane(entry['src']))
+                self.pool.submit(self._handle, (event, entry['rows']), keys, priority)
+        self.dispatched += len(entries)
+        if entries:
+            logger.debug("%s events dispatched, %s received so far, %s coalesced, %s journaled",
+                         len(entries), self.received, self.received - self.dispatched,
+                         self.journal.depth if self.journal else 0)
+        return len(entries)
+
+    def _lane(self, path):
+        """ the top level album directory of path """
+        if self.root is None:
+            return None
+        return os.path.relpath(path, self.root).split(os.sep)[0]
+
+    def _handle(self, event, rows=()):
+        try:
+            with profiling.thread():
+                self.handler.dispatch(event)
+            if self.store is not None:
+                self._remember(event)
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            logger.exception(e)
+            logger.error("while handling %s event for: %s", event.event_type, event.src_path)
+        # handled, even if it failed: it would fail again
+        if self.journal is not None:
+            self.journal.ack(rows)
+
+    def _remember(self, event):
+        """ record the fingerprints of a handled event, failed ones are found again by the next reconcile """
+        if not event.is_directory and not isWatched(event.src_path) and not (
+                event.event_type == 'moved' and isWatched(event.dest_path)):
+            return
+        if event.event_type == 'moved':
+            self.store.move(event.src_path, event.dest_path)
+            self.store.invalidate(os.path.dirname(event.src_path))
+            self.store.invalidate(os.path.dirname(event.dest_path))
+        elif event.event_type == 'deleted':
+            self.store.remove(event.src_path)
+            self.store.invalidate(os.path.dirname(event.src_path))
+        elif event.is_directory:
+            if event.event_type == 'created':
+                # its content is fingerprinted by its own events
+                self.store.update([(event.src_path, None)])
+                self.store.invalidate(os.path.dirname(event.src_path))
+        else:
+            try:
+                st = os.stat(event.src_path)
+            except OSError:
+                # gone since: its deletion is pending
+                return
+            self.store.update(files=[(event.src_path, st.st_size, st.st_mtime)])
+            if event.event_type == 'created':
+                self.store.invalidate(os.path.dirname(event.src_path))
+
+
+def makeEvent(action, path, is_directory, src=None):
+    """
+    Build the watchdog event matching a net action
+    Returns a watchdog FileSystemEvent
+    """
+    if action == 'moved':
+        if is_directory:
+            return DirMovedEvent(src, path)
+        return FileMovedEvent(src, path)
+    classes = {
+        'created': (FileCreatedEvent, DirCreatedEvent),
+        'modified': (FileModifiedEvent, DirModifiedEvent),
+        'deleted': (FileDeletedEvent, DirDeletedEvent)}
+    return classes[action][1 if is_directory else 0](path)
+
+
+class AlbumResolver:
+
+    """
+    Cached album lookup for the directories of root, replaces getAlbum in watch mode
+    A trie of the directories relative to root, each node holds the album id of its directory
+    (None if it has no album). Filled on demand, one query per directory not cached yet.
+    Album creation, move or deletion must be followed by invalidate
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # name -> [album id, children]
+        self.trie = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _parts(self, directory):
+        rel = os.path.relpath(directory, self.root)
+        if rel == os.curdir:
+            return []
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            return None
+        return rel.split(os.sep)
+
+    def resolve(self, dao, directory):
+        """
+        Same result as getAlbum for a directory of root, except directories above root are not albums
+        Returns an album dict: id (None if the album does not exist), name, parent
+        (id of the nearest existing album, the album itself included, '0' if none)
+        """
+        parts = self._parts(directory)
+        if parts is None:
+            logger.warn("%s is not in %s: no album", directory, self.root)
+            parts = []
+        album = {'id': None, 'name': parts[-1] if parts else os.path.basename(directory), 'parent': '0'}
+        parent = '0'
+        children = self.trie
+        for name in parts:
+            with self.lock:
+                node = children.get(name)
+                if node is not None:
+                    self.hits += 1
+            if node is None:
+                # out of the lock: other lanes keep resolving meanwhile
+                row = dao.get_album_id(name, parent)
+                with self.lock:
+                    node = children.setdefault(name, [row['id'] if row else None, {}])
+                    self.misses += 1
+            album['id'] = node[0]
+            if node[0] is not None:
+                parent = node[0]
+            children = node[1]
+        album['parent'] = parent
+        return album
+
+    def invalidate(self, directory):
+        """ forget the album of directory and its sub directories """
+        parts = self._parts(directory)
+        with self.lock:
+            if not parts:
+                self.trie = {}
+                return
+            children = self.trie
+            for name in parts[:-1]:
+                node = children.get(name)
+                if node is None:
+                    return
+                children = node[1]
+            children.pop(parts[-1], None)
+
+
+class PhotoTitles:
+
+    """
+    Cached photo titles of the albums, the known photos of a daemon: replaces a title query per photo
+    Filled on demand, one query per album not cached yet. Only a cached title is trusted:
+    the titles of an album are forgotten when its photos are deleted or moved (forget),
+    all of them at the start of each sync (clear), photos deleted from Lychee meanwhile included
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # album id -> set of titles
+        self.albums = {}
+        # bumped by forget and clear: a query started before is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, dao, album_id, title):
+        """ True if the album has a photo with this title """
+        with self.lock:
+            titles = self.albums.get(album_id)
+            generation = self.generation
+            if titles is not None:
+                self.hits += 1
+                return title in titles
+            self.misses += 1
+        # out of the lock: other lanes keep importing meanwhile
+        rows = dao.getPhotoTitles(album_id)
+        if rows is None:
+            return False
+        titles = set(rows)
+        with self.lock:
+            if generation == self.generation:
+                titles = self.albums.setdefault(album_id, titles)
+        return title in titles
+
+    def add(self, album_id, title):
+        """ a photo has been imported """
+        with self.lock:
+            titles = self.albums.get(album_id)
+            if titles is not None:
+                titles.add(title)
+
+    def forget(self, *album_ids):
+        """ the photos of these albums have been deleted or moved """
+        with self.lock:
+            for album_id in album_ids:
+                self.albums.pop(album_id, None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.albums = {}
+            self.generation += 1
+
+
+class MyEventHandler(FileSystemEventHandler):
+
+    """
+    Applies filesystem events to Lychee
+    Methods may be called from several worker threads: each thread has its own db connection
+    """
+
+    def __init__(self):
+        borg = ConfBorg()
+        self.conf = borg.conf
+        self.local = threading.local()
+        self.albums = AlbumResolver(self.conf['srcdir'])
+        # FingerprintStore, checksums of imported photos
+        self.store = None
+        # PhotoTitles in daemon mode: already imported photos are skipped without being read
+        self.titles = None
+
+    @property
+    def dao(self):
+        """ the db connection of the current thread, reused between events """
+        dao = getattr(self.local, 'dao', None)
+        if dao is None:
+            dao = LycheeDAO(self.conf)
+            self.local.dao = dao
+        return dao
+
+    def dispatch(self, event):
+        # reconnect if the connection has been closed while idle
+        self.dao.db.ping(True)
+        try:
+            FileSystemEventHandler.dispatch(self, event)
+        finally:
+            # the next event of this thread is not counted against this photo
+            querystats.leave(self.conf, 'photo')
+
+    def catch_all_handler(self, event):
+        return
+
+    def on_moved(self, event):
+        """
+        Moves only update the db: photos are matched by the checksum recorded when imported (or their title),
+        sub albums and photos follow their album
+        What can't be found in the db is imported at its new place
+        """
+
+        if event.is_directory:
+
+            albSrc = self.albums.resolve(self.dao, event.src_path)
+            parent = self.albums.resolve(self.dao, os.path.dirname(event.dest_path))['id'] or '0'
+            albDest = self.albums.resolve(self.dao, event.dest_path)
+            logger.info("%s Album moved to %s. ", event.src_path, event.dest_path)
+            if albSrc['id'] is None:
+                logger.warn("album of %s not found, %s imported as new", event.src_path, event.dest_path)
+                self.importTree(event.dest_path)
+            elif albDest['id'] is not None and albDest['id'] != albSrc['id']:
+                # an album already exists for the destination
+                self.dao.mergeAlbum(albSrc['id'], albDest['id'])
+                self.forgetTitles(albSrc['id'], albDest['id'])
+            else:
+                self.dao.setAlbumParentAndTitle(albDest['name'], parent, albSrc['id'])
+            self.albums.invalidate(event.src_path)
+            self.albums.invalidate(event.dest_path)
+            return
+        else:
+            if isWatched(event.src_path):
+                dirs = event.src_path.split(os.sep)
+                albDir = os.sep.join(dirs[:-1])
+                dirs2 = event.dest_path.split(os.sep)
+                albDir2 = os.sep.join(dirs2[:-1])
+                album = self.albums.resolve(self.dao, albDir)
+                if album['id'] == None:
+                    album = self.albums.resolve(self.dao, albDir2)
+
+                checksum = self.store.checksum(event.src_path) if self.store is not None else None
+                dbPhoto = self.dao.get_photo_light(album['id'], os.sep.join(dirs[-1:]), checksum or "")
+
+                album2 = self.albums.resolve(self.dao, albDir2)
+                if dbPhoto is None:
+                    logger.warn("photo %s not found, %s imported as new", event.src_path, event.dest_path)
+                    self.on_created(FileCreatedEvent(event.dest_path))
+                    return
+                logger.info("%s Photo moved to %s. ", event.src_path, event.dest_path)
+                self.dao.setPhotoAlbumAndTitle(os.sep.join(dirs2[-1:]), album2['id'], dbPhoto['id'])
+                self.forgetTitles(dbPhoto['album'], album2['id'])
+            elif isWatched(event.dest_path):
+                # renamed to a photo name (end of an upload)
+                self.on_created(FileCreatedEvent(event.dest_path))
+
+            return
+
+    def forgetTitles(self, *album_ids):
+        """ PhotoTitles.forget, in daemon mode """
+        if self.titles is not None:
+            self.titles.forget(*album_ids)
+
+    def rememberChecksum(self, path, photo):
+        """ record the checksum of an imported photo: it matches the photo when it is moved """
+        if self.store is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            # already moved or deleted again, its events are pending
+            return
+        self.store.setChecksum(path, st.st_size, st.st_mtime, photo.checksum)
+
+    def importTree(self, directory):
+        """ import a directory and its content as new """
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            self.on_created(DirCreatedEvent(root))
+            for f in sorted(files):
+                self.on_created(FileCreatedEvent(os.path.join(root, f)))
+
+    def on_created(self, event):
+
+
+        if event.is_directory:
+            album = self.albums.resolve(self.dao, event.src_path)
+            if album['id'] is not None:
+                logger.info("Album already exists: %s.", album['name'])
+                return
+            logger.info("Created album: %s.", album['name'])
+            self.dao.createAlbum(album)
+            self.albums.invalidate(event.src_path)
+            return
+
+        else:
+            if isWatched(event.src_path):
+                dirs = event.src_path.split(os.sep)
+                albDir = os.sep.join(dirs[:-1])
+                album = self.albums.resolve(self.dao, albDir)
+                album['path'] = albDir
+                querystats.enter(self.conf, 'photo', event.src_path)
+                if (self.titles is not None and album['id'] is not None and
+                        self.titles.contains(self.dao, album['id'], dirs[-1])):
+                    # already imported (a daemon first sync emits the whole library): not even read
+                    logger.debug("photo already exists in this album with same name: %s", event.src_path)
+                    return
+                if get_quarantine(self.conf).contains(event.src_path):
+                    logger.warn("quarantined, skipped until modified: %s", event.src_path)
+                    return
+                throttle = get_throttle(self.conf)
+                if throttle:
+                    throttle.before(event.src_path)
+                photo = None
+                try:
+                    photo = LycheePhoto(self.conf, os.sep.join(dirs[-1:]), album, stage=True)
+                    if not (self.dao.photoExists(photo)):
+                        res = copyFileToLychee(self, photo)
+
+                        processImage(self, photo)
+                        res = self.dao.addFileToAlbum(photo.record())
+                        exporter.imported(self.conf, res)
+                        logger.info("Created Photo: %s.", photo.srcfullpath)
+                        get_page_cache(self.conf).done(photo.srcfullpath, photo.destfullpath if res else None)
+                        if res:
+                            self.rememberChecksum(event.src_path, photo)
+                            if self.titles is not None:
+                                self.titles.add(album['id'], photo.originalname)
+                        # increment counter
+                        if not res:
+                            logger.error(
+                                "while adding to album: %s photo: %s",
+                                album['name'],
+                                photo.srcfullpath)
+                    else:
+                        photo.discardStaged()
+                        get_page_cache(self.conf).done(photo.srcfullpath)
+                        logger.error("photo already exists in this album with same name or same checksum: %s "
+                                     "it won't be added to lychee", photo.srcfullpath)
+                except Exception:
+                    # reported here: the aggregator only logs it
+                    if photo is not None:
+                        photo.discardStaged()
+                    exporter.imported(self.conf, False)
+                    raise
+            return
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            album = self.albums.resolve(self.dao, event.src_path)
+            if album['id'] is not None:
+                filelist = self.dao.eraseAlbum(album['id'])
+                deleteFiles(self, filelist)
+                self.forgetTitles(album['id'])
+                logger.info("Deleted album: %s.", album['name'])
+                assert self.dao.dropAlbum(album['id'])
+                self.albums.invalidate(event.src_path)
+            else:
+                logger.error("Tried to delete album: %s, but it wasn't present in the DB", album['name'])
+
+            return
+        else:
+            if isWatched(event.src_path):
+                dirs = event.src_path.split(os.sep)
+                albDir = os.sep.join(dirs[:-1])
+                album = self.albums.resolve(self.dao, albDir)
+                album['path'] = albDir
+                dbPhoto = self.dao.get_photo_light(album['id'], os.sep.join(dirs[-1:]), "")
+                if dbPhoto is not None:
+                    delete = [dbPhoto]
+                    deletePhotos(self, delete)
+                    self.forgetTitles(album['id'])
+                    logger.info("Deleted Photo: %s.", os.sep.join(dirs[-1:]))
+                else:
+                    logger.info("Tried to delete Photo: %s, but it wasn't in the database.", os.sep.join(dirs[-1:]))
+            return
+
+    def on_modified(self, event):
+        if event.is_directory:
+            return
+        else:
+            if isWatched(event.src_path):
+                dirs = event.src_path.split(os.sep)
+                albDir = os.sep.join(dirs[:-1])
+                album = self.albums.resolve(self.dao, albDir)
+                album['path'] = albDir
+                # the new content is read once: for the lookup, the checksum and the copy
+                querystats.enter(self.conf, 'photo', event.src_path)
+                if get_quarantine(self.conf).contains(event.src_path):
+                    logger.warn("quarantined, skipped until modified: %s", event.src_path)
+                    return
+                throttle = get_throttle(self.conf)
+                if throttle:
+                    throttle.before(event.src_path)
+                photo = None
+                try:
+                    photo = LycheePhoto(self.conf, os.sep.join(dirs[-1:]), album, stage=True)
+                    dbPhoto = self.dao.get_photo(photo)
+                    if dbPhoto is not None:
+                        delete = [dbPhoto]
+                        deletePhotos(self, delete)
+                        self.forgetTitles(album['id'])
+
+                    if not (self.dao.photoExists(photo)):
+                        res = copyFileToLychee(self, photo)
+
+                        processImage(self, photo)
+                        res = self.dao.addFileToAlbum(photo.record())
+                        exporter.imported(self.conf, res)
+                        logger.info("Modified Photo: %s.", photo.srcfullpath)
+                        if res:
+                            self.rememberChecksum(event.src_path, photo)
+                        get_page_cache(self.conf).done(photo.srcfullpath, photo.destfullpath if res else None)
+                        # increment counter
+                        if not res:
+                            logger.error(
+                                "while adding to album: %s photo: %s",
+                                album['name'],
+                                photo.srcfullpath)
+                    else:
+                        photo.discardStaged()
+                        get_page_cache(self.conf).done(photo.srcfullpath)
+                        logger.error("photo already exists in this album with same name or same checksum: %s "
+                                     "it won't be added to lychee", photo.srcfullpath)
+                except Exception:
+                    # reported here: the aggregator only logs it
+                    if photo is not None:
+                        photo.discardStaged()
+                    exporter.imported(self.conf, False)
+                    raise
+            return
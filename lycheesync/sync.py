@@ -3,8 +3,6 @@
 
 from __future__ import print_function
 # from __future__ import unicode_literals
-from lycheesync.lycheesyncer import LycheeSyncer
-from lycheesync.update_scripts import inf_to_lychee_2_6_2
 import logging.config
 import click
 import os
@@ -20,6 +18,8 @@ logger = logging.getLogger(__name__)
 @click.command()
 @click.option('-w', '--watch', 'exclusive_mode', flag_value='watch', default=True,
               help='Watch mode exclusive with only watching for filesystem events')
+@click.option('-D', '--daemon', 'exclusive_mode', flag_value='daemon', default=False,
+              help='Daemon mode exclusive with watch mode, incremental syncs on a schedule or on demand')
 @click.option('-v', '--verbose', is_flag=True, help='Program verbosity.')
 @click.option('-n', '--normal', 'exclusive_mode', flag_value='normal',
               default=False, help='normal mode exclusive with replace and delete mode')
@@ -30,6 +30,15 @@ logger = logging.getLogger(__name__)
 @click.option('-s', '--sort_album_by_name', is_flag=True, help='Sort album by name')
 @click.option('-c', '--sanitycheck', is_flag=True, help='Sort album by name')
 @click.option('-l', '--link', is_flag=True, help="Don't copy files create link instead")
+@click.option('-t', '--transfer', type=click.Choice(['auto', 'copy', 'reflink', 'hardlink', 'symlink', 'move']),
+              default=None, help="How photos are put in lychee (default copy, symlink with -l), auto picks the "
+                                 "fastest safe one")
+@click.option('-T', '--throttle', is_flag=True,
+              help="Throttle mode: limited read rate, photo rate and workers, low cpu and io priority")
+@click.option('--db-stats', 'db_stats', is_flag=True,
+              help="Count database statements, print the top ones by total time and flag N+1 query patterns")
+@click.option('--profile', type=click.Choice(['cprofile', 'sampling']), default=None,
+              help="Profile the run, profile file written in the logs directory")
 @click.option('-u26', '--updatedb26', is_flag=True,
               help="Update lycheesync added data in lychee db to the lychee 2.6.2 required values")
 @click.argument('imagedirpath', metavar='PHOTO_DIRECTORY_ROOT',
@@ -40,8 +49,8 @@ logger = logging.getLogger(__name__)
                 type=click.Path(exists=True, resolve_path=True))
 # checks file existence and attributes
 # @click.argument('file2', type=click.Path(exists=True, file_okay=True, dir_okay=False, writable=False, readable=True, resolve_path=True))
-def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updatedb26, imagedirpath, lycheepath,
-         confpath):
+def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, transfer, throttle, db_stats, profile,
+         updatedb26, imagedirpath, lycheepath, confpath):
     """Lycheesync
 
     A script to synchronize any directory containing photos with Lychee.
@@ -54,7 +63,7 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
         confpath = confpath.decode('UTF-8')
 
     conf_data = {'verbose': verbose, "srcdir": imagedirpath, "lycheepath": lycheepath, 'confpath': confpath,
-                 "dropdb": False, "replace": False, "normal": False, "watch": True}
+                 "dropdb": False, "replace": False, "normal": False, "watch": True, "daemon": False}
 
     if exclusive_mode == "delete":
         conf_data["dropdb"] = True
@@ -65,6 +74,9 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
     elif exclusive_mode == "normal":
         conf_data["normal"] = True
         conf_data["watch"] = False
+    elif exclusive_mode == "daemon":
+        conf_data["daemon"] = True
+        conf_data["watch"] = False
 
     conf_data["user"] = None
     conf_data["group"] = None
@@ -77,6 +89,18 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
         logger.info("!!!!!!!!!!!!!!!! SANITY OFF")
     conf_data["sanity"] = sanitycheck
     conf_data["link"] = link
+    if transfer:
+        conf_data["transfer"] = transfer
+    elif link:
+        conf_data["transfer"] = "symlink"
+    if transfer == "move" and (conf_data["watch"] or conf_data["daemon"]):
+        # the source deletion would be handled as a photo deletion
+        raise click.BadParameter("move can't be used in watch or daemon mode", param_hint="--transfer")
+    if throttle:
+        # else the configuration file may enable it
+        conf_data["throttle"] = True
+    if db_stats:
+        conf_data["dbStats"] = True
     # if conf_data["dropdb"]:
     #    conf_data["sort"] = True
 
@@ -98,14 +122,26 @@ def main(verbose, exclusive_mode, sort_album_by_name, sanitycheck, link, updated
 
     # DB update
     if updatedb26:
+        from lycheesync.update_scripts import inf_to_lychee_2_6_2
         inf_to_lychee_2_6_2.updatedb(conf_data)
 
     logger.info("=================== start adding to lychee ==================")
     try:
 
         # DELEGATE WORK TO LYCHEESYNCER
+        # imported here: keep cli startup fast, heavy dependencies are loaded on demand
+        from lycheesync.lycheesyncer import LycheeSyncer
         s = LycheeSyncer()
-        s.sync()
+        if profile:
+            from lycheesync.utils import profiling
+            from lycheesync.utils.boilerplatecode import log_directory
+            profiling.start(profile, log_directory())
+            try:
+                s.sync()
+            finally:
+                profiling.stop()
+        else:
+            s.sync()
 
     except Exception:
         logger.exception('Failed to run batch')
@@ -21,6 +21,17 @@ def init_loggers(logconf, verbose=False):
                 h.setLevel(logging.DEBUG)
 
 
+def log_directory():
+    """
+    Directory of the log file (logs/lycheesync.log with the default logging configuration)
+    Returns a path, logs when there is no log file
+    """
+    for handler in logging.getLogger().handlers + logging.getLogger('lycheesync').handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.dirname(handler.baseFilename)
+    return 'logs'
+
+
 def script_init(cli_args):
     """
     - will initialize a ConfBorg object containing cli arguments, configutation file elements
@@ -39,6 +50,8 @@ def script_init(cli_args):
 
     # append path to configuration
     cli_args['full_path'] = full_path
+    # keep their priority when the configuration file is reloaded
+    cli_args['cli_keys'] = sorted(cli_args.keys()) + ['cli_keys']
 
     # read log configuration
     if os.path.exists(log_conf_path):
@@ -68,3 +81,23 @@ def script_init(cli_args):
     borg = ConfBorg(z)
     logger.debug("**** loaded configuration: ")
     logger.debug("**** " + borg.pretty)
+
+
+def reload_conf(fixed=()):
+    """
+    Read the configuration file again and apply its changes to the ConfBorg configuration
+    cli args keep their priority
+    Parameters:
+    - fixed: keys, or key prefixes, only read at startup: they keep their running value
+    Returns the list of changed keys and the list of fixed keys whose change is ignored
+    """
+    conf = ConfBorg().conf
+    with open(conf['confpath'], 'rt') as f:
+        fresh = json.load(f)
+    cli_keys = conf.get('cli_keys', [])
+    changed = sorted(k for k, v in fresh.items() if k not in cli_keys and conf.get(k) != v)
+    ignored = [k for k in changed if k.startswith(tuple(fixed))]
+    changed = [k for k in changed if k not in ignored]
+    for k in changed:
+        conf[k] = fresh[k]
+    return changed, ignored
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+
+from lycheesync.utils.throttle import get_throttle
+from lycheesync.utils.workerpool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# files per unlink task
+CHUNK = 256
+
+
+def photoFiles(lycheepath, url):
+    """
+    Lychee files of a photo: big file, thumbnail and @2x thumbnail
+    Returns a list of paths
+    """
+    filesplit = os.path.splitext(url)
+    thumb2 = ''.join([filesplit[0], "@2x", filesplit[1]]).lower()
+    return [os.path.join(lycheepath, "uploads", "big", url),
+            os.path.join(lycheepath, "uploads", "thumb", url),
+            os.path.join(lycheepath, "uploads", "thumb", thumb2)]
+
+
+class DeletionService:
+
+    """
+    Deletes lychee photo files in batches, in parallel
+    - direct mode: files are unlinked by the workers, delete returns once they are gone
+    - trash mode: files are renamed into uploads/.trash by the workers (a rename is cheap),
+      the trash is purged in the background. Leftovers of a previous run are purged at start
+    Per file failures are counted, not logged one by one: see counts and close
+    """
+
+    def __init__(self, lycheepath, workers=8, trash=False):
+        self.lycheepath = lycheepath
+        self.pool = WorkerPool(workers, 'delete')
+        self.lock = threading.Lock()
+        self.counts = {'removed': 0, 'missing': 0, 'failed': 0, 'purged': 0}
+        self.batches = 0
+        self.trash = os.path.join(lycheepath, "uploads", ".trash") if trash else None
+        self.purger = None
+        if self.trash:
+            self.purger = WorkerPool(1, 'purge')
+            if os.path.isdir(self.trash):
+                for batch in os.listdir(self.trash):
+                    self.purger.submit(self._purge, (os.path.join(self.trash, batch), ))
+
+    def delete(self, urls):
+        """
+        Delete the lychee files of photos
+        Parameters:
+        - urls: photo file names in uploads/big, duplicates are deleted once
+        Returns a dict of counts: removed, missing, failed
+        """
+        paths = []
+        seen = set()
+        for url in urls:
+            for path in photoFiles(self.lycheepath, url):
+                if path not in seen:
+                    seen.add(path)
+                    paths.append(path)
+        counts = {'removed': 0, 'missing': 0, 'failed': 0}
+        if not paths:
+            return counts
+        batch = None
+        if self.trash:
+            with self.lock:
+                self.batches += 1
+                batch = os.path.join(self.trash, "{}-{}-{}".format(int(time.time()), os.getpid(), self.batches))
+            for sub in ("big", "thumb"):
+                os.makedirs(os.path.join(batch, sub))
+        chunks = [paths[i:i + CHUNK] for i in range(0, len(paths), CHUNK)]
+        cond = threading.Condition()
+        left = [len(chunks)]
+        errors = []
+
+        def run(chunk):
+            result = {'removed': 0, 'missing': 0, 'failed': 0}
+            done = 0
+            try:
+                for path in chunk:
+                    try:
+                        if batch:
+                            os.rename(path, os.path.join(batch, os.path.basename(os.path.dirname(path)),
+                                                         os.path.basename(path)))
+                        else:
+                            os.remove(path)
+                        result['removed'] += 1
+                    except OSError as e:
+                        if e.errno == errno.ENOENT:
+                            result['missing'] += 1
+                        else:
+                            result['failed'] += 1
+                            logger.debug("problem removing %s: %s", path, e)
+                            if not errors:
+                                errors.append(e)
+                    done += 1
+            except Exception as e:
+                logger.exception(e)
+                if not errors:
+                    errors.append(e)
+            finally:
+                # the rest of the chunk is not deleted, the caller is waiting for it anyway
+                result['failed'] += len(chunk) - done
+                with cond:
+                    for k, v in result.items():
+                        counts[k] += v
+                    left[0] -= 1
+                    cond.notify_all()
+
+        for i, chunk in enumerate(chunks):
+            self.pool.submit(run, (chunk, ), keys=(i, ))
+        with cond:
+            while left[0]:
+                cond.wait()
+        with self.lock:
+            for k, v in counts.items():
+                self.counts[k] += v
+        if counts['failed']:
+            logger.warn("%s of %s photo files could not be deleted, first error: %s", counts['failed'], len(paths),
+                        errors[0])
+        logger.debug("deleted %s photos: %s", len(urls), counts)
+        if batch:
+            self.purger.submit(self._purge, (batch, ))
+        return counts
+
+    def _purge(self, batch):
+        removed = sum(len(files) for _, _, files in os.walk(batch))
+        shutil.rmtree(batch, ignore_errors=True)
+        with self.lock:
+            self.counts['purged'] += removed
+
+    def close(self, wait=True):
+        """
+        Stop the workers, after the trash purge if wait (else it goes on at the next start)
+        Logs the deletion counts
+        """
+        self.pool.stop()
+        if self.purger and wait:
+            self.purger.stop()
+        if any(self.counts.values()):
+            logger.info("photo files deleted: %(removed)s, already missing: %(missing)s, failed: %(failed)s, "
+                        "purged from trash: %(purged)s", self.counts)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_deletion_service(conf):
+    """
+    The DeletionService of the conf, one per process:
+    deleteWorkers (default 8, limited by throttleWorkers in throttle mode), deleteTrash (default False)
+    Returns a DeletionService
+    """
+    workers = conf.get('deleteWorkers', 8)
+    throttle = get_throttle(conf)
+    if throttle:
+        workers = throttle.limitWorkers(workers)
+    key = (conf['lycheepath'], workers, conf.get('deleteTrash', False))
+    with _services_lock:
+        if key not in _services:
+            _services[key] = DeletionService(*key)
+        return _services[key]
+
+
+def close_deletion_services(wait=True):
+    """ close the services created by get_deletion_service """
+    with _services_lock:
+        services = list(_services.values())
+        _services.clear()
+    for service in services:
+        service.close(wait)
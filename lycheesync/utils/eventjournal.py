@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# sqlite default limit of host parameters is 999
+ACK_CHUNK = 500
+
+
+class EventJournal:
+
+    """
+    An append-only journal of file system events, in a local sqlite database (WAL mode)
+    Events are appended when received and acked once handled:
+    the events left in the journal after a crash are the ones to handle again
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.lock = threading.Lock()
+        # autocommit: every append is durable once it returns
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("pragma journal_mode=wal")
+        # with WAL, survives a process crash, only an os crash may lose the last events
+        self.db.execute("pragma synchronous=normal")
+        self.db.execute("create table if not exists events (id integer primary key autoincrement, "
+                        "event_type text not null, src_path text not null, dest_path text, "
+                        "is_directory integer not null)")
+        # number of events not acked yet
+        self.depth = self.db.execute("select count(*) from events").fetchone()[0]
+
+    def append(self, event_type, src_path, dest_path=None, is_directory=False):
+        """
+        Journal one event
+        Returns the event row id, to ack it later
+        """
+        with self.lock:
+            cur = self.db.execute("insert into events (event_type, src_path, dest_path, is_directory) "
+                                  "values (?, ?, ?, ?)", (event_type, src_path, dest_path, int(is_directory)))
+            self.depth += 1
+            return cur.lastrowid
+
+    def ack(self, rows):
+        """
+        Remove handled events from the journal
+        Parameters:
+        - rows: row ids returned by append or read
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        with self.lock:
+            self.db.execute("begin")
+            try:
+                for i in range(0, len(rows), ACK_CHUNK):
+                    chunk = rows[i:i + ACK_CHUNK]
+                    cur = self.db.execute("delete from events where id in ({})".format(
+                        ",".join("?" * len(chunk))), chunk)
+                    self.depth -= cur.rowcount
+                self.db.execute("commit")
+            except Exception:
+                self.db.execute("rollback")
+                raise
+
+    def read(self, from_id=0, limit=1000):
+        """
+        Read journaled events in order
+        Returns a list of (row id, event_type, src_path, dest_path, is_directory) with row id >= from_id
+        """
+        with self.lock:
+            cur = self.db.execute("select id, event_type, src_path, dest_path, is_directory from events "
+                                  "where id >= ? order by id limit ?", (from_id, limit))
+            return [(r[0], r[1], r[2], r[3], bool(r[4])) for r in cur.fetchall()]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_exif_date(value):
+    """
+    Fast path for the fixed exif date format: YYYY-MM-DD HH:MM:SS or YYYY:MM:DD HH:MM:SS
+    Takes a string as input
+    Returns a datetime or None if value is not in this exact format
+    """
+    if len(value) != 19 or value[10] != ' ' or value[13] != ':' or value[16] != ':':
+        return None
+    sep = value[4]
+    if (sep != '-' and sep != ':') or value[7] != sep:
+        return None
+    try:
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        # out of range values or non digits
+        return None
+
+
+def parse_date(value):
+    """
+    Parse a date string, exif format first, dateutil as a fallback for odd values
+    Takes a string as input
+    Returns a datetime, raises ValueError if value can't be parsed
+    """
+    the_date = parse_exif_date(value)
+    if the_date is None:
+        # imported here: dateutil is slow to import and almost never needed
+        from dateutil.parser import parse
+        the_date = parse(value)
+    return the_date
+
+
+def convert_strdate_to_timestamp(value):
+    """
+    Convert a date to an epoch timestamp (local time)
+    Takes an int, a datetime or a string as input
+    Returns an epoch timestamp, now if value is None or can't be parsed
+    """
+    if isinstance(value, int):
+        return value
+    elif isinstance(value, datetime.date):
+        return (value - EPOCH).total_seconds()
+    elif value:
+
+        value = str(value)
+
+        try:
+            the_date = parse_date(value)
+            # works for python 3
+            # timestamp = the_date.timestamp()
+            return time.mktime(the_date.timetuple())
+
+        except Exception as e:
+            logger.warn('model date impossible to parse: ' + str(value))
+
+    # now in epoch time
+    return int(time.time())
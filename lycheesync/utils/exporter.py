@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import logging
+import math
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    import socketserver
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    import SocketServer as socketserver
+
+logger = logging.getLogger(__name__)
+
+# name -> (type, help), every exported metric
+METRICS = {
+    'lycheesync_start_time_seconds': ('gauge', "Start of the run, unix time"),
+    'lycheesync_run_duration_seconds': ('gauge', "Seconds since the start of the run"),
+    'lycheesync_photos_imported_total': ('counter', "Photos imported in Lychee"),
+    'lycheesync_photo_import_failures_total': ('counter', "Photos that could not be imported"),
+    'lycheesync_last_import_timestamp_seconds': ('gauge', "Last successful photo import, unix time"),
+    'lycheesync_stage_duration_seconds': ('histogram', "Duration of the import stages (see the performance report)"),
+    'lycheesync_stage_errors_total': ('counter', "Import stages that raised an error"),
+    'lycheesync_db_queries_total': ('counter', "Database statements executed"),
+    'lycheesync_db_errors_total': ('counter', "Database statements that failed"),
+    'lycheesync_db_reconnects_total': ('counter', "Database connections reopened"),
+    'lycheesync_watch_events_received_total': ('counter', "Filesystem events received from the observer"),
+    'lycheesync_watch_events_coalesced_total': ('counter', "Filesystem events merged into another one or cancelled"),
+    'lycheesync_watch_events_dispatched_total': ('counter', "Net actions dispatched to the workers"),
+    'lycheesync_watch_events_failed_total': ('counter', "Net actions whose handling raised an error"),
+    'lycheesync_watch_pending_paths': ('gauge', "Paths waiting for their quiet window or end of write"),
+    'lycheesync_watch_writing_files': ('gauge', "Pending files still being written"),
+    'lycheesync_watch_journal_depth': ('gauge', "Events journaled and not handled yet"),
+    'lycheesync_watch_queue_depth': ('gauge', "Net actions queued for the workers"),
+    'lycheesync_watch_running_tasks': ('gauge', "Net actions being handled"),
+}
+
+# seconds, upper bounds of the stage duration buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def formatValue(value):
+    """ a sample value in the text format """
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def formatLabels(labels):
+    """ {"stage": "hash"} -> '{stage="hash"}', labels is a tuple of (name, value) """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                            .replace('\n', '\\n')) for name, value in labels) + "}"
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self, name, labels):
+        """ Returns the (name, labels, value) samples, cumulative buckets """
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append((name + '_bucket', labels + (('le', formatValue(float(bound))),), total))
+        samples.append((name + '_bucket', labels + (('le', '+Inf'),), self.count))
+        samples.append((name + '_sum', labels, self.sum))
+        samples.append((name + '_count', labels, self.count))
+        return samples
+
+
+class Exporter:
+
+    """
+    The run metrics in the Prometheus text format (see METRICS)
+    Counters and histograms are updated by the listeners of lycheedao and metrics,
+    the watch mode gauges are read from the EventAggregator when rendered
+    Served on /metrics by listen (watch and daemon modes), written to a node-exporter textfile by writeTextfile
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (name, labels) -> value
+        self.values = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        self.aggregator = None
+        self.server = None
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def imported(self, ok):
+        """ a photo import ended, successfully or not """
+        if ok:
+            self.inc('lycheesync_photos_imported_total')
+            self.set('lycheesync_last_import_timestamp_seconds', time.time())
+        else:
+            self.inc('lycheesync_photo_import_failures_total')
+
+    def observeQuery(self, query, elapsed, rows=None):
+        """ query listener (see lycheedao) """
+        self.inc('lycheesync_db_queries_total')
+        if rows is None:
+            self.inc('lycheesync_db_errors_total')
+
+    def observeReconnect(self):
+        """ reconnect listener (see lycheedao) """
+        self.inc('lycheesync_db_reconnects_total')
+
+    def observeStage(self, name, elapsed, error=False):
+        """ stage listener (see metrics) """
+        self.observe('lycheesync_stage_duration_seconds', elapsed, (('stage', name),))
+        if error:
+            self.inc('lycheesync_stage_errors_total', labels=(('stage', name),))
+
+    def watch(self, aggregator):
+        """ export the event and queue gauges of an EventAggregator """
+        self.aggregator = aggregator
+
+    def _aggregatorSamples(self):
+        aggregator = self.aggregator
+        if aggregator is None:
+            return []
+        samples = [('lycheesync_watch_events_received_total', aggregator.received),
+                   ('lycheesync_watch_events_coalesced_total', aggregator.coalesced),
+                   ('lycheesync_watch_events_dispatched_total', aggregator.dispatched),
+                   ('lycheesync_watch_events_failed_total', aggregator.failed),
+                   ('lycheesync_watch_pending_paths', len(aggregator.pending)),
+                   ('lycheesync_watch_writing_files', aggregator.writing),
+                   ('lycheesync_watch_journal_depth', aggregator.journal.depth if aggregator.journal else 0)]
+        if aggregator.pool is not None:
+            samples.append(('lycheesync_watch_queue_depth', aggregator.pool.queued))
+            samples.append(('lycheesync_watch_running_tasks', aggregator.pool.running))
+        return [(name, (), value) for name, value in samples]
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format, a string
+        """
+        now = time.time()
+        samples = [('lycheesync_start_time_seconds', (), self.started),
+                   ('lycheesync_run_duration_seconds', (), now - self.started)]
+        samples.extend(self._aggregatorSamples())
+        with self.lock:
+            samples.extend((name, labels, value) for (name, labels), value in self.values.items())
+            histograms = [(name, labels, h.samples(name, labels)) for (name, labels), h in self.histograms.items()]
+        by_name = {}
+        for name, labels, value in sorted(samples, key=lambda s: (s[0], s[1])):
+            by_name.setdefault(name, []).append((name, labels, value))
+        # bucket samples in the order of their bounds
+        for name, labels, histogram in sorted(histograms, key=lambda h: (h[0], h[1])):
+            by_name.setdefault(name, []).extend(histogram)
+        lines = []
+        for name in sorted(by_name):
+            kind, text = METRICS[name]
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in by_name[name]:
+                lines.append("{}{} {}".format(sample, formatLabels(labels), formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+    def writeTextfile(self, path):
+        """
+        Write the metrics to path, atomically: node-exporter never reads a partial file
+        Returns nothing
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # node-exporter only reads *.prom files
+        tmp = path + '.tmp'
+        with io.open(tmp, 'wt', encoding='utf-8') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def listen(self, address='127.0.0.1', port=9475):
+        """
+        Serve /metrics on address:port, in a background thread
+        Returns the MetricsServer
+        """
+        server = MetricsServer((address, port), MetricsHandler)
+        server.exporter = self
+        t = threading.Thread(target=server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        self.server = server
+        logger.info("metrics on http://%s:%s/metrics", address, server.server_address[1])
+        return server
+
+    def close(self):
+        """ stop serving /metrics """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.exporter.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request from %s: " + format, self.client_address[0], *args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter(conf):
+    """
+    The process Exporter when metricsPort or metricsTextfile is set, else None
+    The listeners are registered on creation
+    Returns an Exporter or None
+    """
+    global _exporter
+    if not conf.get('metricsPort') and not conf.get('metricsTextfile'):
+        return None
+    with _exporter_lock:
+        if _exporter is None:
+            from lycheesync.lycheedao import QUERY_LISTENERS
+            from lycheesync.lycheedao import RECONNECT_LISTENERS
+            from lycheesync.utils.metrics import STAGE_LISTENERS
+            _exporter = Exporter()
+            QUERY_LISTENERS.append(_exporter.observeQuery)
+            RECONNECT_LISTENERS.append(_exporter.observeReconnect)
+            STAGE_LISTENERS.append(_exporter.observeStage)
+        return _exporter
+
+
+def imported(conf, ok):
+    """ Exporter.imported when metrics are exported """
+    exporter = get_exporter(conf)
+    if exporter is not None:
+        exporter.imported(ok)
+
+
+def serve(conf, aggregator):
+    """
+    Export the gauges of aggregator, and serve /metrics when metricsPort is set
+    (metricsAddress, default 127.0.0.1: local scrapes only)
+    Returns nothing
+    """
+    exporter = get_exporter(conf)
+    if exporter is None:
+        return
+    exporter.watch(aggregator)
+    if conf.get('metricsPort') and exporter.server is None:
+        try:
+            exporter.listen(conf.get('metricsAddress', '127.0.0.1'), conf['metricsPort'])
+        except (IOError, OSError) as e:
+            logger.error("metrics not served on port %s: %s", conf['metricsPort'], e)
+
+
+def report(conf):
+    """ write the metricsTextfile, when set """
+    exporter = get_exporter(conf)
+    if exporter is None or not conf.get('metricsTextfile'):
+        return
+    try:
+        exporter.writeTextfile(conf['metricsTextfile'])
+        logger.debug("metrics written to %s", conf['metricsTextfile'])
+    except (IOError, OSError) as e:
+        logger.warn("metrics not written to %s: %s", conf['metricsTextfile'], e)
+
+
+def close(conf):
+    """ write the textfile and stop serving /metrics """
+    report(conf)
+    exporter = get_exporter(conf)
+    if exporter is not None:
+        exporter.close()
+        exporter.watch(None)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FingerprintStore:
+
+    """
+    The last known state of the source tree, in a local sqlite database (WAL mode)
+    - directories: modification time, None when its listing has to be read again
+    - files: size, modification time and checksum once imported
+    Used by watch mode to find what changed while it was not running
+    """
+
+    def __init__(self, path, root):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.root = root
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.execute("create table if not exists meta (key text primary key, value text)")
+        self.db.execute("create table if not exists dirs (path text primary key, parent text, mtime real)")
+        self.db.execute("create table if not exists files (path text primary key, parent text not null, "
+                        "size integer not null, mtime real not null, checksum text)")
+        columns = [r[1] for r in self.db.execute("pragma table_info(files)").fetchall()]
+        if 'checksum' not in columns:
+            # state of a version without checksums
+            self.db.execute("alter table files add column checksum text")
+        self.db.execute("create index if not exists files_parent on files (parent)")
+        self.db.execute("create index if not exists dirs_parent on dirs (parent)")
+        row = self.db.execute("select value from meta where key = 'root'").fetchone()
+        if row is None or row[0] != root:
+            if row is not None:
+                logger.warn("fingerprints of %s dropped, source directory is now %s", row[0], root)
+            self.clear()
+
+    def clear(self):
+        """ forget everything: the next reconciliation is a baseline """
+        with self.lock:
+            self.db.execute("begin")
+            self.db.execute("delete from dirs")
+            self.db.execute("delete from files")
+            self.db.execute("insert or replace into meta (key, value) values ('root', ?)", (self.root, ))
+            self.db.execute("commit")
+
+    def empty(self):
+        with self.lock:
+            return self.db.execute("select count(*) from dirs").fetchone()[0] == 0
+
+    def listing(self, directory):
+        """
+        Known content of a directory
+        Returns (mtime or None, {file name: (size, mtime)}, [sub directory names])
+        """
+        with self.lock:
+            row = self.db.execute("select mtime from dirs where path = ?", (directory, )).fetchone()
+            files = self.db.execute("select path, size, mtime from files where parent = ?", (directory, ))
+            files = dict((os.path.basename(p), (s, m)) for p, s, m in files.fetchall())
+            dirs = self.db.execute("select path from dirs where parent = ?", (directory, ))
+            dirs = [os.path.basename(r[0]) for r in dirs.fetchall()]
+        return (row[0] if row else None), files, dirs
+
+    def update(self, dirs=(), files=()):
+        """
+        Record several fingerprints in one transaction
+        Parameters:
+        - dirs: (path, mtime or None) tuples
+        - files: (path, size, mtime) tuples
+        """
+        with self.lock:
+            self.db.execute("begin")
+            try:
+                self.db.executemany("insert or replace into dirs (path, parent, mtime) values (?, ?, ?)",
+                                    [(p, self._parent(p), m) for p, m in dirs])
+                # the checksum is kept while the file is unchanged
+                self.db.executemany("insert or replace into files (path, parent, size, mtime, checksum) "
+                                    "values (?, ?, ?, ?, (select checksum from files "
+                                    "where path = ? and size = ? and mtime = ?))",
+                                    [(p, os.path.dirname(p), s, m, p, s, m) for p, s, m in files])
+                self.db.execute("commit")
+            except Exception:
+                self.db.execute("rollback")
+                raise
+
+    def setChecksum(self, path, size, mtime, checksum):
+        """ record the checksum of an imported file, with its fingerprint when imported """
+        with self.lock:
+            self.db.execute("insert or replace into files (path, parent, size, mtime, checksum) "
+                            "values (?, ?, ?, ?, ?)", (path, os.path.dirname(path), size, mtime, checksum))
+
+    def checksum(self, path):
+        """
+        Returns the checksum recorded for path, None if unknown
+        """
+        with self.lock:
+            row = self.db.execute("select checksum from files where path = ?", (path, )).fetchone()
+        return row[0] if row else None
+
+    def invalidate(self, directory):
+        """ the listing of directory changed: read it again at the next reconciliation """
+        with self.lock:
+            self.db.execute("update dirs set mtime = null where path = ?", (directory, ))
+
+    def remove(self, path):
+        """ forget a file or a directory and its content """
+        prefix = path + os.sep
+        with self.lock:
+            self.db.execute("begin")
+            try:
+                for table in ('dirs', 'files'):
+                    self.db.execute("delete from {} where path = ? or substr(path, 1, ?) = ?".format(table),
+                                    (path, len(prefix), prefix))
+                self.db.execute("commit")
+            except Exception:
+                self.db.execute("rollback")
+                raise
+
+    def move(self, src, dest):
+        """ a file or a directory and its content moved from src to dest """
+        prefix = src + os.sep
+        with self.lock:
+            self.db.execute("begin")
+            try:
+                for table in ('dirs', 'files'):
+                    # replaced destination
+                    self.db.execute("delete from {} where path = ? or substr(path, 1, ?) = ?".format(table),
+                                    (dest, len(dest) + 1, dest + os.sep))
+                    self.db.execute("update {} set path = ?, parent = ? where path = ?".format(table),
+                                    (dest, self._parent(dest), src))
+                    self.db.execute("update {} set path = ? || substr(path, ?), parent = ? || substr(parent, ?) "
+                                    "where substr(path, 1, ?) = ?".format(table),
+                                    (dest, len(src) + 1, dest, len(src) + 1, len(prefix), prefix))
+                self.db.execute("commit")
+            except Exception:
+                self.db.execute("rollback")
+                raise
+
+    def _parent(self, path):
+        return None if path == self.root else os.path.dirname(path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
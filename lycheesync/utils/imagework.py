@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# exif orientations transforming the pixels
+TRANSFORMING_ORIENTATIONS = (2, 3, 4, 5, 6, 7, 8)
+# exif orientation -> swaps width and height
+SWAPPING_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def loadPIL():
+    """
+    Import PIL on first use: it is slow to import and useless for sanity check or db update runs
+    Returns the PIL Image module
+    """
+    from PIL import Image
+    from PIL import ImageFile
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return Image
+
+
+def openImage(path):
+    """
+    Open an image, refusing the ones above Image.MAX_IMAGE_PIXELS (decompression bombs)
+    before decoding them
+    Returns a PIL Image
+    """
+    Image = loadPIL()
+    img = Image.open(path)
+    if Image.MAX_IMAGE_PIXELS and img.size[0] * img.size[1] > Image.MAX_IMAGE_PIXELS:
+        img.close()
+        raise ValueError("{}x{} pixels, more than the {} allowed".format(img.size[0], img.size[1],
+                                                                        Image.MAX_IMAGE_PIXELS))
+    return img
+
+
+def thumbnail(path, box, res, destimage):
+    """
+    Crop box from the image at path and save it as a res thumbnail in destimage
+    Returns destimage
+    """
+    Image = loadPIL()
+    original = openImage(path)
+    try:
+        img = original.crop(box)
+        img.thumbnail(res, Image.LANCZOS)
+        img.save(destimage, quality=99)
+    finally:
+        original.close()
+    return destimage
+
+
+def rotate(path, url):
+    """
+    Rotate the image at path according to its exif orientation tag, reset to 1
+    A hard linked file is replaced by a new one: the other link keeps its content
+    Returns the orientation found, None without orientation tag
+    """
+    import pyexiv2
+    Image = loadPIL()
+    metadata = pyexiv2.ImageMetadata(path)
+    metadata.read()
+    original = img = openImage(path)
+    orientation = None
+    try:
+        if "Exif.Image.Orientation" in metadata.exif_keys:
+            orientation = metadata['Exif.Image.Orientation'].value
+
+            if orientation == 2:
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+            elif orientation == 3:
+                img = img.rotate(180)
+            elif orientation == 4:
+                img = img.rotate(180).transpose(Image.FLIP_LEFT_RIGHT)
+            elif orientation == 5:
+                img = img.rotate(-90, expand=True).transpose(Image.FLIP_LEFT_RIGHT)
+            elif orientation == 6:
+                img = img.rotate(-90, expand=True)
+            elif orientation == 7:
+                img = img.rotate(90, expand=True).transpose(Image.FLIP_LEFT_RIGHT)
+            elif orientation == 8:
+                img = img.rotate(90, expand=True)
+            else:
+                if orientation != 1:
+                    logger.warn("Orientation not defined {} for photo {}".format(orientation, path))
+
+            if orientation in TRANSFORMING_ORIENTATIONS:
+                # the pixels are transformed: viewers must not apply it again
+                metadata['Exif.Image.Orientation'].value = 1
+            if os.stat(path).st_nlink > 1:
+                # hard link: save a new file, the source keeps its content
+                tmp = os.path.join(os.path.dirname(path), '.rotated-' + url)
+                img.save(tmp, quality=99)
+                os.rename(tmp, path)
+            else:
+                img.save(path, quality=99)
+    finally:
+        original.close()
+    metadata.write(preserve_timestamps=True)
+    return orientation
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import functools
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from lycheesync.utils.boilerplatecode import log_directory
+
+logger = logging.getLogger(__name__)
+
+# durations kept per stage for the percentiles, a uniform sample beyond
+MAX_SAMPLES = 20000
+# called with (stage name, elapsed seconds, error) for each timing, ex: Exporter.observeStage
+STAGE_LISTENERS = []
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of sorted values
+    Returns a value, None for no values
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(q / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.samples = []
+
+    def add(self, elapsed, nbytes=0, error=False):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.bytes += nbytes
+        if error:
+            self.errors += 1
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(elapsed)
+        else:
+            # reservoir sampling
+            i = random.randint(0, self.count - 1)
+            if i < MAX_SAMPLES:
+                self.samples[i] = elapsed
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {'count': self.count, 'errors': self.errors, 'total': self.total, 'max': self.max,
+                'mean': self.total / self.count if self.count else None, 'bytes': self.bytes,
+                'p50': percentile(samples, 50), 'p95': percentile(samples, 95), 'p99': percentile(samples, 99)}
+
+
+class Metrics:
+
+    """
+    Per stage timings of a run: count, errors, total, max, p50/p95/p99 durations (seconds) and bytes processed
+    Thread safe: stages are timed by watch mode workers as well
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.started = time.time()
+
+    def record(self, name, elapsed, nbytes=0, error=False):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.add(elapsed, nbytes, error)
+        for listener in STAGE_LISTENERS:
+            listener(name, elapsed, error)
+
+    @contextmanager
+    def timed(self, name, nbytes=0):
+        """ time the with block as stage name, an exception counts as an error """
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.record(name, time.time() - start, nbytes, error=True)
+            raise
+        self.record(name, time.time() - start, nbytes)
+
+    def timedIter(self, name, iterable):
+        """ time each next() of iterable as stage name, ex: os.walk """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.time() - start)
+            yield item
+
+    def summary(self):
+        """
+        Returns a json serializable dict: {'started', 'elapsed', 'stages': {name: stage summary}}
+        """
+        with self.lock:
+            stages = dict((name, stage.summary()) for name, stage in self.stages.items())
+        return {'started': self.started, 'elapsed': time.time() - self.started, 'stages': stages}
+
+    def table(self):
+        """
+        Returns the summary as a text table, slowest stages (total time) first
+        """
+        summary = self.summary()
+
+        def ms(v):
+            return "-" if v is None else "{:.1f}".format(v * 1000)
+
+        lines = ["{:<28} {:>8} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+            'stage', 'count', 'errors', 'total s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'MB')]
+        for name, s in sorted(summary['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append("{:<28} {:>8} {:>6} {:>10.2f} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+                name[:28], s['count'], s['errors'], s['total'], ms(s['p50']), ms(s['p95']), ms(s['p99']), ms(s['max']),
+                "{:.1f}".format(s['bytes'] / 1048576.0) if s['bytes'] else "-"))
+        lines.append("run time: {:.1f}s".format(summary['elapsed']))
+        return "\n".join(lines)
+
+    def writeReport(self, path, extra=None):
+        """
+        Write the summary as json to path, with the extra dict keys
+        Returns nothing
+        """
+        report = self.summary()
+        report.update(extra or {})
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + '.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.started = time.time()
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """ Returns the process Metrics """
+    return _metrics
+
+
+def timed(name, nbytes=0):
+    """ time a with block in the process Metrics, see Metrics.timed """
+    return _metrics.timed(name, nbytes)
+
+
+def instrument(cls, prefix):
+    """
+    Time every public method of cls as stage "prefix.method"
+    Returns cls
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_') or not callable(method):
+            continue
+
+        def wrap(method, stage):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                with _metrics.timed(stage):
+                    return method(*args, **kwargs)
+            return wrapper
+        setattr(cls, name, wrap(method, "{}.{}".format(prefix, name)))
+    return cls
+
+
+def reportPath(conf):
+    """
+    The json report path: metricsReport, by default lycheesync-report.json next to the log file
+    Returns a path
+    """
+    if conf.get('metricsReport'):
+        return conf['metricsReport']
+    return os.path.join(log_directory(), 'lycheesync-report.json')
+
+
+def report(conf, extra=None):
+    """
+    End of run: log the summary table and write the json report
+    Returns nothing
+    """
+    metrics = get_metrics()
+    logger.info("performance report:\n%s", metrics.table())
+    path = reportPath(conf)
+    try:
+        metrics.writeReport(path, extra)
+        logger.info("performance report written to %s", path)
+    except (IOError, OSError) as e:
+        logger.warn("performance report not written to %s: %s", path, e)
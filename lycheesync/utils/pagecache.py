@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+
+def advise(path, advice, sync=False):
+    """
+    posix_fadvise the whole file, errors (vanished file, no posix_fadvise) are ignored
+    Parameters:
+    - sync: write the file back first, dirty pages are not dropped by DONTNEED
+    Returns True if the hint was given
+    """
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        if sync:
+            os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, advice)
+        return True
+    except OSError as e:
+        logger.debug("posix_fadvise %s failed: %s", path, e)
+        return False
+    finally:
+        os.close(fd)
+
+
+class PageCache:
+
+    """
+    Page cache hints for the import I/O, so that an import doesn't evict the web server hot thumbnails:
+    - readahead: WILLNEED on the next photos to import, read by the kernel while the current one is processed
+    - drop: DONTNEED on the source and lychee big file of a photo once done.
+      Big files were just written: their dirty pages can't be dropped before writeback,
+      so they are written back and dropped `lag` photos later, when the kernel has most likely written them already
+    Thumbnails are left alone: they are what the web server needs
+    """
+
+    def __init__(self, readahead=2, drop=True, lag=16):
+        self.readahead = readahead
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.written = collections.deque()
+        self.lag = lag
+        self.prefetched = 0
+        self.dropped = 0
+
+    def ahead(self, names, directory=''):
+        """
+        Iterate over file names of directory, the next readahead ones being prefetched
+        Returns a generator of names
+        """
+        names = list(names)
+        for name in names[:self.readahead]:
+            self.prefetch(os.path.join(directory, name))
+        for i, name in enumerate(names):
+            if self.readahead and i + self.readahead < len(names):
+                self.prefetch(os.path.join(directory, names[i + self.readahead]))
+            yield name
+
+    def prefetch(self, path):
+        if advise(path, WILLNEED):
+            self.prefetched += 1
+
+    def done(self, src, dest=None):
+        """
+        A photo is done: src is dropped now, dest (the lychee big file, if any) later
+        """
+        if not self.drop:
+            return
+        if advise(src, DONTNEED):
+            self.dropped += 1
+        if dest is None:
+            return
+        with self.lock:
+            self.written.append(dest)
+            old = self.written.popleft() if len(self.written) > self.lag else None
+        if old is not None and advise(old, DONTNEED, sync=True):
+            self.dropped += 1
+
+    def close(self):
+        """ drop the big files not dropped yet """
+        with self.lock:
+            written = list(self.written)
+            self.written.clear()
+        for path in written:
+            if advise(path, DONTNEED, sync=True):
+                self.dropped += 1
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_page_cache(conf):
+    """
+    The PageCache of the conf, one per process:
+    pageCacheReadahead (photos read ahead, default 2, 0 disables), pageCacheDrop (default True)
+    Returns a PageCache
+    """
+    key = (conf.get('pageCacheReadahead', 2), conf.get('pageCacheDrop', True))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = PageCache(*key)
+        return _caches[key]
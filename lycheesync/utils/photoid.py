@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# lychee_photos.id is a bigint(14): 10 digits of epoch seconds, then 4 digits
+ID_LENGTH = 14
+TIME_DIGITS = 10
+
+
+class ClockSkewError(Exception):
+    pass
+
+
+class PhotoIdAllocator:
+
+    """
+    Allocates unique 14 digits photo ids: epoch seconds, worker id, sequence
+    ex: with 1 worker digit, 1500000000 2 017 is the 18th id of worker 2 during second 1500000000
+    - threads share the allocator: ids are unique within the process
+    - processes and hosts importing at the same time need distinct worker ids
+    When the sequence of the current second is exhausted, waits for the next second
+    Ids start at the second after the allocator creation: a previous run with the same worker id
+    (restarted within the same second) may have used the sequence of that second
+    When the clock goes back by at most max_skew seconds, ids are taken from the last used second;
+    further, ClockSkewError is raised rather than risking duplicate ids
+    """
+
+    def __init__(self, worker=0, worker_digits=1, max_skew=5, clock=time.time, sleep=time.sleep):
+        if not 0 <= worker_digits < ID_LENGTH - TIME_DIGITS:
+            raise ValueError("worker digits must be between 0 and {}".format(ID_LENGTH - TIME_DIGITS - 1))
+        if not 0 <= worker < 10 ** worker_digits:
+            raise ValueError("worker id {} does not fit in {} digits".format(worker, worker_digits))
+        self.worker = worker
+        self.worker_digits = worker_digits
+        self.seq_digits = ID_LENGTH - TIME_DIGITS - worker_digits
+        self.max_skew = max_skew
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # the creation second counts as exhausted
+        self.last = int(clock())
+        self.seq = 10 ** self.seq_digits - 1
+
+    def _now(self):
+        now = int(self.clock())
+        if self.last - now > self.max_skew:
+            raise ClockSkewError("clock went back {}s, more than the {}s allowed: no photo id until {}".format(
+                self.last - now, self.max_skew, self.last))
+        return now
+
+    def next(self):
+        """
+        Returns a new photo id, a 14 characters string
+        """
+        photo_id = None
+        while photo_id is None:
+            with self.lock:
+                if os.getpid() != self.pid:
+                    raise Exception("photo id allocator inherited by a forked process: configure its own worker id")
+                now = self._now()
+                exhausted = False
+                if now > self.last:
+                    self.last = now
+                    self.seq = 0
+                elif self.seq + 1 < 10 ** self.seq_digits:
+                    # same second, or the clock went back a little: go on with the last second
+                    self.seq += 1
+                else:
+                    exhausted = True
+                if not exhausted:
+                    photo_id = "{}{}{}".format(self.last,
+                                               str(self.worker).zfill(self.worker_digits) if self.worker_digits else "",
+                                               str(self.seq).zfill(self.seq_digits))
+            if photo_id is None:
+                # exhausted: wait for the next second, without blocking the other threads
+                self.sleep(0.01)
+        if len(photo_id) != ID_LENGTH:
+            raise ValueError("photo id {} is not {} characters long".format(photo_id, ID_LENGTH))
+        return photo_id
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def configure(worker=0, worker_digits=1, max_skew=5):
+    """
+    Replace the process allocator, ex: in a new worker process
+    Returns the new PhotoIdAllocator
+    """
+    global _allocator
+    allocator = PhotoIdAllocator(worker, worker_digits, max_skew)
+    with _allocator_lock:
+        _allocator = allocator
+    return allocator
+
+
+def next_photo_id(conf):
+    """
+    Allocate a photo id from the process allocator, created from conf on first use:
+    photoIdWorker (default 0), photoIdWorkerDigits (default 1), photoIdMaxSkew (default 5)
+    Returns a 14 characters string
+    """
+    global _allocator
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = PhotoIdAllocator(conf.get('photoIdWorker', 0), conf.get('photoIdWorkerDigits', 1),
+                                          conf.get('photoIdMaxSkew', 5))
+        allocator = _allocator
+    return allocator.next()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sampling')
+EXTENSIONS = {'cprofile': 'pstats', 'sampling': 'collapsed'}
+# functions printed at the end
+TOP = 25
+
+
+class CProfiler:
+
+    """
+    cProfile of the thread calling start, and of the with blocks of other threads (see thread),
+    merged with the worker processes ones in one pstats file
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.main = cProfile.Profile()
+        self.owner = None
+        self.profiles = []
+
+    def start(self):
+        self.owner = threading.current_thread()
+        self.main.enable()
+
+    @contextmanager
+    def thread(self):
+        if threading.current_thread() is self.owner:
+            yield
+            return
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError as e:
+            # one profiler at a time since python 3.12
+            logger.debug("thread not profiled: %s", e)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def stop(self, path, worker_files=()):
+        """
+        Write the merged stats to path
+        Returns the top cumulative functions, a string
+        """
+        self.main.disable()
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            profiles = list(self.profiles)
+        for source in profiles + list(worker_files):
+            try:
+                stats.add(source)
+            except (TypeError, IOError, EOFError) as e:
+                # never enabled, or an unreadable worker file
+                logger.debug("profile not merged: %s", e)
+        stats.dump_stats(path)
+        out = io.StringIO() if sys.version_info.major > 2 else io.BytesIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(TOP)
+        return out.getvalue()
+
+
+class Sampler(threading.Thread):
+
+    """
+    Samples the stacks of every other thread each interval seconds
+    Writes them collapsed, one "thread;module:function;... count" line per stack (flamegraph.pl, speedscope)
+    """
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, name='sampler')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        # collapsed stack -> samples
+        self.counts = {}
+
+    def run(self):
+        me = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            names = dict((t.ident, re.sub(r'-\d+$', '', t.name)) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{}:{}".format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with io.open(path, 'wt', encoding='utf-8') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+def readCollapsed(path, counts):
+    """ add the stacks of a collapsed file to counts """
+    with io.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] = counts.get(stack, 0) + int(count)
+
+
+def topCollapsed(counts, n=TOP):
+    """
+    Functions with the most samples, callees included
+    Returns a string
+    """
+    total = sum(counts.values()) or 1
+    inclusive = {}
+    for stack, count in counts.items():
+        for func in set(stack.split(';')[1:]):
+            inclusive[func] = inclusive.get(func, 0) + count
+    lines = ["{} samples".format(sum(counts.values())), "{:>8} {:>6}  {}".format('samples', '%', 'function')]
+    for func, count in sorted(inclusive.items(), key=lambda item: -item[1])[:n]:
+        lines.append("{:>8} {:>5.1f}%  {}".format(count, 100.0 * count / total, func))
+    return "\n".join(lines)
+
+
+class Profiling:
+
+    """
+    A profiled run: the lycheesync process threads and the image worker processes (see workerProfile)
+    Output in directory: profile-<run>.pstats (cprofile) or profile-<run>.collapsed (sampling)
+    """
+
+    def __init__(self, mode, directory):
+        if mode not in MODES:
+            raise ValueError("unknown profiler {}, expected one of: {}".format(mode, ", ".join(MODES)))
+        self.mode = mode
+        self.directory = directory
+        self.run = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(directory, "profile-{}.{}".format(self.run, EXTENSIONS[mode]))
+        self.profiler = CProfiler() if mode == 'cprofile' else Sampler()
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.profiler.start()
+        logger.info("profiling with %s", self.mode)
+
+    def workerPrefix(self):
+        return os.path.join(self.directory, "profile-{}-worker".format(self.run))
+
+    def stop(self):
+        """ merge the worker processes files, write the profile and log the top functions """
+        worker_files = glob.glob("{}-*.{}".format(self.workerPrefix(), EXTENSIONS[self.mode]))
+        if self.mode == 'cprofile':
+            top = self.profiler.stop(self.path, worker_files)
+        else:
+            self.profiler.stop()
+            counts = self.profiler.counts
+            for path in worker_files:
+                readCollapsed(path, counts)
+            self.profiler.write(self.path)
+            top = topCollapsed(counts)
+        for path in worker_files:
+            os.remove(path)
+        logger.info("profile written to %s (%s worker processes merged), top functions:\n%s", self.path,
+                    len(worker_files), top)
+
+
+_profiling = None
+
+
+def start(mode, directory):
+    """
+    Start profiling the process
+    Returns the Profiling
+    """
+    global _profiling
+    _profiling = Profiling(mode, directory)
+    _profiling.start()
+    return _profiling
+
+
+def stop():
+    global _profiling
+    if _profiling is not None:
+        profiling = _profiling
+        _profiling = None
+        profiling.stop()
+
+
+@contextmanager
+def thread():
+    """ profile the with block of a worker thread (cprofile), sampled threads need nothing """
+    if _profiling is not None and _profiling.mode == 'cprofile':
+        with _profiling.profiler.thread():
+            yield
+    else:
+        yield
+
+
+def workerProfile():
+    """
+    What a worker process has to profile, passed to it at start
+    Returns (mode, file prefix), None when not profiling
+    """
+    if _profiling is None:
+        return None
+    return _profiling.mode, _profiling.workerPrefix()
+
+
+class WorkerProfiler:
+
+    """ profiling in a worker process: its tasks (cprofile) or all of it (sampling), written at exit """
+
+    def __init__(self, spec):
+        self.mode, prefix = spec
+        self.path = "{}-{}.{}".format(prefix, os.getpid(), EXTENSIONS[self.mode])
+        self.profile = cProfile.Profile() if self.mode == 'cprofile' else None
+        self.sampler = None
+        if self.mode == 'sampling':
+            self.sampler = Sampler()
+            self.sampler.start()
+
+    @contextmanager
+    def task(self):
+        if self.profile is not None:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+        else:
+            yield
+
+    def write(self):
+        try:
+            if self.profile is not None:
+                self.profile.dump_stats(self.path)
+            else:
+                self.sampler.stop()
+                self.sampler.write(self.path)
+        except (IOError, OSError) as e:
+            logger.warn("worker profile not written to %s: %s", self.path, e)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"%s|%\(\w+\)s")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+# fingerprints of raw queries, bounded
+_fingerprints = {}
+MAX_FINGERPRINTS = 10000
+
+
+def fingerprint(query):
+    """
+    Shape of a statement: literals and placeholders replaced by ?, value lists by (?+), spaces collapsed, lower case
+    ex: "select * from lychee_photos where id=12" -> "select * from lychee_photos where id=?"
+    Returns a string
+    """
+    shape = _fingerprints.get(query)
+    if shape is None:
+        shape = _STRINGS.sub("?", query)
+        shape = _PLACEHOLDERS.sub("?", shape)
+        shape = _NUMBERS.sub("?", shape)
+        shape = _LISTS.sub("(?+)", shape)
+        shape = _SPACES.sub(" ", shape).strip().rstrip(";").lower()
+        if len(_fingerprints) < MAX_FINGERPRINTS:
+            _fingerprints[query] = shape
+    return shape
+
+
+class QueryStats:
+
+    """
+    Statements executed during a run, by fingerprint: calls, rows, time, and commits
+    N+1 detection: queries are also counted per scope (an album, a photo: see enter), a fingerprint executed
+    more than limits[scope name] times in one scope is flagged
+    """
+
+    def __init__(self, limits=None):
+        self.lock = threading.Lock()
+        # fingerprint -> {'calls', 'rows', 'time', 'max'}
+        self.statements = {}
+        self.commits = 0
+        self.limits = limits or {}
+        # (scope, fingerprint) -> highest count in one scope
+        self.flagged = {}
+        self.local = threading.local()
+
+    def observeQuery(self, query, elapsed, rows=None):
+        """ query listener (see lycheedao) """
+        shape = fingerprint(query)
+        with self.lock:
+            s = self.statements.get(shape)
+            if s is None:
+                s = self.statements[shape] = {'calls': 0, 'rows': 0, 'time': 0.0, 'max': 0.0}
+            s['calls'] += 1
+            s['rows'] += rows if rows and rows > 0 else 0
+            s['time'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+        for key, counts in getattr(self.local, 'scopes', {}).values():
+            counts[shape] = counts.get(shape, 0) + 1
+
+    def observeCommit(self):
+        with self.lock:
+            self.commits += 1
+
+    def enter(self, name, key):
+        """
+        Count the queries of this thread as the scope name (ex: 'album', 'photo') of key (ex: its path),
+        until the next enter of name or leave. Scopes of different names are counted at the same time
+        """
+        scopes = getattr(self.local, 'scopes', None)
+        if scopes is None:
+            scopes = self.local.scopes = {}
+        if name in scopes:
+            self._check(name, scopes[name])
+        scopes[name] = (key, {})
+
+    def leave(self, name=None):
+        """ end the scope name of this thread, all its scopes if None """
+        scopes = getattr(self.local, 'scopes', {})
+        for n in ([name] if name else list(scopes)):
+            if n in scopes:
+                self._check(n, scopes.pop(n))
+
+    def _check(self, name, scope):
+        key, counts = scope
+        limit = self.limits.get(name)
+        if not limit:
+            return
+        for shape, count in counts.items():
+            if count > limit:
+                with self.lock:
+                    if (name, shape) not in self.flagged:
+                        logger.warn("N+1: %s queries of this shape for %s %s: %s", count, name, key, shape)
+                    self.flagged[(name, shape)] = max(self.flagged.get((name, shape), 0), count)
+
+    def top(self, n=20):
+        """
+        Returns the n statements with the highest total time: [(fingerprint, stats dict)]
+        """
+        with self.lock:
+            statements = [(shape, dict(s)) for shape, s in self.statements.items()]
+        return sorted(statements, key=lambda item: -item[1]['time'])[:n]
+
+    def table(self, n=20):
+        """
+        Returns a text report: totals, top n statements by total time, flagged N+1 shapes
+        """
+        with self.lock:
+            calls = sum(s['calls'] for s in self.statements.values())
+            total = sum(s['time'] for s in self.statements.values())
+            flagged = sorted(self.flagged.items())
+        lines = ["{} queries ({} shapes), {:.2f}s, {} commits".format(calls, len(self.statements), total,
+                                                                     self.commits),
+                 "{:>8} {:>10} {:>9} {:>9} {:>10}  {}".format('calls', 'total s', 'mean ms', 'max ms', 'rows',
+                                                              'statement')]
+        for shape, s in self.top(n):
+            lines.append("{:>8} {:>10.3f} {:>9.2f} {:>9.2f} {:>10}  {}".format(
+                s['calls'], s['time'], s['time'] / s['calls'] * 1000, s['max'] * 1000, s['rows'], shape[:200]))
+        for (name, shape), count in flagged:
+            lines.append("N+1 per {} (up to {} calls, limit {}): {}".format(name, count, self.limits[name],
+                                                                           shape[:200]))
+        return "\n".join(lines)
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_query_stats(conf):
+    """
+    The process QueryStats when dbStats is on, else None
+    dbStatsMaxPerAlbum (default 100) and dbStatsMaxPerPhoto (default 3) are the N+1 limits
+    The query listener is registered on creation
+    Returns a QueryStats or None
+    """
+    global _stats
+    if not conf.get('dbStats'):
+        return None
+    with _stats_lock:
+        if _stats is None:
+            from lycheesync.lycheedao import COMMIT_LISTENERS
+            from lycheesync.lycheedao import QUERY_LISTENERS
+            _stats = QueryStats({'album': conf.get('dbStatsMaxPerAlbum', 100),
+                                 'photo': conf.get('dbStatsMaxPerPhoto', 3)})
+            QUERY_LISTENERS.append(_stats.observeQuery)
+            COMMIT_LISTENERS.append(_stats.observeCommit)
+        return _stats
+
+
+def enter(conf, name, key):
+    """ QueryStats.enter when dbStats is on """
+    stats = get_query_stats(conf)
+    if stats is not None:
+        stats.enter(name, key)
+
+
+def leave(conf, name=None):
+    """ QueryStats.leave when dbStats is on """
+    stats = get_query_stats(conf)
+    if stats is not None:
+        stats.leave(name)
+
+
+def report(conf):
+    """ log the query report when dbStats is on """
+    stats = get_query_stats(conf)
+    if stats is not None:
+        stats.leave()
+        logger.info("database statements:\n%s", stats.table())
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+
+from lycheesync.utils import profiling
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTaskError(Exception):
+
+    """ an image task failed in its worker process: timeout, memory limit, too many pixels, crash... """
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+def _serve(conn, max_pixels, memory_mb, profile=None):
+    """ worker process loop: runs (func, args) tasks received on conn, answers ('ok', result) or ('error', why) """
+    if memory_mb:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    import warnings
+    from lycheesync.utils.imagework import loadPIL
+    Image = loadPIL()
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+    profiler = None
+    if profile:
+        profiler = profiling.WorkerProfiler(profile)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, args = task
+        try:
+            if profiler:
+                with profiler.task():
+                    answer = ('ok', func(*args))
+            else:
+                answer = ('ok', func(*args))
+        except MemoryError:
+            answer = ('error', "memory limit of {} MB reached".format(memory_mb))
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            answer = ('error', "{}: {}".format(type(e).__name__, e))
+        conn.send(answer)
+    if profiler:
+        profiler.write()
+
+
+class ImageWorker:
+
+    def __init__(self, context, max_pixels, memory_mb, profile=None):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, max_pixels, memory_mb, profile),
+                                       name='image-worker')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(5)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ImageSandbox:
+
+    """
+    Runs image tasks (see imagework) in worker processes, under limits:
+    - timeout: seconds, the worker is killed beyond
+    - max_pixels: images above are refused before being decoded
+    - memory_mb: address space of a worker (RLIMIT_AS)
+    A killed or crashed worker is replaced. A failed task raises ImageTaskError
+    Threads share the workers, at most workers tasks run at a time
+    With workers=0, tasks run in the calling thread without limits
+    profile: (mode, file prefix) to profile the workers, see profiling.workerProfile
+    """
+
+    def __init__(self, workers=2, timeout=60, max_pixels=100000000, memory_mb=2048, profile=None):
+        self.workers = workers
+        self.profile = profile
+        self.timeout = timeout
+        self.max_pixels = max_pixels
+        self.memory_mb = memory_mb
+        methods = multiprocessing.get_all_start_methods()
+        # fork from a threaded process (watch mode) may deadlock
+        self.context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+        self.cond = threading.Condition()
+        self.idle = []
+        self.started = 0
+        self.killed = 0
+
+    def run(self, func, *args):
+        """
+        Run func(*args) in a worker process, func must be a module level function
+        Returns its result
+        """
+        if not self.workers:
+            return func(*args)
+        for attempt in range(2):
+            worker = self._acquire()
+            try:
+                worker.conn.send((func, args))
+            except (IOError, OSError) as e:
+                # died while idle: try again on a new worker
+                logger.debug("image worker gone: %s", e)
+                self._kill(worker)
+                self._release(None)
+                continue
+            except Exception:
+                self._release(worker)
+                raise
+            return self._answer(worker)
+        raise ImageTaskError("image workers die as soon as started")
+
+    def _answer(self, worker):
+        """ wait for the answer of the task sent to worker """
+        try:
+            if not worker.conn.poll(self.timeout):
+                self._kill(worker)
+                worker = None
+                raise ImageTaskError("timeout after {}s".format(self.timeout))
+            try:
+                status, value = worker.conn.recv()
+            except EOFError:
+                self._kill(worker)
+                code = worker.process.exitcode
+                worker = None
+                raise ImageTaskError("worker died (exit code {}), memory limit of {} MB?".format(code,
+                                                                                               self.memory_mb))
+            if status == 'error':
+                raise ImageTaskError(value)
+            return value
+        finally:
+            self._release(worker)
+
+    def _acquire(self):
+        with self.cond:
+            while not self.idle and self.started >= self.workers:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return ImageWorker(self.context, self.max_pixels, self.memory_mb, self.profile)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        """ worker back to the idle ones, None when it is gone """
+        with self.cond:
+            if worker is None:
+                self.started -= 1
+            else:
+                self.idle.append(worker)
+            self.cond.notify()
+
+    def _kill(self, worker):
+        worker.kill()
+        with self.cond:
+            self.killed += 1
+
+    def close(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+            self.started -= len(idle)
+        for worker in idle:
+            worker.stop()
+
+
+class Quarantine:
+
+    """
+    Source photos whose image processing failed in the sandbox, kept in a json file:
+    {path: {'reason', 'size', 'mtime'}}
+    They are skipped until modified. Listed at the end of the run
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        # quarantined during this run
+        self.added = []
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rt') as f:
+                    self.files = json.load(f)
+            except ValueError as e:
+                logger.warn("quarantine list %s unreadable, starting a new one: %s", path, e)
+
+    def add(self, srcpath, reason):
+        try:
+            st = os.stat(srcpath)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, None
+        with self.lock:
+            self.files[srcpath] = {'reason': reason, 'size': size, 'mtime': mtime}
+            self.added.append(srcpath)
+            self._save()
+        logger.error("quarantined %s: %s", srcpath, reason)
+
+    def contains(self, srcpath):
+        """ True if srcpath is quarantined and unchanged since """
+        with self.lock:
+            entry = self.files.get(srcpath)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(srcpath)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime) != (entry['size'], entry['mtime']):
+            with self.lock:
+                self.files.pop(srcpath, None)
+                self._save()
+            return False
+        return True
+
+    def _save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wt') as f:
+            json.dump(self.files, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def report(self):
+        """ log the files quarantined during this run """
+        with self.lock:
+            added = list(self.added)
+        if added:
+            logger.error("%s photos quarantined during this run (listed in %s):", len(added), self.path)
+            for path in added:
+                logger.error("- %s: %s", path, self.files[path]['reason'])
+
+
+_sandboxes = {}
+_quarantines = {}
+_lock = threading.Lock()
+
+
+def get_sandbox(conf):
+    """
+    The ImageSandbox of the conf, one per process:
+    imageWorkers (default 2, 0 runs image work in process without limits), imageTimeout (seconds, default 60),
+    imageMaxPixels (default 100000000), imageMemoryMB (default 2048, 0 for no limit)
+    Returns an ImageSandbox
+    """
+    key = (conf.get('imageWorkers', 2), conf.get('imageTimeout', 60), conf.get('imageMaxPixels', 100000000),
+           conf.get('imageMemoryMB', 2048), profiling.workerProfile())
+    with _lock:
+        if key not in _sandboxes:
+            _sandboxes[key] = ImageSandbox(*key)
+        return _sandboxes[key]
+
+
+def get_quarantine(conf):
+    """
+    The Quarantine of the conf: quarantineFile (default logs/quarantine.json)
+    Returns a Quarantine
+    """
+    path = conf.get('quarantineFile', os.path.join('logs', 'quarantine.json'))
+    with _lock:
+        if path not in _quarantines:
+            _quarantines[path] = Quarantine(path)
+        return _quarantines[path]
+
+
+def close_sandboxes():
+    """ stop the worker processes of the sandboxes created by get_sandbox """
+    with _lock:
+        sandboxes = list(_sandboxes.values())
+        _sandboxes.clear()
+    for sandbox in sandboxes:
+        sandbox.close()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# linux ioprio_set syscall numbers
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+class TokenBucket:
+
+    """
+    Rate limiter: take(n) waits until n tokens are available at rate tokens per second
+    At most burst tokens are saved up while idle. A take bigger than burst goes in debt,
+    paid back by the next takes: big photos are allowed, the average rate is kept
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last = clock()
+        # applied to rate, adjusted by Throttle backoff
+        self.scale = 1.0
+
+    def take(self, n=1):
+        """
+        Returns the seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            rate = self.rate * self.scale
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+def setIoPriority(io_class, level=7):
+    """
+    ioprio_set of the calling thread (linux), inherited by the threads it starts
+    Returns True if applied
+    """
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        logger.warn("io priority not supported on %s", platform.machine())
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    value = (IO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | (level if io_class != 'idle' else 0)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        logger.warn("io priority %s not applied: %s", io_class, os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+
+class Throttle:
+
+    """
+    Limits an import so that the Lychee server stays responsive:
+    - throttleReadMBps: source MB read per second (default 20)
+    - throttlePhotosPerSecond: photos imported per second (default 5)
+    - throttleWorkers: maximum number of importing threads (default 1)
+    - throttleNice: cpu nice increment (default 10), throttleIoClass: idle, best-effort or none (default idle)
+    - throttleDbLatency: when the mysql query latency (moving average, ms) goes above it, the rates are halved,
+      then they come back gradually once it is low again. 0 disables it (default 50)
+    0 disables a rate limit
+    """
+
+    def __init__(self, conf, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        mbps = conf.get('throttleReadMBps', 20)
+        pps = conf.get('throttlePhotosPerSecond', 5)
+        self.bytes = TokenBucket(mbps * 1024 * 1024, clock=clock, sleep=sleep) if mbps else None
+        self.photos = TokenBucket(pps, max(pps, 1), clock=clock, sleep=sleep) if pps else None
+        self.workers = conf.get('throttleWorkers', 1)
+        self.nice = conf.get('throttleNice', 10)
+        self.io_class = conf.get('throttleIoClass', 'idle')
+        self.db_latency = conf.get('throttleDbLatency', 50) / 1000.0
+        self.lock = threading.Lock()
+        # moving average of query latency, seconds
+        self.latency = None
+        self.scale = 1.0
+        self.adjusted = 0
+        self.waited = 0.0
+        self.applied = False
+
+    def applyPriority(self):
+        """ lower the cpu and io priority of the calling thread once, to do before starting workers """
+        if self.applied:
+            return
+        self.applied = True
+        if self.nice:
+            os.nice(self.nice)
+        if self.io_class and self.io_class != 'none':
+            setIoPriority(self.io_class)
+        logger.info("throttled: nice +%s, io class %s", self.nice, self.io_class)
+
+    def limitWorkers(self, workers):
+        return min(workers, self.workers) if self.workers else workers
+
+    def before(self, path):
+        """ wait before importing the photo at path """
+        waited = 0
+        if self.photos:
+            waited += self.photos.take(1)
+        if self.bytes:
+            try:
+                waited += self.bytes.take(os.path.getsize(path))
+            except OSError:
+                pass
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def observeQuery(self, query, elapsed, rows=None):
+        """ query listener (see lycheedao): adjusts the rates to the mysql latency """
+        if not self.db_latency:
+            return
+        with self.lock:
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            now = self.clock()
+            if now - self.adjusted < 1:
+                return
+            if self.latency > self.db_latency:
+                scale = max(self.scale / 2, 0.05)
+            elif self.latency < self.db_latency * 0.8:
+                scale = min(self.scale + 0.05, 1.0)
+            else:
+                return
+            if scale != self.scale:
+                logger.debug("mysql latency %.1fms: throttle rates at %d%%", self.latency * 1000, scale * 100)
+            self.adjusted = now
+            self.scale = scale
+            for bucket in (self.bytes, self.photos):
+                if bucket:
+                    bucket.scale = scale
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle(conf):
+    """
+    The process Throttle when throttle mode is on (conf throttle), else None
+    The query listener is registered on creation
+    Returns a Throttle or None
+    """
+    global _throttle
+    if not conf.get('throttle'):
+        return None
+    with _throttle_lock:
+        if _throttle is None:
+            from lycheesync.lycheedao import QUERY_LISTENERS
+            _throttle = Throttle(conf)
+            QUERY_LISTENERS.append(_throttle.observeQuery)
+        return _throttle
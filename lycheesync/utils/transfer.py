@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('copy', 'reflink', 'hardlink', 'symlink', 'move')
+
+# read size when hashing
+HASH_CHUNK = 1024 * 1024
+
+# linux ioctl cloning a whole file (btrfs, xfs...)
+FICLONE = 0x40049409
+
+# transfer failures worth a fallback to the next strategy
+FALLBACK_ERRNOS = set([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL, errno.ENOTTY, errno.ENOSYS,
+                       getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+
+def reflink(src, dest):
+    """ copy on write clone of src, instant and without extra space """
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                fdest.close()
+                os.remove(dest)
+                raise
+    shutil.copymode(src, dest)
+
+
+def copy(src, dest):
+    """ copy of src with its permission bits, data stays in the kernel when copy_file_range is available """
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdest:
+                try:
+                    size = os.fstat(fsrc.fileno()).st_size
+                    copied = 0
+                    while copied < size:
+                        n = os.copy_file_range(fsrc.fileno(), fdest.fileno(), size - copied)
+                        if n == 0:
+                            break
+                        copied += n
+                except OSError as e:
+                    if e.errno not in FALLBACK_ERRNOS:
+                        raise
+                    # not supported between these file systems
+                    fsrc.seek(0)
+                    fdest.seek(0)
+                    fdest.truncate()
+                    shutil.copyfileobj(fsrc, fdest)
+        shutil.copymode(src, dest)
+    else:
+        shutil.copy(src, dest)
+
+
+def hardlink(src, dest):
+    os.link(src, dest)
+
+
+def symlink(src, dest):
+    os.symlink(src, dest)
+
+
+def move(src, dest):
+    """ the source file is removed """
+    shutil.move(src, dest)
+
+
+def sha1(src, stage=None):
+    """
+    sha1 of src, read once by chunks
+    Parameters:
+    - stage: optional, a path where src is copied at the same time
+    Returns the hex digest, stage is removed if it could not be written completely
+    """
+    digest = hashlib.sha1()
+    with open(src, 'rb') as f:
+        out = open(stage, 'wb') if stage else None
+        try:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+                if out:
+                    out.write(chunk)
+            if out:
+                out.close()
+        except Exception:
+            # read error, source removed, no space left: no partial copy left behind
+            if out:
+                out.close()
+                try:
+                    os.remove(stage)
+                except OSError:
+                    pass
+            raise
+    return digest.hexdigest()
+
+
+FUNCTIONS = {'copy': copy, 'reflink': reflink, 'hardlink': hardlink, 'symlink': symlink, 'move': move}
+
+# what to try when a strategy fails for one file
+FALLBACKS = {'reflink': ['copy'], 'hardlink': ['copy'], 'copy': [], 'symlink': [], 'move': []}
+
+
+def probe(srcdir, destdir):
+    """
+    Find the fastest safe strategy from srcdir to destdir: reflink, else hardlink on the same file system,
+    else copy. The probe files are created in destdir
+    Returns a strategy name
+    """
+    try:
+        if os.stat(srcdir).st_dev != os.stat(destdir).st_dev:
+            return 'copy'
+    except OSError as e:
+        logger.warn("transfer probe failed: %s", e)
+        return 'copy'
+    fd, probe_src = tempfile.mkstemp(prefix='.lycheesync-probe-', dir=destdir)
+    probe_dest = probe_src + '.dest'
+    try:
+        os.write(fd, b'lycheesync')
+        os.close(fd)
+        for strategy in ('reflink', 'hardlink'):
+            try:
+                FUNCTIONS[strategy](probe_src, probe_dest)
+                return strategy
+            except (IOError, OSError) as e:
+                logger.debug("transfer probe: no %s (%s)", strategy, e)
+            finally:
+                if os.path.lexists(probe_dest):
+                    os.remove(probe_dest)
+        return 'copy'
+    finally:
+        os.remove(probe_src)
+
+
+class Transfer:
+
+    """
+    Puts source photos in lychee uploads/big with one strategy
+    (copy, reflink, hardlink, symlink, move, or auto: probed once),
+    falling back to a copy for the files it does not work for
+    """
+
+    def __init__(self, strategy, srcdir, destdir):
+        if strategy == 'auto':
+            strategy = probe(srcdir, destdir)
+            logger.info("transfer strategy: %s", strategy)
+        if strategy not in FUNCTIONS:
+            raise ValueError("unknown transfer strategy: {}".format(strategy))
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        # strategy -> number of transferred files
+        self.counts = {}
+
+    def run(self, src, dest):
+        """
+        Transfer src to dest
+        Returns the strategy used
+        """
+        strategies = [self.strategy] + FALLBACKS[self.strategy]
+        for strategy in strategies:
+            try:
+                FUNCTIONS[strategy](src, dest)
+                break
+            except (IOError, OSError) as e:
+                if strategy == strategies[-1] or e.errno not in FALLBACK_ERRNOS:
+                    raise
+                logger.debug("%s failed for %s (%s), next: %s", strategy, src, e,
+                             strategies[strategies.index(strategy) + 1])
+        with self.lock:
+            self.counts[strategy] = self.counts.get(strategy, 0) + 1
+        return strategy
+
+    def commit(self, staged, src, dest):
+        """
+        Put in place a copy of src staged while computing its checksum (see LycheePhoto)
+        Returns the strategy used: copy
+        """
+        os.rename(staged, dest)
+        shutil.copymode(src, dest)
+        with self.lock:
+            self.counts['copy'] = self.counts.get('copy', 0) + 1
+        return 'copy'
+
+
+_transfers = {}
+_transfers_lock = threading.Lock()
+
+
+def get_transfer(conf):
+    """
+    The Transfer of the conf transfer strategy (default copy, symlink in link mode), probed once per process
+    Returns a Transfer
+    """
+    strategy = conf.get('transfer') or ('symlink' if conf.get('link') else 'copy')
+    destdir = os.path.join(conf['lycheepath'], 'uploads', 'big')
+    key = (strategy, conf['srcdir'], destdir)
+    with _transfers_lock:
+        if key not in _transfers:
+            _transfers[key] = Transfer(strategy, conf['srcdir'], destdir)
+        return _transfers[key]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class WorkerPool:
+
+    """
+    A pool of worker threads running tasks in parallel
+    Each task is submitted with one or more keys (lanes):
+    - tasks sharing a key run one at a time, in submission order
+    - tasks with different keys run in parallel
+    - among runnable tasks, the lowest priority value runs first
+    A task with several keys runs when it is the oldest task of all its lanes
+    """
+
+    def __init__(self, workers=4, name='worker'):
+        self.cond = threading.Condition()
+        # key -> deque of tasks
+        self.lanes = {}
+        # keys of running tasks
+        self.busy = set()
+        # (priority, seq, key) of lanes head tasks
+        self.heap = []
+        self.seq = 0
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.stopped = False
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="{}-{}".format(name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, args=(), keys=(None,), priority=PRIORITY_BULK):
+        """
+        Queue func(*args)
+        Parameters:
+        - keys: the lanes of the task
+        - priority: PRIORITY_INTERACTIVE or PRIORITY_BULK
+        Returns nothing
+        """
+        with self.cond:
+            self.seq += 1
+            task = {'func': func, 'args': args, 'keys': set(keys), 'priority': priority, 'seq': self.seq}
+            for key in task['keys']:
+                lane = self.lanes.setdefault(key, deque())
+                lane.append(task)
+                if len(lane) == 1:
+                    heapq.heappush(self.heap, (priority, task['seq'], key))
+            self.queued += 1
+            self.cond.notify()
+
+    def _runnable(self, task):
+        for key in task['keys']:
+            if key in self.busy or self.lanes[key][0] is not task:
+                return False
+        return True
+
+    def _next(self):
+        """ pop the next runnable task, None if there is none. call with the lock held """
+        while self.heap:
+            priority, seq, key = heapq.heappop(self.heap)
+            lane = self.lanes.get(key)
+            if not lane or lane[0]['seq'] != seq:
+                # stale entry
+                continue
+            task = lane[0]
+            if self._runnable(task):
+                for k in task['keys']:
+                    self.lanes[k].popleft()
+                    self.busy.add(k)
+                return task
+            # blocked: pushed again when its blocking lane moves on
+        return None
+
+    def _release(self, task):
+        """ free the task lanes and schedule their next task. call with the lock held """
+        for key in task['keys']:
+            self.busy.discard(key)
+            lane = self.lanes[key]
+            if lane:
+                heapq.heappush(self.heap, (lane[0]['priority'], lane[0]['seq'], key))
+            else:
+                del self.lanes[key]
+
+    def _work(self):
+        while True:
+            with self.cond:
+                task = self._next()
+                while task is None and not self.stopped:
+                    self.cond.wait()
+                    task = self._next()
+                if task is None:
+                    return
+                self.queued -= 1
+                self.running += 1
+            try:
+                task['func'](*task['args'])
+            except Exception as e:
+                logger.exception(e)
+                with self.cond:
+                    self.failed += 1
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    self.done += 1
+                    self._release(task)
+                    self.cond.notify_all()
+
+    def join(self):
+        """ wait until every submitted task is done """
+        with self.cond:
+            while self.queued or self.running:
+                self.cond.wait()
+
+    def stop(self):
+        """ wait for submitted tasks then stop the workers """
+        self.join()
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: exif date fast path vs dateutil
+usage: python -m tests.standalone.exifdate_bench [nb_dates]
+"""
+from __future__ import print_function
+import random
+import sys
+import time
+
+from dateutil.parser import parse
+
+from lycheesync.utils.exifdate import convert_strdate_to_timestamp
+
+
+def make_dates(nb):
+    dates = []
+    for i in range(nb):
+        dates.append("{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}".format(
+            random.randint(1990, 2016), random.randint(1, 12), random.randint(1, 28),
+            random.randint(0, 23), random.randint(0, 59), random.randint(0, 59)).replace(':', '-', 2))
+    return dates
+
+
+def dateutil_timestamp(value):
+    return time.mktime(parse(value).timetuple())
+
+
+def bench(func, dates):
+    start = time.time()
+    for d in dates:
+        func(d)
+    return time.time() - start
+
+
+def main():
+    nb = 1000000
+    if len(sys.argv) > 1:
+        nb = int(sys.argv[1])
+    dates = make_dates(nb)
+
+    # sanity: both implementations agree
+    for d in dates[:1000]:
+        assert convert_strdate_to_timestamp(d) == dateutil_timestamp(d), d
+
+    fast = bench(convert_strdate_to_timestamp, dates)
+    print("fast path: {} dates in {:.2f}s ({:.2f} us/date)".format(nb, fast, fast * 1e6 / nb))
+
+    # dateutil is far too slow for a million dates, extrapolate from a sample
+    sample = dates[:min(nb, 50000)]
+    slow = bench(dateutil_timestamp, sample) * nb / len(sample)
+    print("dateutil:  {} dates in {:.2f}s ({:.2f} us/date, extrapolated from {})".format(
+        nb, slow, slow * 1e6 / nb, len(sample)))
+    print("speedup: x{:.1f}".format(slow / fast))
+
+
+if __name__ == '__main__':
+    main()
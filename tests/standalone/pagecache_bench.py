@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark: page cache residency of lychee uploads/thumb during a large import, with and without page cache hints
+usage: python -m tests.standalone.pagecache_bench [workdir] [import_size_mb] [nb_thumbs]
+workdir should be on the file system to measure (default: the temp directory)
+Thumbnails are read (warm), then an import (checksum while copying) is run and the share of thumbnail pages
+still in the page cache is measured with mincore. Thumbnails are only evicted when the import is bigger than
+the memory available for the page cache: use an import_size_mb above it (see free -m), or run in a memory
+limited cgroup. The share of imported source and big file pages left in the cache is shown as well
+"""
+from __future__ import print_function
+import ctypes
+import ctypes.util
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lycheesync.utils.pagecache import PageCache
+from lycheesync.utils.transfer import sha1
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+PAGE = mmap.PAGESIZE
+
+
+def resident(path):
+    """ Returns (resident pages, pages) of path """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0, 0
+    pages = (size + PAGE - 1) // PAGE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            vec = (ctypes.c_ubyte * pages)()
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+            return sum(v & 1 for v in vec), pages
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+def residency(paths):
+    total = [0, 0]
+    for p in paths:
+        r, n = resident(p)
+        total[0] += r
+        total[1] += n
+    return 100.0 * total[0] / max(total[1], 1)
+
+
+def listdir(directory):
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory))]
+
+
+def make_files(directory, nb, size):
+    os.makedirs(directory)
+    chunk = os.urandom(size)
+    for i in range(nb):
+        with open(os.path.join(directory, "{:06d}.jpg".format(i)), 'wb') as f:
+            f.write(chunk)
+
+
+def evict(paths):
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run(root, cache):
+    thumbs = listdir(os.path.join(root, 'uploads', 'thumb'))
+    srcdir = os.path.join(root, 'src')
+    big = os.path.join(root, 'uploads', 'big')
+    if os.path.isdir(big):
+        shutil.rmtree(big)
+    os.makedirs(big)
+    sources = listdir(srcdir)
+    evict(sources)
+    # the web server serves the thumbnails
+    for t in thumbs:
+        with open(t, 'rb') as f:
+            f.read()
+    before = residency(thumbs)
+    start = time.time()
+    for name in cache.ahead([os.path.basename(s) for s in sources], srcdir):
+        src = os.path.join(srcdir, name)
+        dest = os.path.join(big, name)
+        staged = dest + '.staged'
+        sha1(src, staged)
+        os.rename(staged, dest)
+        cache.done(src, dest)
+    cache.close()
+    elapsed = time.time() - start
+    return before, residency(thumbs), residency(sources + listdir(big)), elapsed
+
+
+def main():
+    workdir = sys.argv[1] if len(sys.argv) > 1 else None
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    nb_thumbs = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    root = tempfile.mkdtemp(prefix='pagecache-bench-', dir=workdir)
+    try:
+        photo_size = 4 * 1024 * 1024
+        make_files(os.path.join(root, 'src'), max(size * 1024 * 1024 // photo_size, 1), photo_size)
+        make_files(os.path.join(root, 'uploads', 'thumb'), nb_thumbs, 16 * 1024)
+        print("import of {} MB, {} thumbnails in {}".format(size, nb_thumbs, root))
+        print("{:<12} {:>14} {:>13} {:>16} {:>9}".format('hints', 'thumbs before', 'thumbs after', 'imported cached',
+                                                        'time'))
+        for name, cache in (('none', PageCache(readahead=0, drop=False)), ('readahead', PageCache(drop=False)),
+                            ('all', PageCache())):
+            before, after, imported, elapsed = run(root, cache)
+            print("{:<12} {:>13.1f}% {:>12.1f}% {:>15.1f}% {:>8.2f}s".format(name, before, after, imported,
+                                                                              elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
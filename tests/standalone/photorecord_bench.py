@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark: LycheePhoto objects vs PhotoRecord
+usage: python -m tests.standalone.photorecord_bench [nb_photos]
+"""
+from __future__ import print_function
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from lycheesync.lycheemodel import LycheePhoto
+
+
+def build_photos(srcdir, nb, as_record=False):
+    conf = {'lycheepath': srcdir}
+    album = {'path': srcdir, 'id': 1, 'name': 'bench'}
+    names = sorted(f for f in os.listdir(srcdir) if f.lower().endswith('.jpg'))
+    res = []
+    for i in range(nb):
+        photo = LycheePhoto(conf, names[i % len(names)], album)
+        # only the record survives the loop
+        res.append(photo.record() if as_record else photo)
+    return res
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objs = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return objs, size
+
+
+def main():
+    nb = 2000
+    if len(sys.argv) > 1:
+        nb = int(sys.argv[1])
+
+    # LycheePhoto may write exif dimensions in source files: work on a copy
+    tmpdir = tempfile.mkdtemp()
+    srcdir = os.path.join(tmpdir, 'bench')
+    shutil.copytree(os.path.join(os.path.dirname(__file__), '..', 'pics', 'album3'), srcdir)
+    try:
+        photos, photos_size = measure(lambda: build_photos(srcdir, nb))
+        records, records_size = measure(lambda: build_photos(srcdir, nb, as_record=True))
+        print("LycheePhoto: {:.0f} bytes/photo".format(photos_size * 1.0 / nb))
+        print("PhotoRecord: {:.0f} bytes/photo".format(records_size * 1.0 / nb))
+        print("pickle LycheePhoto: {} bytes".format(len(pickle.dumps(photos[0], pickle.HIGHEST_PROTOCOL))))
+        print("pickle PhotoRecord: {} bytes".format(len(pickle.dumps(records[0], pickle.HIGHEST_PROTOCOL))))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark: cold cache import reads, checksum then copy vs checksum while copying
+usage: python -m tests.standalone.singleread_bench [workdir] [nb_files] [file_size_mb]
+workdir should be on the file system to measure (default: the temp directory)
+The page cache is emptied for the source files before each run (posix_fadvise DONTNEED)
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lycheesync.utils.transfer import copy, sha1
+
+
+def make_files(srcdir, nb, size):
+    chunk = os.urandom(1024 * 1024)
+    paths = []
+    for i in range(nb):
+        path = os.path.join(srcdir, "{:05d}.jpg".format(i))
+        with open(path, 'wb') as f:
+            for j in range(size):
+                f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def evict(paths):
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def hash_then_copy(path, dest):
+    checksum = sha1(path)
+    copy(path, dest)
+    return checksum
+
+
+def hash_while_copying(path, dest):
+    return sha1(path, dest)
+
+
+def bench(func, paths, destdir):
+    os.mkdir(destdir)
+    evict(paths)
+    start = time.time()
+    for p in paths:
+        func(p, os.path.join(destdir, os.path.basename(p)))
+    return time.time() - start
+
+
+def main():
+    workdir = sys.argv[1] if len(sys.argv) > 1 else None
+    nb = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    root = tempfile.mkdtemp(prefix='singleread-bench-', dir=workdir)
+    try:
+        srcdir = os.path.join(root, 'src')
+        os.mkdir(srcdir)
+        paths = make_files(srcdir, nb, size)
+        print("{} files of {} MB in {}".format(nb, size, root))
+        for name, func in (('hash then copy', hash_then_copy), ('hash while copying', hash_while_copying)):
+            elapsed = bench(func, paths, os.path.join(root, name.replace(' ', '_')))
+            print("{:<20} {:>8.3f}s {:>8.0f} MB/s".format(name, elapsed, nb * size / max(elapsed, 1e-6)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
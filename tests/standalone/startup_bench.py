@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: import time from cli invocation to the first db query (LycheeDAO creation)
+based on python -X importtime (python >= 3.7)
+usage: python -m tests.standalone.startup_bench [threshold_ms]
+exit code is 1 if the threshold is exceeded or if a heavy dependency is imported
+"""
+from __future__ import print_function
+import subprocess
+import sys
+import time
+
+# everything imported before LycheeSyncer.sync() opens the db connection
+FIRST_QUERY_IMPORTS = ("from lycheesync.sync import main; "
+                       "from lycheesync.lycheesyncer import LycheeSyncer; "
+                       "from lycheesync.lycheedao import LycheeDAO")
+
+# only needed to import photos or to watch the source directory
+HEAVY_MODULES = ['pyexiv2', 'PIL', 'watchdog', 'pathtools', 'dateutil']
+
+
+def importtime(code):
+    """ returns a list of (cumulative us, module name) for top level imports and the wall clock time """
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    res = []
+    for line in out.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        # drop the separator space, nesting is kept as indentation
+        res.append((int(cumulative), name[1:].rstrip()))
+    return res, wall
+
+
+def main():
+    threshold_ms = 250
+    if len(sys.argv) > 1:
+        threshold_ms = int(sys.argv[1])
+
+    imports, wall = importtime(FIRST_QUERY_IMPORTS)
+    # top level imports are not indented
+    total_ms = sum(c for c, name in imports if not name.startswith(' ')) / 1000.0
+
+    print("slowest imports:")
+    for cumulative, name in sorted(imports, reverse=True)[:15]:
+        print("{:>10.1f} ms {}".format(cumulative / 1000.0, name))
+    print("total import time: {:.1f} ms (threshold {} ms)".format(total_ms, threshold_ms))
+    print("process wall time: {:.1f} ms".format(wall * 1000))
+
+    ok = True
+    heavy = [name.strip() for c, name in imports if name.strip().split('.')[0] in HEAVY_MODULES]
+    if heavy:
+        print("heavy modules imported before first db query: {}".format(', '.join(heavy)))
+        ok = False
+    if total_ms > threshold_ms:
+        print("startup regression: {:.1f} ms > {} ms".format(total_ms, threshold_ms))
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
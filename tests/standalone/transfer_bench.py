@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark: transfer strategies from a source directory to a lychee uploads/big like directory
+usage: python -m tests.standalone.transfer_bench [workdir] [nb_files] [file_size_mb]
+workdir should be on the file system to measure (default: the temp directory)
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lycheesync.utils.transfer import STRATEGIES, Transfer, probe
+
+
+def make_files(srcdir, nb, size):
+    chunk = os.urandom(1024 * 1024)
+    paths = []
+    for i in range(nb):
+        path = os.path.join(srcdir, "{:05d}.jpg".format(i))
+        with open(path, 'wb') as f:
+            for j in range(size):
+                f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def bench(strategy, srcdir, paths, destdir):
+    os.mkdir(destdir)
+    t = Transfer(strategy, srcdir, destdir)
+    start = time.time()
+    for p in paths:
+        t.run(p, os.path.join(destdir, os.path.basename(p)))
+    elapsed = time.time() - start
+    return elapsed, t.counts
+
+
+def main():
+    workdir = sys.argv[1] if len(sys.argv) > 1 else None
+    nb = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    root = tempfile.mkdtemp(prefix='transfer-bench-', dir=workdir)
+    try:
+        srcdir = os.path.join(root, 'src')
+        os.mkdir(srcdir)
+        paths = make_files(srcdir, nb, size)
+        print("{} files of {} MB in {}, auto picks: {}".format(nb, size, root, probe(srcdir, root)))
+        print("{:<10} {:>10} {:>10}  {}".format('strategy', 'seconds', 'MB/s', 'used'))
+        for strategy in STRATEGIES:
+            if strategy == 'move':
+                # moves the sources: measured last, on a copy
+                continue
+            elapsed, counts = bench(strategy, srcdir, paths, os.path.join(root, strategy))
+            print("{:<10} {:>10.3f} {:>10.0f}  {}".format(strategy, elapsed, nb * size / max(elapsed, 1e-6), counts))
+        movedir = os.path.join(root, 'tomove')
+        shutil.copytree(srcdir, movedir)
+        moved = [os.path.join(movedir, os.path.basename(p)) for p in paths]
+        elapsed, counts = bench('move', movedir, moved, os.path.join(root, 'move'))
+        print("{:<10} {:>10.3f} {:>10.0f}  {}".format('move', elapsed, nb * size / max(elapsed, 1e-6), counts))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+from lycheesync.lycheesyncer import planAlbumIds, reorderalbumids, sortedWalk
+
+
+class FakeDao(object):
+    def getAlbumMinMaxIds(self):
+        return 10, 20
+
+    def changeAlbumIds(self, id_map):
+        raise AssertionError("planned ids are already sorted")
+
+
+class FakeSyncer(object):
+    def __init__(self, srcdir):
+        self.conf = {'srcdir': srcdir}
+        self.dao = FakeDao()
+
+
+class TestAlbumIds:
+    def test_plan_matches_reorder(self, tmpdir):
+        # repeated album names: the plan and reorderalbumids must break the tie the same way,
+        # a/x/trip is walked before a-b/trip but sorts after it as a path
+        for d in ('a-b/trip', 'a/x/trip', 'c'):
+            tmpdir.join(d).ensure(dir=True)
+        srcdir = str(tmpdir)
+        syncer = FakeSyncer(srcdir)
+        walk = list(sortedWalk(os.walk(srcdir)))
+        plan = planAlbumIds(syncer, walk)
+        assert sorted(plan.values()) == list(range(21, 27))
+        assert plan[os.path.join(srcdir, 'a', 'x', 'trip')] < plan[os.path.join(srcdir, 'a-b', 'trip')]
+        # albums as the import records them, in walk order
+        albums = [{'id': plan[root], 'name': os.path.basename(root)} for root, dirs, files in walk if root != srcdir]
+        assert not reorderalbumids(syncer, albums)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import socket
+from lycheesync.lycheedaemon import STARTUP_KEYS, sendCommand, startServer
+from lycheesync.utils.boilerplatecode import reload_conf
+from lycheesync.utils.configuration import ConfBorg
+
+
+class FakeDaemon(object):
+    def __init__(self):
+        self.commands = []
+
+    def command(self, name):
+        self.commands.append(name)
+        return {'ok': True, 'command': name}
+
+
+class TestCommands:
+    def test_roundtrip(self, tmpdir):
+        path = str(tmpdir.join('sync.sock'))
+        daemon = FakeDaemon()
+        server = startServer(path, daemon)
+        try:
+            assert sendCommand(path, 'status') == {'ok': True, 'command': 'status'}
+            assert sendCommand(path, 'sync-now') == {'ok': True, 'command': 'sync-now'}
+            assert daemon.commands == ['status', 'sync-now']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stale_socket_is_replaced(self, tmpdir):
+        path = str(tmpdir.join('sync.sock'))
+        # left by a dead daemon
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        dead.bind(path)
+        dead.close()
+        server = startServer(path, FakeDaemon())
+        try:
+            assert sendCommand(path, 'status')['ok']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestReload:
+    def test_startup_keys_are_kept(self, tmpdir, monkeypatch):
+        path = tmpdir.join('conf.json')
+        path.write(json.dumps({'daemonInterval': 60, 'pageCacheReadahead': 4, 'watchWorkers': 8, 'dbHost': 'db2',
+                               'verbose': True}))
+        conf = {'confpath': str(path), 'daemonInterval': 3600, 'pageCacheReadahead': 2, 'watchWorkers': 4,
+                'dbHost': 'db1', 'verbose': False, 'cli_keys': ['cli_keys', 'verbose']}
+        monkeypatch.setattr(ConfBorg, '_shared_state', {'confdic': conf, 'isinitialized': True})
+        changed, ignored = reload_conf(STARTUP_KEYS)
+        assert changed == ['daemonInterval', 'pageCacheReadahead']
+        assert ignored == ['dbHost', 'watchWorkers']
+        assert conf['daemonInterval'] == 60 and conf['pageCacheReadahead'] == 4
+        assert conf['watchWorkers'] == 4 and conf['dbHost'] == 'db1'
+        assert not conf['verbose'], "cli args keep their priority"
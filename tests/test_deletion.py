@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+from lycheesync.utils.deletion import DeletionService, photoFiles
+
+
+def make_lychee(tmpdir, urls):
+    lychee = str(tmpdir)
+    for sub in ('big', 'thumb'):
+        os.makedirs(os.path.join(lychee, 'uploads', sub))
+    for url in urls:
+        for path in photoFiles(lychee, url):
+            with open(path, 'wb') as f:
+                f.write(b'photo')
+    return lychee
+
+
+def remaining(lychee):
+    return sorted(os.listdir(os.path.join(lychee, 'uploads', 'big')) +
+                  os.listdir(os.path.join(lychee, 'uploads', 'thumb')))
+
+
+class TestDeletionService:
+    def test_delete(self, tmpdir):
+        urls = ["{:04d}.jpg".format(i) for i in range(600)]
+        lychee = make_lychee(tmpdir, urls + ['kept.jpg'])
+        service = DeletionService(lychee, workers=4)
+        counts = service.delete(urls + urls[:10] + ['missing.jpg'])
+        assert counts == {'removed': 1800, 'missing': 3, 'failed': 0}
+        assert remaining(lychee) == ['kept.jpg', 'kept.jpg', 'kept@2x.jpg']
+        service.close()
+
+    def test_failures_are_counted(self, tmpdir):
+        lychee = make_lychee(tmpdir, ['a.jpg'])
+        os.remove(os.path.join(lychee, 'uploads', 'big', 'a.jpg'))
+        # a directory can't be removed as a file
+        os.mkdir(os.path.join(lychee, 'uploads', 'big', 'a.jpg'))
+        service = DeletionService(lychee)
+        assert service.delete(['a.jpg']) == {'removed': 2, 'missing': 0, 'failed': 1}
+        service.close()
+        assert service.counts['failed'] == 1
+
+    def test_unexpected_error(self, tmpdir, monkeypatch):
+        lychee = make_lychee(tmpdir, ['a.jpg', 'b.jpg'])
+        remove = os.remove
+
+        def failing(path):
+            if os.path.basename(path) == 'a.jpg':
+                raise ValueError("not an OSError")
+            remove(path)
+        monkeypatch.setattr(os, 'remove', failing)
+        service = DeletionService(lychee, workers=2)
+        counts = service.delete(['a.jpg', 'b.jpg'])
+        service.close()
+        # returns: the rest of the failed chunk is counted as failed
+        assert counts['failed'] >= 1 and sum(counts.values()) == 6
+
+    def test_trash(self, tmpdir):
+        urls = ['a.jpg', 'b.jpg']
+        lychee = make_lychee(tmpdir, urls)
+        trash = os.path.join(lychee, 'uploads', '.trash')
+        # left by a previous run
+        os.makedirs(os.path.join(trash, 'old', 'big'))
+        service = DeletionService(lychee, trash=True)
+        assert service.delete(urls)['removed'] == 6
+        assert remaining(lychee) == []
+        service.close()
+        assert os.listdir(trash) == []
+        assert service.counts['purged'] == 6
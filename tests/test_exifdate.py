@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import datetime
+import time
+from lycheesync.utils.exifdate import parse_exif_date, parse_date, convert_strdate_to_timestamp
+
+
+class TestExifDate:
+    def test_exif_format(self):
+        expected = datetime.datetime(2011, 11, 11, 11, 11, 11)
+        assert parse_exif_date("2011-11-11 11:11:11") == expected
+        assert parse_exif_date("2011:11:11 11:11:11") == expected
+
+    def test_fast_path_rejects_odd_values(self):
+        assert parse_exif_date("2011-11-11") is None
+        assert parse_exif_date("2011-11:11 11:11:11") is None
+        assert parse_exif_date("2011-13-11 11:11:11") is None
+        assert parse_exif_date("0000:00:00 00:00:00") is None
+
+    def test_fallback(self):
+        assert parse_date("11 Nov 2011 11:11") == datetime.datetime(2011, 11, 11, 11, 11)
+
+    def test_timestamp(self):
+        ts = convert_strdate_to_timestamp("2011-11-11 11:11:11")
+        assert datetime.datetime.fromtimestamp(ts) == datetime.datetime(2011, 11, 11, 11, 11, 11)
+        assert convert_strdate_to_timestamp(42) == 42
+
+    def test_timestamp_defaults_to_now(self):
+        before = int(time.time())
+        assert before <= convert_strdate_to_timestamp(None) <= time.time()
+        assert before <= convert_strdate_to_timestamp("not a date") <= time.time()
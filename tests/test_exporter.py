@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import io
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileSystemEventHandler
+from lycheesync.lycheewatcher import EventAggregator
+from lycheesync.utils.exporter import Exporter, Histogram
+
+
+def sample(text, line):
+    """ value of the sample line starting with line """
+    for l in text.splitlines():
+        if l.startswith(line + " "):
+            return float(l.rpartition(" ")[2])
+    return None
+
+
+class TestExporter:
+    def test_histogram_buckets_are_cumulative(self):
+        h = Histogram((0.1, 1))
+        for v in (0.05, 0.5, 0.7, 3):
+            h.observe(v)
+        assert [value for name, labels, value in h.samples('d', ())] == [1, 3, 4, 4.25, 4]
+
+    def test_render(self):
+        exporter = Exporter()
+        exporter.imported(True)
+        exporter.imported(False)
+        exporter.observeQuery("select 1", 0.001, 1)
+        exporter.observeQuery("select 1", 0.001, None)
+        exporter.observeReconnect()
+        exporter.observeStage('thumbnail "big"', 0.3)
+        text = exporter.render()
+        assert "# TYPE lycheesync_stage_duration_seconds histogram" in text
+        assert sample(text, 'lycheesync_stage_duration_seconds_bucket{stage="thumbnail \\"big\\"",le="0.25"}') == 0
+        assert sample(text, 'lycheesync_stage_duration_seconds_bucket{stage="thumbnail \\"big\\"",le="0.5"}') == 1
+        assert sample(text, 'lycheesync_photos_imported_total') == 1
+        assert sample(text, 'lycheesync_photo_import_failures_total') == 1
+        assert sample(text, 'lycheesync_db_queries_total') == 2
+        assert sample(text, 'lycheesync_db_errors_total') == 1
+        assert sample(text, 'lycheesync_db_reconnects_total') == 1
+        assert sample(text, 'lycheesync_last_import_timestamp_seconds') >= exporter.started
+
+    def test_watch_gauges(self):
+        exporter = Exporter()
+        agg = EventAggregator(FileSystemEventHandler(), quiet_window=3600)
+        exporter.watch(agg)
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        for i in range(3):
+            agg.dispatch(FileModifiedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileCreatedEvent('/src/a/q.jpg'))
+        agg.dispatch(FileDeletedEvent('/src/a/q.jpg'))
+        text = exporter.render()
+        assert sample(text, 'lycheesync_watch_events_received_total') == 6
+        assert sample(text, 'lycheesync_watch_events_coalesced_total') == 5
+        assert sample(text, 'lycheesync_watch_pending_paths') == 1
+
+    def test_http_and_textfile(self, tmpdir):
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        exporter = Exporter()
+        exporter.imported(True)
+        server = exporter.listen('127.0.0.1', 0)
+        try:
+            body = urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1]), timeout=5).read()
+        finally:
+            exporter.close()
+        assert sample(body.decode('utf-8'), 'lycheesync_photos_imported_total') == 1
+        path = str(tmpdir.join('textfile', 'lycheesync.prom'))
+        exporter.writeTextfile(path)
+        with io.open(path, encoding='utf-8') as f:
+            assert sample(f.read(), 'lycheesync_photos_imported_total') == 1
+        assert tmpdir.join('textfile').listdir() == [tmpdir.join('textfile', 'lycheesync.prom')]
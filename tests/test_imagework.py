@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import pytest
+from lycheesync.utils import imagework
+
+
+class TestRotate:
+    def test_orientation_is_reset_once_applied(self, tmpdir):
+        pyexiv2 = pytest.importorskip('pyexiv2')
+        from PIL import Image
+        path = str(tmpdir.join('p.jpg'))
+        img = Image.new('RGB', (40, 20), (250, 0, 0))
+        img.paste((0, 0, 250), (20, 0, 40, 20))
+        img.save(path, quality=99)
+        metadata = pyexiv2.ImageMetadata(path)
+        metadata.read()
+        metadata['Exif.Image.Orientation'] = 3
+        metadata.write()
+
+        assert imagework.rotate(path, 'p.jpg') == 3
+
+        metadata = pyexiv2.ImageMetadata(path)
+        metadata.read()
+        assert metadata['Exif.Image.Orientation'].value == 1
+        img = Image.open(path)
+        # rotated 180: blue on the left
+        assert img.size == (40, 20)
+        r, g, b = img.getpixel((5, 10))
+        assert b > 200 and r < 50
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import pytest
+from lycheesync.utils.metrics import Metrics, instrument, percentile
+
+
+class TestMetrics:
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile(values, 99) == 99
+        assert percentile([7], 99) == 7
+        assert percentile([], 50) is None
+
+    def test_stages(self):
+        metrics = Metrics()
+        for i in range(1, 101):
+            metrics.record('copy', i / 1000.0, nbytes=10)
+        with pytest.raises(ValueError):
+            with metrics.timed('hash'):
+                raise ValueError()
+        stages = metrics.summary()['stages']
+        assert stages['copy']['count'] == 100
+        assert stages['copy']['bytes'] == 1000
+        assert stages['copy']['p95'] == pytest.approx(0.095)
+        assert stages['hash']['errors'] == 1
+        table = metrics.table()
+        assert 'copy' in table and 'hash' in table
+
+    def test_timed_iter(self):
+        metrics = Metrics()
+        assert list(metrics.timedIter('walk', iter('abc'))) == ['a', 'b', 'c']
+        assert metrics.summary()['stages']['walk']['count'] == 3
+
+    def test_report(self, tmpdir):
+        metrics = Metrics()
+        metrics.record('exif', 0.01)
+        path = str(tmpdir.join('logs', 'report.json'))
+        metrics.writeReport(path, {'imported': 1})
+        with open(path) as f:
+            report = json.load(f)
+        assert report['imported'] == 1
+        assert report['stages']['exif']['count'] == 1
+
+    def test_instrument(self):
+        class Dao:
+            def get(self, x):
+                return x
+
+            def _private(self):
+                return 1
+        instrument(Dao, 'dao')
+        from lycheesync.utils.metrics import get_metrics
+        before = get_metrics().summary()['stages'].get('dao.get', {}).get('count', 0)
+        assert Dao().get(3) == 3
+        assert get_metrics().summary()['stages']['dao.get']['count'] == before + 1
+        assert 'dao._private' not in get_metrics().summary()['stages']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+from lycheesync.utils import pagecache
+from lycheesync.utils.pagecache import DONTNEED, PageCache, WILLNEED
+
+
+def record(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pagecache, 'advise', lambda path, advice, sync=False: calls.append((advice, path)) or True)
+    return calls
+
+
+class TestPageCache:
+    def test_ahead(self, monkeypatch):
+        calls = record(monkeypatch)
+        cache = PageCache(readahead=2)
+        it = cache.ahead(['a', 'b', 'c', 'd'], 'dir')
+        assert next(it) == 'a'
+        assert calls == [(WILLNEED, os.path.join('dir', n)) for n in 'abc']
+        assert list(it) == ['b', 'c', 'd']
+        assert cache.prefetched == 4
+
+    def test_no_readahead(self, monkeypatch):
+        calls = record(monkeypatch)
+        assert list(PageCache(readahead=0).ahead(['a', 'b'])) == ['a', 'b']
+        assert calls == []
+
+    def test_done_drops_big_files_later(self, monkeypatch):
+        calls = record(monkeypatch)
+        cache = PageCache(lag=1)
+        cache.done('src1', 'big1')
+        assert calls == [(DONTNEED, 'src1')]
+        cache.done('src2', 'big2')
+        assert calls[1:] == [(DONTNEED, 'src2'), (DONTNEED, 'big1')]
+        cache.done('src3')
+        cache.close()
+        assert calls[3:] == [(DONTNEED, 'src3'), (DONTNEED, 'big2')]
+        assert cache.dropped == 5
+
+    def test_drop_disabled(self, monkeypatch):
+        calls = record(monkeypatch)
+        cache = PageCache(drop=False)
+        cache.done('src', 'big')
+        cache.close()
+        assert calls == []
+
+    def test_advise(self, tmpdir):
+        path = tmpdir.join('p.jpg')
+        path.write_binary(b'photo')
+        assert pagecache.advise(str(path), DONTNEED) == hasattr(os, 'posix_fadvise')
+        assert not pagecache.advise(str(tmpdir.join('missing.jpg')), DONTNEED)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import threading
+import pytest
+from lycheesync.utils.photoid import ClockSkewError, PhotoIdAllocator
+
+
+class FakeClock(object):
+    def __init__(self, now=1500000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestPhotoId:
+    def test_format(self):
+        clock = FakeClock()
+        allocator = PhotoIdAllocator(worker=2, clock=clock, sleep=clock.sleep)
+        # the creation second is skipped
+        assert allocator.next() == '15000000012000'
+        assert allocator.next() == '15000000012001'
+        clock.now += 1
+        assert allocator.next() == '15000000022000'
+
+    def test_restart_within_the_same_second(self):
+        clock = FakeClock()
+        first = PhotoIdAllocator(worker=0, clock=clock, sleep=clock.sleep)
+        ids = set(first.next() for i in range(10))
+        # restarted during the second of its last ids
+        second = PhotoIdAllocator(worker=0, clock=clock, sleep=clock.sleep)
+        ids.update(second.next() for i in range(10))
+        assert len(ids) == 20
+
+    def test_waits_without_the_lock(self):
+        clock = FakeClock()
+        allocator = PhotoIdAllocator(worker=0, clock=clock)
+        held = []
+        allocator.sleep = lambda seconds: (held.append(allocator.lock.locked()), clock.sleep(seconds))
+        allocator.next()
+        assert held and not any(held)
+
+    def test_unique_across_threads(self):
+        clock = FakeClock()
+        allocator = PhotoIdAllocator(worker=0, clock=clock, sleep=clock.sleep)
+        ids = []
+
+        def allocate():
+            ids.extend([allocator.next() for i in range(2000)])
+        threads = [threading.Thread(target=allocate) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(ids)) == len(ids) == 16000
+        assert all(len(i) == 14 for i in ids)
+        # 1000 ids per second: waited for the next seconds
+        assert int(clock.now) >= 1500000016
+
+    def test_workers_do_not_collide(self):
+        clock = FakeClock()
+        ids = set()
+        for worker in range(10):
+            allocator = PhotoIdAllocator(worker=worker, clock=clock, sleep=clock.sleep)
+            ids.update(allocator.next() for i in range(100))
+        assert len(ids) == 1000
+
+    def test_clock_skew(self):
+        clock = FakeClock()
+        allocator = PhotoIdAllocator(max_skew=5, clock=clock, sleep=clock.sleep)
+        first = allocator.next()
+        clock.now -= 3
+        # tolerated: still the last second
+        assert allocator.next() == first[:10] + '0001'
+        clock.now -= 10
+        with pytest.raises(ClockSkewError):
+            allocator.next()
+
+    def test_invalid_worker(self):
+        with pytest.raises(ValueError):
+            PhotoIdAllocator(worker=10, worker_digits=1)
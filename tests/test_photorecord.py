@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from lycheesync.lycheedao import LycheeDAO
+from lycheesync.lycheemodel import ExifData, LycheePhoto, PhotoRecord
+
+
+class RecordingCursor(object):
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, query, args=None):
+        self.db.executed.append((query, args))
+        return 1
+
+
+class RecordingDb(object):
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        pass
+
+
+def make_photo():
+    """ a LycheePhoto with a distinct value per field, no file involved """
+    photo = LycheePhoto.__new__(LycheePhoto)
+    photo.id = '15000000001'
+    photo.url = 'abc.jpg'
+    photo.type = 'image/jpeg'
+    photo.width = 640.0
+    photo.height = 480.0
+    photo.size = '1.2 MB'
+    photo.star = 3
+    photo.thumbUrl = 'abc-thumb.jpg'
+    photo.albumid = 42
+    photo._epoch_sysdate = 1300000000.5
+    photo.exif = ExifData()
+    photo.exif.iso = '100'
+    photo.exif.aperture = 'F2.8'
+    photo.exif.make = 'Canon'
+    photo.exif.model = 'EOS'
+    photo.exif.shutter = '1/60 s'
+    photo.exif.focal = '35 mm'
+    photo.description = 'desc'
+    photo.originalname = 'p.jpg'
+    photo.checksum = 'sha'
+    photo.tags = 'tag'
+    return photo
+
+
+class TestPhotoRecord:
+    def test_fields(self):
+        record = make_photo().record()
+        assert list(record) == ['15000000001', 'abc.jpg', 'image/jpeg', 640, 480, '1.2 MB', 3, 'abc-thumb.jpg', 42,
+                                1300000000, '100', 'F2.8', 'Canon', 'EOS', '1/60 s', '35 mm', 'desc', 'p.jpg',
+                                'sha', 'tag']
+        assert list(record) == [getattr(record, f) for f in PhotoRecord._fields]
+
+    def test_insert_columns(self):
+        dao = LycheeDAO.__new__(LycheeDAO)
+        dao.conf = {'publicAlbum': 7}
+        dao.db = RecordingDb()
+        assert dao.addFileToAlbum(make_photo().record())
+        query, args = dao.db.executed[0]
+        columns = query[query.index('(') + 1:query.index(')')].split(',')
+        values = query[query.rindex('(') + 1:query.rindex(')')] % tuple("'{}'".format(a) for a in args)
+        row = dict((c.strip(), v.strip().strip("'")) for c, v in zip(columns, values.split(',')))
+        assert len(columns) == len(values.split(','))
+        assert row == {'id': '15000000001', 'url': 'abc.jpg', 'public': '7', 'type': 'image/jpeg', 'width': '640',
+                       'height': '480', 'size': '1.2 MB', 'star': '3', 'thumbUrl': 'abc-thumb.jpg', 'album': '42',
+                       'iso': '100', 'aperture': 'F2.8', 'make': 'Canon', 'model': 'EOS', 'shutter': '1/60 s',
+                       'focal': '35 mm', 'takestamp': '1300000000', 'description': 'desc', 'title': 'p.jpg',
+                       'checksum': 'sha', 'tags': 'tag'}
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import threading
+import time
+from lycheesync.utils import profiling
+from lycheesync.utils.sandbox import ImageSandbox
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def run_profiled(mode, directory):
+    profiling.start(mode, str(directory))
+    try:
+        busy(0.05)
+
+        def work():
+            with profiling.thread():
+                busy(0.05)
+        t = threading.Thread(target=work, name='watch-0')
+        t.start()
+        t.join()
+        sandbox = ImageSandbox(workers=1, profile=profiling.workerProfile())
+        assert sandbox.run(abs, -1) == 1
+        sandbox.close()
+    finally:
+        profiling.stop()
+    return [str(directory.join(f)) for f in os.listdir(str(directory))]
+
+
+class TestProfiling:
+    def test_cprofile(self, tmpdir):
+        import pstats
+        files = run_profiled('cprofile', tmpdir)
+        assert len(files) == 1 and files[0].endswith('.pstats'), "worker profile merged and removed"
+        stats = dict((f[2], v) for f, v in pstats.Stats(files[0]).stats.items())
+        assert stats['busy'][0] == 2, "main thread and worker thread"
+        assert '<built-in method builtins.abs>' in stats, "image worker process"
+
+    def test_sampling(self, tmpdir):
+        files = run_profiled('sampling', tmpdir)
+        assert len(files) == 1 and files[0].endswith('.collapsed')
+        with open(files[0]) as f:
+            stacks = [line.rpartition(' ')[0] for line in f]
+        assert any(s.startswith('watch;') and s.endswith(':busy') for s in stacks)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from lycheesync.utils.querystats import QueryStats, fingerprint
+
+
+class TestFingerprint:
+    def test_literals(self):
+        assert fingerprint("select * from lychee_photos where id=12") == "select * from lychee_photos where id=?"
+        assert fingerprint("SELECT id FROM lychee_photos\n  WHERE title='it''s' AND album=%s;") == \
+            "select id from lychee_photos where title=? and album=?"
+
+    def test_lists(self):
+        assert fingerprint("select title from lychee_albums where id in (1, 2, 3)") == \
+            fingerprint("select title from lychee_albums where id in (4,5)") == \
+            "select title from lychee_albums where id in (?+)"
+
+
+class TestQueryStats:
+    def test_statements(self):
+        stats = QueryStats()
+        stats.observeQuery("select * from lychee_photos where id=%s", 0.002, 1)
+        stats.observeQuery("select * from lychee_photos where id=%s", 0.004, 0)
+        stats.observeQuery("update lychee_albums set title=%s", 0.010, 3)
+        stats.observeCommit()
+        top = stats.top()
+        assert top[0][0] == "update lychee_albums set title=?"
+        assert top[1][1]['calls'] == 2 and top[1][1]['rows'] == 1
+        assert "3 queries (2 shapes), 0.02s, 1 commits" in stats.table()
+
+    def test_n_plus_one(self):
+        stats = QueryStats({'album': 3})
+        for album in ('a', 'b'):
+            stats.enter('album', album)
+            for i in range(4 if album == 'a' else 2):
+                stats.observeQuery("select * from lychee_photos where album=%s and title=%s", 0.001)
+            stats.observeQuery("select * from lychee_albums where id=%s", 0.001)
+        stats.leave()
+        assert stats.flagged == {('album', "select * from lychee_photos where album=? and title=?"): 4}
+        assert "N+1 per album (up to 4 calls, limit 3)" in stats.table()
+
+    def test_scopes_are_per_thread(self):
+        import threading
+        stats = QueryStats({'photo': 1})
+        stats.enter('photo', 'p.jpg')
+        t = threading.Thread(target=lambda: [stats.observeQuery("select 1", 0) for i in range(3)])
+        t.start()
+        t.join()
+        stats.leave('photo')
+        assert stats.flagged == {}
+
+    def test_left_scope_counts_nothing(self):
+        stats = QueryStats({'photo': 1})
+        stats.enter('photo', 'p.jpg')
+        stats.observeQuery("select * from lychee_photos where id=%s", 0.001)
+        stats.leave('photo')
+        # album deletion handled next by the same thread
+        for i in range(3):
+            stats.observeQuery("delete from lychee_photos where id=%s", 0.001)
+        stats.enter('photo', 'q.jpg')
+        stats.leave()
+        assert stats.flagged == {}
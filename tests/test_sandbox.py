@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import time
+import pytest
+from lycheesync.utils import imagework
+from lycheesync.utils.sandbox import ImageSandbox, ImageTaskError, Quarantine
+
+
+@pytest.fixture
+def sandbox():
+    sandbox = ImageSandbox(workers=1, timeout=5, max_pixels=1000, memory_mb=512)
+    yield sandbox
+    sandbox.close()
+
+
+def make_image(path, size):
+    from PIL import Image
+    Image.new('RGB', size, (200, 10, 10)).save(path)
+    return path
+
+
+class TestImageSandbox:
+    def test_thumbnail(self, sandbox, tmpdir):
+        src = make_image(str(tmpdir.join('p.png')), (30, 20))
+        dest = str(tmpdir.join('t.png'))
+        assert sandbox.run(imagework.thumbnail, src, (5, 0, 25, 20), (10, 10), dest) == dest
+        from PIL import Image
+        assert Image.open(dest).size == (10, 10)
+
+    def test_max_pixels(self, sandbox, tmpdir):
+        src = make_image(str(tmpdir.join('bomb.png')), (100, 100))
+        with pytest.raises(ImageTaskError) as e:
+            sandbox.run(imagework.thumbnail, src, (0, 0, 100, 100), (10, 10), str(tmpdir.join('t.png')))
+        assert 'pixels' in e.value.reason
+
+    def test_timeout_replaces_the_worker(self, sandbox):
+        sandbox.timeout = 0.5
+        start = time.time()
+        with pytest.raises(ImageTaskError) as e:
+            sandbox.run(time.sleep, 30)
+        assert 'timeout' in e.value.reason
+        assert time.time() - start < 10
+        assert sandbox.killed == 1
+        assert sandbox.run(abs, -3) == 3
+
+    def test_memory_limit(self, sandbox):
+        with pytest.raises(ImageTaskError) as e:
+            sandbox.run(bytearray, 2 * 1024 ** 3)
+        assert 'memory' in e.value.reason
+        assert sandbox.run(abs, -1) == 1
+
+    def test_crash(self, sandbox):
+        with pytest.raises(ImageTaskError) as e:
+            sandbox.run(os._exit, 3)
+        assert 'exit code 3' in e.value.reason
+
+    def test_idle_worker_died(self, sandbox):
+        assert sandbox.run(abs, -1) == 1
+        worker = sandbox.idle[0]
+        worker.process.terminate()
+        worker.process.join(5)
+        assert sandbox.run(abs, -2) == 2
+        assert sandbox.killed == 1 and worker not in sandbox.idle
+
+    def test_in_process(self):
+        assert ImageSandbox(workers=0).run(abs, -2) == 2
+
+
+class TestQuarantine:
+    def test_until_modified(self, tmpdir):
+        src = tmpdir.join('p.jpg')
+        src.write_binary(b'bad')
+        path = str(tmpdir.join('logs', 'quarantine.json'))
+        quarantine = Quarantine(path)
+        quarantine.add(str(src), "timeout after 60s")
+        assert quarantine.contains(str(src))
+        # kept between runs
+        assert Quarantine(path).contains(str(src))
+        src.write_binary(b'fixed photo')
+        assert not quarantine.contains(str(src))
+        assert not Quarantine(path).contains(str(src))
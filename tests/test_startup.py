@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import subprocess
+import sys
+
+
+class TestStartup:
+    def test_no_heavy_import_before_first_query(self):
+        """ photo and watch dependencies should only be imported by the code paths needing them """
+        code = ("import sys; "
+                "from lycheesync.sync import main; "
+                "from lycheesync.lycheesyncer import LycheeSyncer; "
+                "heavy = ['pyexiv2', 'PIL', 'watchdog', 'pathtools', 'dateutil']; "
+                "print(','.join(m for m in heavy if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.decode('utf-8').strip() == '', "heavy modules imported at startup"
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from lycheesync.utils.throttle import Throttle, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket:
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, clock=clock.time, sleep=clock.sleep)
+        for i in range(6):
+            bucket.take()
+        # 2 in the burst, then one every half second
+        assert clock.slept == [0.5] * 4
+
+    def test_debt(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock.time, sleep=clock.sleep)
+        assert bucket.take(30) == 2.0
+        assert bucket.take(5) == 0.5
+
+    def test_idle_refill_is_capped(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1, burst=2, clock=clock.time, sleep=clock.sleep)
+        clock.now += 100
+        for i in range(3):
+            bucket.take()
+        assert clock.slept == [1.0]
+
+
+class TestThrottle:
+    def test_backoff(self):
+        clock = FakeClock()
+        throttle = Throttle({'throttleDbLatency': 50}, clock=clock.time, sleep=clock.sleep)
+        throttle.observeQuery("select 1", 0.2)
+        assert throttle.scale == 0.5 and throttle.photos.scale == 0.5
+        # adjusted at most once per second
+        throttle.observeQuery("select 1", 0.2)
+        assert throttle.scale == 0.5
+        clock.now += 1
+        throttle.observeQuery("select 1", 0.2)
+        assert throttle.scale == 0.25
+        for i in range(40):
+            clock.now += 1
+            throttle.observeQuery("select 1", 0.001)
+        assert throttle.scale == 1.0
+
+    def test_disabled(self):
+        throttle = Throttle({'throttleReadMBps': 0, 'throttlePhotosPerSecond': 0, 'throttleDbLatency': 0,
+                             'throttleWorkers': 0})
+        assert throttle.bytes is None and throttle.photos is None
+        throttle.observeQuery("select 1", 10)
+        assert throttle.scale == 1.0
+        assert throttle.limitWorkers(4) == 4
+        assert Throttle({}).limitWorkers(4) == 1
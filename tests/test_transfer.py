@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import errno
+import os
+import pytest
+from lycheesync.utils import transfer
+from lycheesync.utils.transfer import Transfer, probe
+
+
+def make_source(tmpdir):
+    src = tmpdir.mkdir('src').join('p.jpg')
+    src.write_binary(b'photo' * 1000)
+    return str(src), str(tmpdir.mkdir('big'))
+
+
+class TestTransfer:
+    def test_strategies(self, tmpdir):
+        src, big = make_source(tmpdir)
+        for strategy in ('copy', 'hardlink', 'symlink'):
+            dest = os.path.join(big, strategy + '.jpg')
+            Transfer(strategy, os.path.dirname(src), big).run(src, dest)
+            with open(dest, 'rb') as f:
+                assert f.read() == b'photo' * 1000
+        assert os.stat(os.path.join(big, 'hardlink.jpg')).st_ino == os.stat(src).st_ino
+        assert os.path.islink(os.path.join(big, 'symlink.jpg'))
+        assert not os.path.islink(os.path.join(big, 'copy.jpg'))
+
+    def test_move(self, tmpdir):
+        src, big = make_source(tmpdir)
+        dest = os.path.join(big, 'p.jpg')
+        Transfer('move', os.path.dirname(src), big).run(src, dest)
+        assert os.path.exists(dest) and not os.path.exists(src)
+
+    def test_probe(self, tmpdir):
+        src, big = make_source(tmpdir)
+        assert probe(os.path.dirname(src), big) in ('reflink', 'hardlink')
+        assert os.listdir(big) == [], "probe files are removed"
+
+    def test_fallback_to_copy(self, tmpdir, monkeypatch):
+        src, big = make_source(tmpdir)
+
+        def cross_device(src, dest):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        monkeypatch.setitem(transfer.FUNCTIONS, 'hardlink', cross_device)
+        t = Transfer('hardlink', os.path.dirname(src), big)
+        assert t.run(src, os.path.join(big, 'p.jpg')) == 'copy'
+        assert t.counts == {'copy': 1}
+
+    def test_sha1_stage(self, tmpdir):
+        src, big = make_source(tmpdir)
+        staged = os.path.join(big, '.staged-p.jpg')
+        checksum = transfer.sha1(src, staged)
+        assert checksum == transfer.sha1(src)
+        dest = os.path.join(big, 'p.jpg')
+        assert Transfer('copy', os.path.dirname(src), big).commit(staged, src, dest) == 'copy'
+        with open(dest, 'rb') as f:
+            assert f.read() == b'photo' * 1000
+        assert not os.path.exists(staged)
+
+    def test_sha1_stage_failed(self, tmpdir, monkeypatch):
+        src, big = make_source(tmpdir)
+        staged = os.path.join(big, '.staged-p.jpg')
+
+        class FailingDigest:
+            def update(self, chunk):
+                raise IOError(errno.EIO, "Input/output error")
+        monkeypatch.setattr(transfer.hashlib, 'sha1', FailingDigest)
+        with pytest.raises(IOError):
+            transfer.sha1(src, staged)
+        assert not os.path.exists(staged), "no partial copy is left"
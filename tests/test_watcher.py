@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import threading
+import time
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, DirMovedEvent, FileCreatedEvent, FileDeletedEvent
+from watchdog.events import FileModifiedEvent, FileMovedEvent, FileSystemEventHandler
+from lycheesync.lycheewatcher import AlbumResolver, EventAggregator, PhotoTitles, ScandirObserver, reconcile
+from lycheesync.utils.eventjournal import EventJournal
+from lycheesync.utils.fingerprints import FingerprintStore
+from lycheesync.utils.workerpool import WorkerPool, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+class RecordingHandler(FileSystemEventHandler):
+    def __init__(self):
+        self.events = []
+
+    def on_any_event(self, event):
+        self.events.append((event.event_type, event.src_path, getattr(event, 'dest_path', None) or None))
+
+
+class ClosedEvent(object):
+    """ close after write event, watchdog >= 2 only """
+    event_type = 'closed'
+    is_directory = False
+
+    def __init__(self, src_path):
+        self.src_path = src_path
+
+
+def make_aggregator(journal=None, max_pending=100000):
+    handler = RecordingHandler()
+    return EventAggregator(handler, quiet_window=3600, journal=journal, max_pending=max_pending), handler
+
+
+class TestEventAggregator:
+    def test_create_and_modify_is_one_import(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        for i in range(10):
+            agg.dispatch(FileModifiedEvent('/src/a/p.jpg'))
+        assert agg.flush() == 0, "quiet window not elapsed"
+        assert agg.flush(force=True) == 1
+        assert handler.events == [('created', '/src/a/p.jpg', None)]
+
+    def test_created_directory_deleted_with_its_content(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(DirCreatedEvent('/src/a/new'))
+        agg.dispatch(FileCreatedEvent('/src/a/new/p.jpg'))
+        agg.dispatch(FileMovedEvent('/src/b/q.jpg', '/src/a/new/q.jpg'))
+        agg.dispatch(DirDeletedEvent('/src/a/new'))
+        assert agg.flush(force=True) == 1
+        assert handler.events == [('deleted', '/src/b/q.jpg', None)]
+
+    def test_create_then_delete_is_nothing(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileDeletedEvent('/src/a/p.jpg'))
+        assert agg.flush(force=True) == 0
+
+    def test_delete_then_create_is_modify(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(FileDeletedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.flush(force=True)
+        assert handler.events == [('modified', '/src/a/p.jpg', None)]
+
+    def test_upload_to_temporary_file(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(FileCreatedEvent('/src/a/.p.jpg.tmp'))
+        agg.dispatch(FileModifiedEvent('/src/a/.p.jpg.tmp'))
+        agg.dispatch(FileMovedEvent('/src/a/.p.jpg.tmp', '/src/a/p.jpg'))
+        agg.flush(force=True)
+        assert handler.events == [('created', '/src/a/p.jpg', None)]
+
+    def test_directory_move_implies_content_moves(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(DirMovedEvent('/src/a', '/src/b'))
+        agg.dispatch(FileMovedEvent('/src/a/p.jpg', '/src/b/p.jpg'))
+        agg.flush(force=True)
+        assert handler.events == [('moved', '/src/a', '/src/b')]
+
+    def test_album_before_photos(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(DirCreatedEvent('/src/a'))
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        # the album is quiet, its photo is not
+        agg.pending['/src/a']['last'] = 0
+        assert agg.flush() == 1
+        agg.pending[os.path.join('/src/a', 'p.jpg')]['last'] = 0
+        assert agg.flush() == 1
+        assert [e[0] for e in handler.events] == ['created', 'created']
+        assert handler.events[0][1] == '/src/a'
+
+    def test_close_after_write(self):
+        agg, handler = make_aggregator()
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileModifiedEvent('/src/a/p.jpg'))
+        assert agg.flush() == 0
+        agg.on_any_event(ClosedEvent('/src/a/p.jpg'))
+        # written and closed: no need to wait for the quiet window
+        assert agg.flush() == 1
+
+    def test_not_closed_is_still_written(self):
+        agg, handler = make_aggregator()
+        agg.on_any_event(ClosedEvent('/src/a/other.jpg'))
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileModifiedEvent('/src/a/p.jpg'))
+        agg.pending['/src/a/p.jpg']['last'] = 0
+        assert agg.flush() == 0
+        assert agg.writing == 1
+
+    def test_stable_size(self, tmpdir):
+        path = str(tmpdir.join('p.jpg'))
+        with open(path, 'wb') as f:
+            f.write(b'1234')
+        agg, handler = make_aggregator()
+        agg.dispatch(FileCreatedEvent(path))
+        agg.pending[path]['last'] = 0
+        # first check records size and mtime
+        assert agg.flush() == 0
+        with open(path, 'ab') as f:
+            f.write(b'5678')
+        assert agg.flush() == 0
+        assert agg.flush() == 1
+
+
+class TestEventJournal:
+    def test_handled_events_are_acked(self, tmpdir):
+        journal = EventJournal(str(tmpdir.join('journal.db')))
+        agg, handler = make_aggregator(journal)
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileModifiedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileCreatedEvent('/src/a/q.jpg'))
+        agg.dispatch(FileDeletedEvent('/src/a/q.jpg'))
+        assert journal.depth == 2, "cancelled events are acked at once"
+        agg.flush(force=True)
+        assert journal.depth == 0
+
+    def test_drained_after_crash(self, tmpdir):
+        path = str(tmpdir.join('journal.db'))
+        journal = EventJournal(path)
+        agg, handler = make_aggregator(journal)
+        agg.dispatch(FileCreatedEvent('/src/a/p.jpg'))
+        agg.dispatch(FileMovedEvent('/src/a/p.jpg', '/src/b/p.jpg'))
+        # crash: never flushed
+        journal.close()
+
+        journal = EventJournal(path)
+        assert journal.depth == 2
+        agg, handler = make_aggregator(journal)
+        agg.flush(force=True)
+        assert handler.events == [('created', '/src/b/p.jpg', None)]
+        assert journal.depth == 0
+
+    def test_bounded_pending(self, tmpdir):
+        journal = EventJournal(str(tmpdir.join('journal.db')))
+        agg, handler = make_aggregator(journal, max_pending=3)
+        for i in range(10):
+            agg.dispatch(FileCreatedEvent('/src/a/{}.jpg'.format(i)))
+        assert len(agg.pending) == 3
+        assert journal.depth == 10
+        handled = 0
+        while handled < 10:
+            n = agg.flush(force=True)
+            assert 0 < n <= 3
+            handled += n
+        assert [e[1] for e in handler.events] == ['/src/a/{}.jpg'.format(i) for i in range(10)]
+        assert journal.depth == 0
+
+
+class TestReconcile:
+    def make_tree(self, tmpdir):
+        root = tmpdir.mkdir('src')
+        root.mkdir('a').join('p.jpg').write('p')
+        root.join('a').join('q.jpg').write('q')
+        root.join('a').join('notes.txt').write('n')
+        root.mkdir('b').join('r.jpg').write('r')
+        return root
+
+    def run(self, tmpdir, root):
+        store = FingerprintStore(str(tmpdir.join('state.db')), str(root))
+        agg, handler = make_aggregator()
+        agg.store = store
+        reconcile(store, str(root), agg.dispatch)
+        agg.flush(force=True)
+        return sorted(handler.events)
+
+    def test_first_run_is_a_baseline(self, tmpdir):
+        root = self.make_tree(tmpdir)
+        assert self.run(tmpdir, root) == []
+        assert self.run(tmpdir, root) == []
+
+    def test_changes_while_stopped(self, tmpdir):
+        root = self.make_tree(tmpdir)
+        self.run(tmpdir, root)
+        root.join('a').join('new.jpg').write('new')
+        root.join('a').join('q.jpg').write('q modified')
+        root.join('a').join('p.jpg').remove()
+        root.join('b').remove()
+        root.mkdir('c').join('s.jpg').write('s')
+        root.join('a').join('other.txt').write('o')
+        src = str(root)
+        assert self.run(tmpdir, root) == sorted([
+            ('created', os.path.join(src, 'a', 'new.jpg'), None),
+            ('modified', os.path.join(src, 'a', 'q.jpg'), None),
+            ('deleted', os.path.join(src, 'a', 'p.jpg'), None),
+            ('deleted', os.path.join(src, 'b'), None),
+            ('created', os.path.join(src, 'c'), None),
+            ('created', os.path.join(src, 'c', 's.jpg'), None)])
+        # recorded as handled
+        assert self.run(tmpdir, root) == []
+
+    def test_live_moves_are_recorded(self, tmpdir):
+        root = self.make_tree(tmpdir)
+        self.run(tmpdir, root)
+        store = FingerprintStore(str(tmpdir.join('state.db')), str(root))
+        agg, handler = make_aggregator()
+        agg.store = store
+        root.join('a').move(root.join('d'))
+        agg.dispatch(DirMovedEvent(str(root.join('a')), str(root.join('d'))))
+        agg.flush(force=True)
+        store.close()
+        assert self.run(tmpdir, root) == []
+
+
+class TestScandirObserver:
+    def test_poll(self, tmpdir, monkeypatch):
+        root = tmpdir.mkdir('src')
+        root.mkdir('a').join('p.jpg').write('p')
+        root.mkdir('b').join('q.jpg').write('q')
+        store = FingerprintStore(str(tmpdir.join('poll.db')), str(root))
+        handler = RecordingHandler()
+        observer = ScandirObserver(store, interval=3600, cpu_budget=1)
+        observer.schedule(handler, str(root))
+        scanned = []
+        scandir = os.scandir
+
+        def counting_scandir(path):
+            scanned.append(path)
+            return scandir(path)
+        monkeypatch.setattr(os, 'scandir', counting_scandir)
+
+        # baseline
+        reconcile(store, str(root), handler.dispatch, record=True)
+        assert handler.events == []
+        del scanned[:]
+        reconcile(store, str(root), handler.dispatch, record=True)
+        assert scanned == [], "unchanged directories are not listed"
+
+        root.join('a').join('r.jpg').write('r')
+        observer.start()
+        for i in range(100):
+            if observer.scans:
+                break
+            time.sleep(0.05)
+        observer.stop()
+        observer.join()
+        assert handler.events == [('created', str(root.join('a').join('r.jpg')), None)]
+        assert scanned == [str(root.join('a'))]
+
+
+class TestFingerprintStore:
+    def test_checksum_follows_moves(self, tmpdir):
+        store = FingerprintStore(str(tmpdir.join('state.db')), '/src')
+        store.setChecksum('/src/a/p.jpg', 10, 1.0, 'abc')
+        # fingerprinted again once handled: unchanged, the checksum is kept
+        store.update(files=[('/src/a/p.jpg', 10, 1.0)])
+        store.move('/src/a', '/src/b')
+        assert store.checksum('/src/a/p.jpg') is None
+        assert store.checksum('/src/b/p.jpg') == 'abc'
+        assert store.listing('/src/b')[1] == {'p.jpg': (10, 1.0)}
+
+    def test_state_without_checksums(self, tmpdir):
+        import sqlite3
+        path = str(tmpdir.join('state.db'))
+        db = sqlite3.connect(path)
+        db.execute("create table meta (key text primary key, value text)")
+        db.execute("create table files (path text primary key, parent text not null, "
+                   "size integer not null, mtime real not null)")
+        db.execute("insert into meta (key, value) values ('root', '/src')")
+        db.execute("insert into files values ('/src/a/p.jpg', '/src/a', 10, 1.0)")
+        db.commit()
+        db.close()
+        store = FingerprintStore(path, '/src')
+        assert store.listing('/src/a')[1] == {'p.jpg': (10, 1.0)}
+        store.setChecksum('/src/a/p.jpg', 10, 1.0, 'abc')
+        assert store.checksum('/src/a/p.jpg') == 'abc'
+
+    def test_checksum_dropped_when_modified(self, tmpdir):
+        store = FingerprintStore(str(tmpdir.join('state.db')), '/src')
+        store.setChecksum('/src/a/p.jpg', 10, 1.0, 'abc')
+        store.update(files=[('/src/a/p.jpg', 12, 2.0)])
+        assert store.checksum('/src/a/p.jpg') is None
+
+
+class AlbumsDAO(object):
+    """ lychee_albums lookups without a db """
+
+    def __init__(self, albums):
+        # (title, parent) -> id
+        self.albums = albums
+        self.queries = 0
+
+    def get_album_id(self, title, parent):
+        self.queries += 1
+        if (title, str(parent)) in self.albums:
+            return {'id': self.albums[(title, str(parent))]}
+        return None
+
+
+class TestAlbumResolver:
+    def test_cached(self):
+        dao = AlbumsDAO({('a', '0'): 1, ('b', '1'): 2})
+        resolver = AlbumResolver('/srv/photos')
+        assert resolver.resolve(dao, '/srv/photos/a/b') == {'id': 2, 'name': 'b', 'parent': 2}
+        assert dao.queries == 2, "one query per directory, none above root"
+        assert resolver.resolve(dao, '/srv/photos/a') == {'id': 1, 'name': 'a', 'parent': 1}
+        assert resolver.resolve(dao, '/srv/photos/a/b') == {'id': 2, 'name': 'b', 'parent': 2}
+        assert dao.queries == 2
+
+    def test_missing_album(self):
+        dao = AlbumsDAO({('a', '0'): 1})
+        resolver = AlbumResolver('/srv/photos')
+        assert resolver.resolve(dao, '/srv/photos/a/c') == {'id': None, 'name': 'c', 'parent': 1}
+
+    def test_invalidate(self):
+        dao = AlbumsDAO({('a', '0'): 1})
+        resolver = AlbumResolver('/srv/photos')
+        assert resolver.resolve(dao, '/srv/photos/a/c')['id'] is None
+        # album created for c
+        dao.albums[('c', '1')] = 3
+        resolver.invalidate('/srv/photos/a/c')
+        assert resolver.resolve(dao, '/srv/photos/a/c')['id'] == 3
+        queries = dao.queries
+        resolver.invalidate('/srv/photos/a')
+        assert resolver.resolve(dao, '/srv/photos/a/c')['id'] == 3
+        assert dao.queries == queries + 2, "sub directories are invalidated too"
+
+
+class TitlesDAO(object):
+    def __init__(self, photos):
+        # album id -> titles
+        self.photos = photos
+        self.queries = 0
+
+    def getPhotoTitles(self, album_id):
+        self.queries += 1
+        return list(self.photos.get(album_id, []))
+
+
+class TestPhotoTitles:
+    def test_one_query_per_album(self):
+        dao = TitlesDAO({1: ['a.jpg', 'b.jpg']})
+        titles = PhotoTitles()
+        assert titles.contains(dao, 1, 'a.jpg')
+        assert not titles.contains(dao, 1, 'c.jpg')
+        assert not titles.contains(dao, 2, 'a.jpg')
+        assert dao.queries == 2
+        titles.add(1, 'c.jpg')
+        assert titles.contains(dao, 1, 'c.jpg')
+        assert dao.queries == 2
+
+    def test_forget(self):
+        dao = TitlesDAO({1: ['a.jpg']})
+        titles = PhotoTitles()
+        assert titles.contains(dao, 1, 'a.jpg')
+        # deleted
+        dao.photos[1] = []
+        titles.forget(1)
+        assert not titles.contains(dao, 1, 'a.jpg')
+        dao.photos[1] = ['a.jpg']
+        titles.clear()
+        assert titles.contains(dao, 1, 'a.jpg')
+        assert dao.queries == 3
+
+
+class TestWorkerPool:
+    def test_lanes_are_serialized(self):
+        pool = WorkerPool(4)
+        done = []
+        lock = threading.Lock()
+
+        def task(key, i):
+            time.sleep(0.001)
+            with lock:
+                done.append((key, i))
+
+        for i in range(20):
+            for key in ('a', 'b', 'c'):
+                pool.submit(task, (key, i), [key])
+        pool.stop()
+        assert len(done) == 60
+        for key in ('a', 'b', 'c'):
+            assert [i for k, i in done if k == key] == list(range(20))
+
+    def test_multi_lanes_task(self):
+        pool = WorkerPool(4)
+        done = []
+        pool.submit(time.sleep, (0.05,), ['a'])
+        pool.submit(done.append, ('move',), ['a', 'b'])
+        pool.submit(done.append, ('b',), ['b'])
+        pool.stop()
+        assert done == ['move', 'b']
+
+    def test_interactive_first(self):
+        pool = WorkerPool(1)
+        done = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        pool.submit(block, (), ['x'])
+        started.wait()
+        pool.submit(done.append, ('bulk',), ['a'], PRIORITY_BULK)
+        pool.submit(done.append, ('interactive',), ['b'], PRIORITY_INTERACTIVE)
+        release.set()
+        pool.stop()
+        assert done == ['interactive', 'bulk']